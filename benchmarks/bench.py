@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""Benchmarks for snapshots, dirty checks, checkouts and history lookups
+
+Generates reproducible synthetic trees for each repository size and times
+the main Repository operations on them. Results are written as JSON so two
+runs can be compared.
+
+Usage:
+  python benchmarks/bench.py -o before.json
+  python benchmarks/bench.py --sizes 100,1000 --content binary -o after.json
+  python benchmarks/bench.py --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pybranchback.repository as repository  # noqa: E402
+import pybranchback.snapshotdb as ssdb  # noqa: E402
+
+
+# Size distributions of generated files as (weight, min, max) in bytes
+SIZE_DISTRIBUTIONS = {
+    'small': [(1, 64, 16 * 1024)],
+    'mixed': [
+        (90, 64, 16 * 1024),
+        (9, 16 * 1024, 1024 * 1024),
+        (1, 1024 * 1024, 8 * 1024 * 1024),
+    ],
+    'large': [(1, 1024 * 1024, 8 * 1024 * 1024)],
+}
+WORDS = (
+    'alpha bravo charlie delta echo foxtrot golf hotel india juliett kilo '
+    'lima mike november oscar papa quebec romeo sierra tango uniform victor '
+    'whiskey xray yankee zulu'
+).split()
+
+
+def parse_arguments():
+    """Parses command line options"""
+    parser = argparse.ArgumentParser(
+        description='Benchmarks PyBranchBack repository operations'
+    )
+    parser.add_argument(
+        '--sizes', type=str, default='100,1000',
+        help='Comma separated file counts of the generated repositories'
+    )
+    parser.add_argument(
+        '--depth', type=int, default=3,
+        help='Directory depth of the generated trees'
+    )
+    parser.add_argument(
+        '--size-dist', choices=sorted(SIZE_DISTRIBUTIONS), default='small',
+        help='Distribution of the sizes of generated files'
+    )
+    parser.add_argument(
+        '--content', choices=('text', 'binary', 'mixed'), default='mixed',
+        help='Type of content of generated files'
+    )
+    parser.add_argument(
+        '--edit-ratio', type=float, default=0.05,
+        help='Fraction of files changed between the two snapshots'
+    )
+    parser.add_argument(
+        '--history', type=int, default=10000,
+        help='Number of snapshot rows in the history for lookups'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Number of runs of each repeatable measurement'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of workers used by the repository'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed of the generated content'
+    )
+    parser.add_argument(
+        '-o', '--output', type=str,
+        help='Path of the JSON results file (default: standard output)'
+    )
+    parser.add_argument(
+        '--compare', type=str, nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two results files instead of running benchmarks'
+    )
+    return parser.parse_args()
+
+
+def generate_tree(root, file_count, depth, size_dist, content, rng):
+    """Generates a tree of files and returns their relative paths"""
+    # Spread the files over a balanced tree of directories
+    directories = ['']
+    fanout = max(2, round(file_count ** (1 / (depth + 1))))
+    for level in range(depth):
+        directories = [
+            os.path.join(directory, 'dir{}'.format(i))
+            for directory in directories
+            for i in range(fanout)
+        ][:max(1, file_count // 2)]
+
+    paths = []
+    for number in range(file_count):
+        directory = directories[number % len(directories)]
+        paths.append(os.path.join(directory, 'file{}.dat'.format(number)))
+
+    for path in paths:
+        write_file(root, path, random_size(size_dist, rng), content, rng)
+    return paths
+
+
+def edit_tree(root, paths, edit_ratio, size_dist, content, rng):
+    """Modifies a fraction of the files in place and adds a new file"""
+    count = max(1, int(len(paths) * edit_ratio))
+    for path in rng.sample(paths, min(count, len(paths))):
+        with open(os.path.join(root, path), 'r+b') as edit_file:
+            size = os.fstat(edit_file.fileno()).st_size
+            edit_file.seek(rng.randrange(max(1, size)))
+            edit_file.write(random_content(32, content, rng))
+    write_file(root, 'added.dat', random_size(size_dist, rng), content, rng)
+
+
+def write_file(root, path, size, content, rng):
+    """Writes a file of random content with the given size"""
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, 'wb') as out_file:
+        out_file.write(random_content(size, content, rng))
+
+
+def random_size(size_dist, rng):
+    """Returns a random file size from the named size distribution"""
+    buckets = SIZE_DISTRIBUTIONS[size_dist]
+    _, low, high = rng.choices(buckets, [b[0] for b in buckets])[0]
+    return rng.randint(low, high)
+
+
+def random_content(size, content, rng):
+    """Returns random text or binary content of the given size"""
+    if content == 'mixed':
+        content = rng.choice(('text', 'binary'))
+    if content == 'binary':
+        return rng.randbytes(size)
+
+    text = ' '.join(rng.choices(WORDS, k=size // 5 + 1)).encode()
+    return text[:size]
+
+
+def timed(func, repeat=1):
+    """Runs a function repeatedly and returns the duration of each run"""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def run_case(file_count, args):
+    """Runs every benchmark on a repository with the given number of files"""
+    rng = random.Random('{}-{}'.format(args.seed, file_count))
+    root = tempfile.mkdtemp(prefix='pbb-bench-')
+    save_wd = os.getcwd()
+    metrics = {}
+    try:
+        os.chdir(root)
+        paths = generate_tree(
+            root, file_count, args.depth, args.size_dist, args.content, rng
+        )
+        repo = repository.Repository(root, create=True, workers=args.jobs)
+
+        # Snapshots of a new tree and of a partially edited tree
+        metrics['snapshot_initial'] = timed(lambda: repo.snapshot('initial'))
+        first_hash, _ = repo._current_snapshot_hash()
+        edit_tree(
+            root, paths, args.edit_ratio, args.size_dist, args.content, rng
+        )
+        metrics['snapshot_edit'] = timed(lambda: repo.snapshot('edit'))
+
+        # Dirty checks with and without the working tree index
+        metrics['check_dirty'] = timed(
+            lambda: repo._check_dirty(first_hash), args.repeat
+        )
+
+        def check_dirty_no_index():
+            repo.index.entries = {}
+            repo.index.timestamp = None
+            repo._check_dirty(first_hash)
+        metrics['check_dirty_no_index'] = timed(
+            check_dirty_no_index, args.repeat
+        )
+
+        # Moving between the two snapshots and back again
+        checkout_runs = []
+        switch_runs = []
+        for _ in range(args.repeat):
+            checkout_runs += timed(lambda: repo.checkout(first_hash))
+            switch_runs += timed(
+                lambda: repo.switch_branch(repo.DEFAULT_BRANCH)
+            )
+        metrics['checkout'] = checkout_runs
+        metrics['switch_branch'] = switch_runs
+
+        # History lookups in a large snapshots table
+        fill_history(repo, args.history, rng)
+        prefixes = [first_hash[:length] for length in (7, 10, 40)]
+        metrics['full_hash'] = timed(
+            lambda: [repo._full_hash(prefix) for prefix in prefixes],
+            args.repeat,
+        )
+        metrics['list_snapshots'] = timed(repo.list_snapshots, args.repeat)
+    finally:
+        os.chdir(save_wd)
+        ssdb.close()
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'files': file_count,
+        'metrics': {
+            name: summarize(runs) for name, runs in metrics.items()
+        },
+    }
+
+
+def fill_history(repo, count, rng):
+    """Inserts synthetic snapshot rows to simulate a long history"""
+    con = ssdb.connect(repo._join_root(repo.FILES['snapshots']))
+    with con:
+        con.executemany(ssdb.INSERT, (
+            {
+                'hash': '{:040x}'.format(rng.getrandbits(160)),
+                'branch': 'history',
+                'message': '',
+                'user': '',
+            }
+            for _ in range(count)
+        ))
+
+
+def summarize(runs):
+    """Returns the statistics of the durations of a benchmark"""
+    return {
+        'runs': runs,
+        'min': min(runs),
+        'median': statistics.median(runs),
+        'max': max(runs),
+    }
+
+
+def compare(old_path, new_path):
+    """Prints the change in median time of every benchmark of two runs"""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old_results = json.load(old_file)['results']
+        new_results = json.load(new_file)['results']
+
+    old_metrics = {
+        (result['files'], name): values['median']
+        for result in old_results
+        for name, values in result['metrics'].items()
+    }
+    row = '{files: >8} {name: <22} {old: >10} {new: >10} {ratio: >8}'
+    print(row.format(
+        files='files', name='benchmark', old='old (s)', new='new (s)',
+        ratio='new/old',
+    ))
+    for result in new_results:
+        for name, values in sorted(result['metrics'].items()):
+            old = old_metrics.get((result['files'], name))
+            if old is None:
+                continue
+            print(row.format(
+                files=result['files'], name=name,
+                old='{:.4f}'.format(old),
+                new='{:.4f}'.format(values['median']),
+                ratio='{:.2f}'.format(values['median'] / old if old else 0),
+            ))
+
+
+def main():
+    """Runs the benchmarks or compares two results files"""
+    args = parse_arguments()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'parameters': {
+                key: value for key, value in vars(args).items()
+                if key not in ('output', 'compare')
+            },
+        },
+        'results': [
+            run_case(int(size), args) for size in args.sizes.split(',')
+        ],
+    }
+
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
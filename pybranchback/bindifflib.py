@@ -1,12 +1,395 @@
-"""Library for performing binary delta compressions"""
+"""Library for performing binary delta compressions
+
+Patches are made by pluggable delta engines. Each engine has a unique id
+that is stored at the start of its patches, after the magic 'PBBD', so a
+patch is always applied by the engine that made it. Patches without the
+magic are bsdiff patches of older repositories. Additional engines can be
+added with register_engine.
+
+The engine of a diff is chosen by the estimated memory it needs. bsdiff
+makes the smallest patches but needs memory many times the size of the
+reference, so larger files use the block engine, whose memory use is
+bounded whatever the size of its inputs.
+"""
+import struct
+import zlib
+
 import bsdiff4
 
 
-def diff(compress, reference):
-    """Compresses the given bytes using the reference and return a patch"""
-    return bsdiff4.diff(reference, compress)
+MAGIC = b'PBBD'
+# Default bytes of memory a diff may use besides its inputs
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+class DeltaFormatException(Exception):
+
+    """A patch is not valid for the engine that applies it"""
+
+    pass
+
+
+class Engine:
+
+    """Interface of a delta engine
+
+    Subclasses set a unique id (0-255) and name, and implement diff, patch
+    and memory.
+    """
+
+    id = None
+    name = None
+
+    def diff(self, compress, reference):
+        """Returns a patch from the reference to the compressed content"""
+        raise NotImplementedError
+
+    def patch(self, patch, reference):
+        """Returns the content rebuilt by applying a patch to the reference"""
+        raise NotImplementedError
+
+    def memory(self, size, ref_size):
+        """Returns the estimated peak bytes of memory used by diff"""
+        raise NotImplementedError
+
+
+class BsdiffEngine(Engine):
+
+    """Engine using bsdiff, which sorts every suffix of the reference"""
+
+    id = 0
+    name = 'bsdiff'
+
+    def diff(self, compress, reference):
+        return bsdiff4.diff(reference, compress)
+
+    def patch(self, patch, reference):
+        return bsdiff4.patch(reference, patch)
+
+    def memory(self, size, ref_size):
+        # Suffix array and its inverse of 8 byte offsets, plus the buffers
+        # of the patch being built
+        return 16 * ref_size + 2 * size
+
+
+class BlockEngine(Engine):
+
+    """Single pass engine matching blocks of the reference by checksum
+
+    The reference is indexed by the CRC of at most MAX_BLOCKS fixed size
+    blocks. The new content is scanned once, extending every match as far
+    as possible. After an insertion or deletion the continuation of the
+    last match is searched for within a window, and other moved content
+    is found again through the block index. The instructions are
+    compressed with zlib as they are made.
+
+    Instructions, after the length of the new content (u64):
+      copy:   'C', offset in the reference (u64), length (u64)
+      insert: 'I', length (u64), followed by the inserted bytes
+    """
+
+    id = 1
+    name = 'block'
+
+    # Block sizes are a power of two, large enough for at most MAX_BLOCKS
+    MIN_BLOCK = 64
+    MAX_BLOCKS = 256 * 1024
+    # Estimated bytes of memory used by each entry of the block index
+    INDEX_ENTRY = 128
+    # Shortest run of the reference stored as a copy
+    MIN_MATCH = 32
+    # Blocks searched for the continuation of a match after an edit
+    SEARCH_BLOCKS = 8
+    COMPRESSION_LEVEL = 6
+
+    LENGTH = struct.Struct('>Q')
+    COPY = struct.Struct('>cQQ')
+    INSERT = struct.Struct('>cQ')
+
+    def diff(self, compress, reference):
+        block = self.block_size(len(reference))
+        window = max(4096, block * self.SEARCH_BLOCKS)
+        index = self._index(reference, block)
+        writer = _PatchWriter(self, len(compress))
+
+        position = 0
+        ref_position = 0
+        size = len(compress)
+        while position < size:
+            # Continue the last match, or else look up the next block
+            length = _common_length(
+                compress, position, reference, ref_position
+            )
+            if length < self.MIN_MATCH:
+                found = index.get(
+                    zlib.crc32(compress[position:position + block])
+                )
+                if found is not None:
+                    found_length = _common_length(
+                        compress, position, reference, found
+                    )
+                    if found_length > length:
+                        ref_position, length = found, found_length
+            if length >= self.MIN_MATCH:
+                writer.copy(ref_position, length)
+                position += length
+                ref_position += length
+                continue
+
+            # Search for the reference continuing after an insertion
+            probe = reference[ref_position:ref_position + self.MIN_MATCH]
+            inserted = -1
+            if len(probe) == self.MIN_MATCH:
+                inserted = compress.find(
+                    probe, position + 1, position + window
+                )
+            # or for the new content continuing after a deletion
+            probe = compress[position:position + self.MIN_MATCH]
+            deleted = -1
+            if len(probe) == self.MIN_MATCH:
+                deleted = reference.find(
+                    probe, ref_position + 1, ref_position + window
+                )
+
+            if inserted >= 0 and (
+                    deleted < 0 or
+                    inserted - position <= deleted - ref_position):
+                writer.insert(compress[position:inserted])
+                position = inserted
+            elif deleted >= 0:
+                ref_position = deleted
+            else:
+                # Content replaced in place, skip ahead to where the old
+                # and new content match again
+                skip = self._replaced_length(
+                    compress, position, reference, ref_position, block
+                )
+                writer.insert(compress[position:position + skip])
+                position += skip
+                ref_position += skip
+        return writer.finish()
+
+    def patch(self, patch, reference):
+        try:
+            instructions = zlib.decompress(patch)
+            length, = self.LENGTH.unpack_from(instructions)
+        except (zlib.error, struct.error):
+            raise DeltaFormatException('Invalid block patch')
+
+        content = bytearray()
+        offset = self.LENGTH.size
+        while offset < len(instructions):
+            code = instructions[offset:offset + 1]
+            try:
+                if code == b'C':
+                    _, start, count = self.COPY.unpack_from(
+                        instructions, offset
+                    )
+                    offset += self.COPY.size
+                    content += reference[start:start + count]
+                elif code == b'I':
+                    _, count = self.INSERT.unpack_from(instructions, offset)
+                    offset += self.INSERT.size
+                    content += instructions[offset:offset + count]
+                    offset += count
+                else:
+                    raise DeltaFormatException('Invalid block instruction')
+            except struct.error:
+                raise DeltaFormatException('Truncated block instruction')
+
+        if len(content) != length:
+            raise DeltaFormatException('Block patch has the wrong length')
+        return bytes(content)
+
+    def memory(self, size, ref_size):
+        # The block index and the instructions, at most the new content
+        blocks = ref_size // self.block_size(ref_size)
+        return self.INDEX_ENTRY * blocks + size
+
+    def block_size(self, ref_size):
+        """Returns the block size used to index a reference"""
+        block = self.MIN_BLOCK
+        while ref_size // block > self.MAX_BLOCKS:
+            block *= 2
+        return block
+
+    def _index(self, reference, block):
+        """Returns {CRC: offset} of the first of each distinct block"""
+        view = memoryview(reference)
+        index = {}
+        for offset in range(0, len(reference) - block + 1, block):
+            index.setdefault(zlib.crc32(view[offset:offset + block]), offset)
+        return index
+
+    def _replaced_length(self, compress, position, reference, ref_position,
+                         block):
+        """Returns the length of content replaced in place, at most a block
+
+        Checks at doubling distances where the old and new content match
+        again, so the work is logarithmic in the block size.
+        """
+        skip = self.MIN_MATCH
+        while skip < block:
+            start = position + skip
+            ref_start = ref_position + skip
+            if (compress[start:start + self.MIN_MATCH] ==
+                    reference[ref_start:ref_start + self.MIN_MATCH]):
+                return skip
+            skip *= 2
+        return block
+
+
+class _PatchWriter:
+
+    """Compresses the instructions of a block patch as they are made"""
+
+    def __init__(self, engine, length):
+        """Initialize instance variables"""
+        self.engine = engine
+
+        # Instance variables
+        self._compressor = zlib.compressobj(engine.COMPRESSION_LEVEL)
+        self._parts = [self._compressor.compress(engine.LENGTH.pack(length))]
+        self._literal = []
+
+    def copy(self, offset, length):
+        """Adds an instruction copying a run of the reference"""
+        self._flush_literal()
+        self._write(self.engine.COPY.pack(b'C', offset, length))
+
+    def insert(self, content):
+        """Adds new content, joined with any directly preceding content"""
+        if content:
+            self._literal.append(content)
+
+    def finish(self):
+        """Returns the compressed instructions"""
+        self._flush_literal()
+        self._parts.append(self._compressor.flush())
+        return b''.join(self._parts)
+
+    def _flush_literal(self):
+        """Writes the pending new content as a single instruction"""
+        if not self._literal:
+            return
+        content = b''.join(self._literal)
+        self._literal = []
+        self._write(self.engine.INSERT.pack(b'I', len(content)))
+        self._write(content)
+
+    def _write(self, data):
+        """Compresses data into the patch"""
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._parts.append(compressed)
+
+
+def _common_length(compress, position, reference, ref_position):
+    """Returns the length of the common prefix of two positions
+
+    Compares runs of doubling size, then finds the end of the match by
+    bisection, so long matches take few comparisons.
+    """
+    length = 0
+    step = 64
+    while True:
+        start = position + length
+        ref_start = ref_position + length
+        run = compress[start:start + step]
+        if not run or run != reference[ref_start:ref_start + step]:
+            break
+        length += step
+        step = min(step * 2, 1024 * 1024)
+
+    # The match ends within the run that differed
+    low = 0
+    high = len(run)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if (compress[start:start + middle] ==
+                reference[ref_start:ref_start + middle]):
+            low = middle
+        else:
+            high = middle - 1
+    return length + low
+
+
+ENGINES = {}
+
+
+def register_engine(engine):
+    """Registers an engine so it can be found by id or name
+
+    Engines are preferred in the order they are registered.
+    """
+    if engine.id in ENGINES:
+        raise ValueError('Engine id already registered: {}'.format(engine.id))
+    ENGINES[engine.id] = engine
+
+
+def get_engine(engine_id):
+    """Returns the registered engine with the given id or name
+
+    Raises:
+      ValueError: If no engine is registered with the id or name
+    """
+    if engine_id in ENGINES:
+        return ENGINES[engine_id]
+    for engine in ENGINES.values():
+        if engine.name == engine_id:
+            return engine
+    raise ValueError('Unknown delta engine: {}'.format(engine_id))
+
+
+def select_engine(size, ref_size, memory_budget=MEMORY_BUDGET):
+    """Returns the first engine whose diff fits in the memory budget
+
+    The engine needing the least memory is returned if none fits.
+    """
+    for engine in ENGINES.values():
+        if engine.memory(size, ref_size) <= memory_budget:
+            return engine
+    return min(
+        ENGINES.values(), key=lambda engine: engine.memory(size, ref_size)
+    )
+
+
+def diff(compress, reference, engine=None, memory_budget=MEMORY_BUDGET):
+    """Compresses the given bytes using the reference and return a patch
+
+    The engine is chosen by the memory budget unless an id or name is given.
+    """
+    if engine is None:
+        engine = select_engine(len(compress), len(reference), memory_budget)
+    else:
+        engine = get_engine(engine)
+    return MAGIC + bytes([engine.id]) + engine.diff(compress, reference)
 
 
 def patch(patch, reference):
-    """Return an uncompressed file by applying the patch to the reference"""
-    return bsdiff4.patch(reference, patch)
+    """Return an uncompressed file by applying the patch to the reference
+
+    Raises:
+      DeltaFormatException: If the patch is not valid
+    """
+    if not patch.startswith(MAGIC):
+        return ENGINES[BsdiffEngine.id].patch(patch, reference)
+
+    try:
+        engine = get_engine(patch[len(MAGIC)])
+    except (IndexError, ValueError):
+        raise DeltaFormatException('Unknown delta engine of patch')
+    return engine.patch(patch[len(MAGIC) + 1:], reference)
+
+
+def diff_stats(compress, reference, engine=None, memory_budget=MEMORY_BUDGET):
+    """Returns the sizes of two versions and of the patch between them"""
+    return {
+        'old_size': len(reference),
+        'new_size': len(compress),
+        'patch_size': len(diff(compress, reference, engine, memory_budget)),
+    }
+
+
+for _engine in (BsdiffEngine(), BlockEngine()):
+    register_engine(_engine)
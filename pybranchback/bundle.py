@@ -0,0 +1,208 @@
+"""Bundles moving snapshots and their objects between repositories
+
+Bundle layout:
+  header:  magic 'PBBU', version (u32), format version of the repository
+           the objects were stored by (u32)
+  records: kind (1 byte), payload length (u64), payload
+
+Records, in this order:
+  'P' prerequisite: raw digest of a snapshot the receiver must already have
+  'S' snapshot:     UTF-8 JSON of the data of a snapshot and its renames
+  'O' object:       raw digest followed by the stored content of the object
+  'E' end:          SHA-1 digest of everything before the end record
+
+Bundles are written and read one record at a time, so they can be streamed
+through a pipe. Only a single stored object is held in memory at once.
+The format version tells whether the trees are binary or text, as a
+repository writing the other tree format could never match them again.
+"""
+import hashlib
+import io
+import json
+import struct
+import tarfile
+
+
+MAGIC = b'PBBU'
+VERSION = 2
+
+HEADER = struct.Struct('>4sII')
+RECORD = struct.Struct('>cQ')
+DIGEST_SIZE = 20
+
+# Record kinds, FORMAT is only yielded for the header
+FORMAT = b'F'
+PREREQUISITE = b'P'
+SNAPSHOT = b'S'
+OBJECT = b'O'
+END = b'E'
+
+
+class BundleException(Exception):
+
+    """A bundle is corrupt, truncated or cannot be applied"""
+
+    pass
+
+
+class BundleWriter:
+
+    """Writes the records of a bundle to a binary stream"""
+
+    def __init__(self, stream, format_version):
+        """Writes the bundle header"""
+        self.stream = stream
+
+        # Instance variables
+        self._hasher = hashlib.sha1()
+        self._write(HEADER.pack(MAGIC, VERSION, format_version))
+
+    def prerequisite(self, snapshot_hash):
+        """Adds a snapshot the receiver must already have"""
+        self._record(PREREQUISITE, bytes.fromhex(snapshot_hash))
+
+    def snapshot(self, data):
+        """Adds the data of a snapshot as a dictionary"""
+        self._record(SNAPSHOT, json.dumps(data, sort_keys=True).encode())
+
+    def object(self, obj_hash, content):
+        """Adds the stored content of an object"""
+        self._write(RECORD.pack(OBJECT, DIGEST_SIZE + len(content)))
+        self._write(bytes.fromhex(obj_hash))
+        self._write(content)
+
+    def finish(self):
+        """Writes the end record and flushes the stream"""
+        self._record(END, self._hasher.digest())
+        self.stream.flush()
+
+    def _record(self, kind, payload):
+        """Writes a whole record"""
+        self._write(RECORD.pack(kind, len(payload)))
+        self._write(payload)
+
+    def _write(self, data):
+        """Writes data to the stream and adds it to the checksum"""
+        self._hasher.update(data)
+        self.stream.write(data)
+
+
+def read_bundle(stream):
+    """Yields the (kind, value) of each record of a bundle
+
+    The format version of the header is yielded first. Prerequisites are
+    yielded as hashes, snapshots as dictionaries and objects as (hash,
+    stored content). The end record is checked against the checksum of the
+    bundle and yielded last with a value of None.
+
+    Raises:
+      BundleException: If the bundle is corrupt or truncated
+    """
+    hasher = hashlib.sha1()
+    magic, version, format_version = HEADER.unpack(
+        _read_exactly(stream, HEADER.size, hasher)
+    )
+    if magic != MAGIC or version != VERSION:
+        raise BundleException('Not a bundle or unsupported version')
+    yield FORMAT, format_version
+
+    while True:
+        record = stream.read(RECORD.size)
+        if len(record) != RECORD.size:
+            raise BundleException('Bundle is truncated')
+        kind, length = RECORD.unpack(record)
+
+        # The end record is not part of its own checksum
+        if kind == END:
+            if _read_exactly(stream, length) != hasher.digest():
+                raise BundleException('Bundle checksum does not match')
+            yield END, None
+            return
+
+        hasher.update(record)
+        payload = _read_exactly(stream, length, hasher)
+        if kind == PREREQUISITE:
+            yield kind, payload.hex()
+        elif kind == SNAPSHOT:
+            try:
+                data = json.loads(payload.decode())
+            except ValueError:
+                raise BundleException('Invalid snapshot record')
+            yield kind, data
+        elif kind == OBJECT:
+            yield kind, (payload[:DIGEST_SIZE].hex(), payload[DIGEST_SIZE:])
+        else:
+            raise BundleException('Invalid bundle record')
+
+
+def write_archive(stream, entries, mtime=0):
+    """Streams a tar archive of files to a binary stream
+
+    Entries are (path, type, size, pieces) with a type of 'tree' or
+    'blob'. The content of each blob is written from an iterable of pieces
+    as it is read, so only a single piece is held in memory at once.
+    """
+    with tarfile.open(fileobj=stream, mode='w|') as archive:
+        for path, obj_type, size, pieces in entries:
+            info = tarfile.TarInfo(path)
+            info.mtime = mtime
+            if obj_type == 'tree':
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                archive.addfile(info)
+                continue
+            info.size = size
+            info.mode = 0o644
+            archive.addfile(info, _PieceReader(pieces))
+    stream.flush()
+
+
+class _PieceReader(io.RawIOBase):
+
+    """Read-only file object over an iterable of bytes pieces"""
+
+    def __init__(self, pieces):
+        """Initialize instance variables"""
+        self._pieces = iter(pieces)
+        self._piece = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # Fill the whole buffer across pieces, as readers such as tarfile
+        # take a short read for the end of the data
+        filled = 0
+        while filled < len(buffer):
+            # Move on to the next piece once the current one is used up
+            if self._offset >= len(self._piece):
+                self._piece = next(self._pieces, None)
+                self._offset = 0
+                if self._piece is None:
+                    self._piece = b''
+                    break
+                continue
+
+            length = min(
+                len(buffer) - filled, len(self._piece) - self._offset
+            )
+            buffer[filled:filled + length] = \
+                self._piece[self._offset:self._offset + length]
+            self._offset += length
+            filled += length
+        return filled
+
+
+def _read_exactly(stream, length, hasher=None):
+    """Reads length bytes from a stream, added to the checksum if given
+
+    Raises:
+      BundleException: If the stream ends first
+    """
+    data = stream.read(length)
+    if len(data) != length:
+        raise BundleException('Bundle is truncated')
+    if hasher is not None:
+        hasher.update(data)
+    return data
@@ -0,0 +1,80 @@
+"""Size bounded caches for reconstructed repository objects"""
+import collections
+import threading
+
+
+class ObjectCache:
+
+    """Least recently used cache of object contents bounded by total bytes
+
+    Counts hits and misses so the size can be tuned for a workload. Safe to
+    share between threads. Values other than bytes can be cached by giving
+    a function returning their size in bytes.
+    """
+
+    def __init__(self, max_bytes, sizeof=len):
+        """Initialize instance variables"""
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        # Instance variables
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, obj_hash):
+        return obj_hash in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, obj_hash):
+        """Returns the cached content for a hash or None if not cached"""
+        with self._lock:
+            content = self._entries.get(obj_hash)
+            if content is None:
+                self.misses += 1
+                return None
+
+            # Mark as the most recently used entry
+            self._entries.move_to_end(obj_hash)
+            self.hits += 1
+            return content
+
+    def put(self, obj_hash, content):
+        """Adds content to the cache, evicting the least recently used"""
+        # Content larger than the whole cache would only flush it
+        content_size = self.sizeof(content)
+        if content_size > self.max_bytes:
+            return
+
+        with self._lock:
+            if obj_hash in self._entries:
+                self._entries.move_to_end(obj_hash)
+                return
+
+            self._entries[obj_hash] = content
+            self.size += content_size
+
+            # Evict least recently used entries until under the size limit
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def clear(self):
+        """Removes all cached content without resetting the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache counters and current usage"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+        }
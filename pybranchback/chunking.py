@@ -0,0 +1,83 @@
+"""Content-defined chunking of large files with a gear rolling hash
+
+Chunk boundaries depend only on the bytes just before them, so an edit in
+the middle of a file only changes the chunks around the edit and all other
+chunks (and their stored objects) are shared between versions and files.
+"""
+import hashlib
+
+
+# Default chunk sizes in bytes, the average size must be a power of two
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+# Bytes read from a stream at a time
+READ_SIZE = 1024 * 1024
+
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+# Random value for each byte, derived from a hash so it never changes
+GEAR = tuple(
+    int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], 'big')
+    for value in range(256)
+)
+
+
+class Chunker:
+
+    """Splits streams into content-defined chunks
+
+    A gear hash is rolled over each chunk starting after the minimum chunk
+    size, and a chunk ends where the top bits of the hash are all zero (on
+    average avg_size bytes past the minimum) or at the maximum chunk size.
+    """
+
+    def __init__(
+            self, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+        """Initialize instance variables"""
+        if avg_size & (avg_size - 1) or not min_size <= avg_size <= max_size:
+            raise ValueError('Invalid chunk sizes')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+        # Use the top bits of the hash, which depend on the most bytes
+        bits = avg_size.bit_length() - 1
+        self._mask = ((1 << bits) - 1) << (HASH_BITS - bits)
+
+    def split(self, stream):
+        """Yields the chunks of a binary stream as bytes"""
+        buffer = bytearray()
+        at_end = False
+        while True:
+            # Keep at least one maximum sized chunk in the buffer
+            while len(buffer) < self.max_size and not at_end:
+                data = stream.read(READ_SIZE)
+                if data:
+                    buffer += data
+                else:
+                    at_end = True
+
+            if not buffer:
+                return
+
+            cut = self.cut_point(buffer)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+
+    def cut_point(self, data):
+        """Returns the length of the first chunk of the data"""
+        end = min(len(data), self.max_size)
+        if end <= self.min_size:
+            return end
+
+        # Local variables keep the per byte loop as fast as possible
+        gear = GEAR
+        mask = self._mask
+        rolling = 0
+        for position in range(self.min_size, end):
+            rolling = ((rolling << 1) + gear[data[position]]) & HASH_MASK
+            if not rolling & mask:
+                return position + 1
+        return end
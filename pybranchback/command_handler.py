@@ -1,5 +1,10 @@
 import argparse
+import contextlib
 import os
+import sys
+import pybranchback.bundle as bundle
+import pybranchback.monitor as monitor
+import pybranchback.profiling as profiling
 import pybranchback.repository as repository
 
 
@@ -12,11 +17,32 @@ def parse_arguments():
       load - Loads an existing snapshot or branch
       branch - Creates a new branch
       list - Lists snapshots and/or branches of the repository
+      status - Lists files changed since the current snapshot
+      diff - Lists files changed between two snapshots
+      pack - Consolidates loose objects into packfiles
+      gc - Removes unreachable objects and repacks the repository
+      migrate - Converts objects of an older repository to the new format
+      monitor - Starts, stops or shows the file system monitor
+      sparse - Materializes only the paths matching patterns
+      export - Writes a bundle or tar archive of a snapshot
+      import - Adds the snapshots and objects of a bundle
     """
     # Create main parser and subparsers
     parser = argparse.ArgumentParser(
         description='Simple branching version control program'
     )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of workers used to store or restore files'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print counters and timings of the command when it completes'
+    )
+    parser.add_argument(
+        '--profile-output', type=str, metavar='FILE',
+        help='Write a cProfile of the command to the given file'
+    )
     subparsers = parser.add_subparsers(dest='command')
     subparsers.required = True
 
@@ -96,6 +122,140 @@ def parse_arguments():
         help='Display list of branches'
     )
 
+    # Parse 'status'
+    status_parser = subparsers.add_parser(
+        'status', help='Lists files changed since the current snapshot'
+    )
+    status_parser.add_argument(
+        '-s', '--stat', action='store_true',
+        help='Display file sizes and binary patch sizes of changes'
+    )
+
+    # Parse 'diff'
+    diff_parser = subparsers.add_parser(
+        'diff', help='Lists files changed between two snapshots'
+    )
+    diff_parser.add_argument(
+        'old', type=str,
+        help='Address or branch name of the old snapshot'
+    )
+    diff_parser.add_argument(
+        'new', type=str, nargs='?',
+        help='Address or branch name of the new snapshot (default: directory)'
+    )
+    diff_parser.add_argument(
+        '-s', '--stat', action='store_true',
+        help='Display file sizes and binary patch sizes of changes'
+    )
+
+    # Parse 'pack'
+    pack_parser = subparsers.add_parser(
+        'pack', help='Consolidates loose objects into packfiles'
+    )
+    pack_parser.add_argument(
+        '-s', '--max-size', type=int,
+        help='Maximum size of each packfile in megabytes'
+    )
+
+    # Parse 'gc'
+    gc_parser = subparsers.add_parser(
+        'gc', help='Removes unreachable objects and repacks the repository'
+    )
+    gc_parser.add_argument(
+        '-r', '--rebase', action='store_true',
+        help='Store full copies to bound long or inefficient delta chains'
+    )
+    gc_parser.add_argument(
+        '--no-repack', action='store_true',
+        help='Leave loose objects unpacked'
+    )
+    gc_parser.add_argument(
+        '-g', '--grace-period', type=int, metavar='SECONDS',
+        help='Keep unreachable objects written within this many seconds'
+    )
+
+    # Parse 'migrate'
+    subparsers.add_parser(
+        'migrate',
+        help='Converts objects of an older repository to the new format'
+    )
+
+    # Parse 'monitor'
+    monitor_parser = subparsers.add_parser(
+        'monitor', help='Starts, stops or shows the file system monitor',
+        description=(
+            'The monitor records changed paths so saves and checks only '
+            'revisit changed directories. Requires Linux inotify.'
+        ),
+    )
+    monitor_parser.add_argument(
+        'action', choices=('start', 'stop', 'status'),
+        help='Action to perform on the monitor'
+    )
+    monitor_parser.add_argument(
+        '--foreground', action='store_true',
+        help='Run the monitor in this process until interrupted'
+    )
+
+    # Parse 'sparse'
+    sparse_parser = subparsers.add_parser(
+        'sparse', help='Materializes only the paths matching patterns',
+        description=(
+            'Patterns use the syntax of ignore files. Paths not matching '
+            'are kept in snapshots without being written. A pattern '
+            'without a leading slash such as src/ matches in every '
+            'directory, use /src/ to select only the top level directory. '
+            'Without patterns the current patterns are listed.'
+        ),
+    )
+    sparse_parser.add_argument(
+        'patterns', type=str, nargs='*',
+        help='Patterns of the paths to materialize'
+    )
+    sparse_parser.add_argument(
+        '--disable', action='store_true',
+        help='Materialize every path again'
+    )
+    sparse_parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='Forces checkout even if unsaved changes in the directory'
+    )
+
+    # Parse 'export'
+    export_parser = subparsers.add_parser(
+        'export', help='Writes a bundle or tar archive of a snapshot',
+        description=(
+            'A bundle holds the snapshot and only the objects it needs, '
+            'and can be imported into another repository.'
+        ),
+    )
+    export_parser.add_argument(
+        'snapshot', type=str, nargs='?',
+        help='Address or branch name of the snapshot (default: current)'
+    )
+    export_parser.add_argument(
+        '-b', '--base', type=str,
+        help='Include the history after this snapshot, which the '
+             'receiving repository must already have'
+    )
+    export_parser.add_argument(
+        '-o', '--output', type=str, metavar='FILE',
+        help='File to write to (default: standard output)'
+    )
+    export_parser.add_argument(
+        '--tar', action='store_true',
+        help='Write a tar archive of the files of the snapshot instead'
+    )
+
+    # Parse 'import'
+    import_parser = subparsers.add_parser(
+        'import', help='Adds the snapshots and objects of a bundle'
+    )
+    import_parser.add_argument(
+        'bundle', type=str, nargs='?',
+        help='Bundle file to read (default: standard input)'
+    )
+
     # Parse and return arguments
     return parser.parse_args()
 
@@ -104,10 +264,27 @@ def process_commands():
     """Parses and processes command line options"""
     # Parse and handle each different command
     args = parse_arguments()
+    with profiling.cprofile(args.profile_output):
+        repo = run_command(args)
+
+    # Display the collected counters and timings
+    if args.profile:
+        cache_stats = repo.profile_report()['object_cache']
+        print(repo.stats.format(), file=sys.stderr)
+        print(
+            '\nobject cache: {hits} hits, {misses} misses'.format(
+                **cache_stats
+            ),
+            file=sys.stderr,
+        )
+
 
+def run_command(args):
+    """Processes a parsed command and returns the repository instance"""
     # Get repository instance and process 'init' command
     repo = repository.Repository(
-        os.getcwd(), create=(args.command == 'init')
+        os.getcwd(), create=(args.command == 'init'), workers=args.jobs,
+        profile=args.profile,
     )
 
     # Process 'save'
@@ -168,6 +345,143 @@ def process_commands():
                 current = ' '
             print(base_string.format(cur=current, **snapshot))
 
+    # Process 'status'
+    if args.command == 'status':
+        changes = repo.status(args.stat)
+        if not changes:
+            print('No changes')
+        for change in changes:
+            print(change_handler(change))
+
+    # Process 'diff'
+    if args.command == 'diff':
+        try:
+            for change in repo.diff(args.old, args.new, args.stat):
+                print(change_handler(change))
+        except repository.InvalidHashException as err:
+            print(invalid_hash_handler(err))
+
+    # Process 'pack'
+    if args.command == 'pack':
+        max_pack_size = None
+        if args.max_size is not None:
+            max_pack_size = args.max_size * 1024 * 1024
+        result = repo.pack(max_pack_size)
+        print('Packed {} objects into {} packfiles'.format(
+            result['objects'], len(result['packs'])
+        ))
+
+    # Process 'gc'
+    if args.command == 'gc':
+        try:
+            result = repo.gc(
+                args.rebase, not args.no_repack, args.grace_period
+            )
+            print(
+                'Removed {objects_removed} objects, rebased '
+                '{objects_rebased} objects, reclaimed {bytes_reclaimed} '
+                'bytes, repacking changed the size of kept objects by '
+                '{repack_growth:+} bytes'.format(**result)
+            )
+        except repository.RepositoryException as err:
+            print(err)
+
+    # Process 'migrate'
+    if args.command == 'migrate':
+        print('Converted {} objects'.format(repo.migrate()))
+
+    # Process 'monitor'
+    if args.command == 'monitor':
+        if args.action == 'start':
+            try:
+                pid = repo.start_monitor(args.foreground)
+                print('Monitor running with process id {}'.format(pid))
+            except monitor.MonitorException as err:
+                print(err)
+        if args.action == 'stop':
+            if repo.stop_monitor():
+                print('Monitor stopped')
+            else:
+                print('Monitor is not running')
+        if args.action == 'status':
+            pid = repo.monitor_pid()
+            if pid is None:
+                print('Monitor is not running')
+            else:
+                print('Monitor running with process id {}'.format(pid))
+
+    # Process 'sparse'
+    if args.command == 'sparse':
+        if not args.patterns and not args.disable:
+            patterns = repo.sparse_patterns()
+            if not patterns:
+                print('Sparse checkout is disabled')
+            for pattern in patterns:
+                print(pattern)
+            return repo
+        try:
+            repo.sparse_checkout(
+                [] if args.disable else args.patterns, args.force
+            )
+        except repository.DirtyDirectoryException as err:
+            print(dirty_directory_handler(err))
+            print(
+                'User -f (--force) option to override. '
+                'All changes since the last snapshot will be lost.'
+            )
+
+    # Process 'export'
+    if args.command == 'export':
+        try:
+            with open_output(args.output) as output:
+                if args.tar:
+                    repo.export_archive(output, args.snapshot)
+                else:
+                    repo.export_bundle(output, args.snapshot, args.base)
+        except repository.InvalidHashException as err:
+            print(invalid_hash_handler(err), file=sys.stderr)
+        except ValueError as err:
+            print(err, file=sys.stderr)
+
+    # Process 'import'
+    if args.command == 'import':
+        try:
+            with open_input(args.bundle) as stream:
+                result = repo.import_bundle(stream)
+            print(
+                'Imported {} snapshots, wrote {} objects, skipped {} '
+                'existing objects'.format(
+                    len(result['snapshots']), result['objects_written'],
+                    result['objects_skipped'],
+                )
+            )
+            for branch in result['branches']:
+                print('Updated branch {}'.format(branch))
+        except bundle.BundleException as err:
+            print(err)
+
+    return repo
+
+
+@contextlib.contextmanager
+def open_output(path):
+    """Context manager for a binary file or standard output if None"""
+    if path is None or path == '-':
+        yield sys.stdout.buffer
+        return
+    with open(path, 'wb') as output:
+        yield output
+
+
+@contextlib.contextmanager
+def open_input(path):
+    """Context manager for a binary file or standard input if None"""
+    if path is None or path == '-':
+        yield sys.stdin.buffer
+        return
+    with open(path, 'rb') as stream:
+        yield stream
+
 
 def invalid_hash_handler(err):
     """Generates a string message on an InvalidHashException"""
@@ -177,6 +491,19 @@ def invalid_hash_handler(err):
     return '\n'.join(str_lines)
 
 
+def change_handler(change):
+    """Generates a string message for a changed file"""
+    path = change.path
+    if change.old_path is not None:
+        path = '{} -> {}'.format(change.old_path, change.path)
+    line = '{status: <9} {path}'.format(status=change.status + ':', path=path)
+    if change.stats is not None:
+        line += ' ({old_size} -> {new_size} bytes, patch {patch_size})'.format(
+            **change.stats
+        )
+    return line
+
+
 def dirty_directory_handler(err):
     """Generates a string message on an DirtyDirectyoryException"""
     return err
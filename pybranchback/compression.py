@@ -0,0 +1,141 @@
+"""Pluggable compression codecs for full objects
+
+Each codec has a unique id that is stored in the object header, so objects
+are always decoded with the codec they were compressed with. Additional
+codecs can be added with register_codec.
+"""
+import bz2
+import lzma
+import zlib
+
+
+# Bytes of content compressed to estimate if the content is compressible
+SAMPLE_SIZE = 64 * 1024
+# Content is stored uncompressed unless the sample shrinks below this ratio
+MAX_RATIO = 0.9
+
+# File signatures of common formats that are already compressed
+COMPRESSED_SIGNATURES = (
+    b'\x1f\x8b',              # gzip
+    b'BZh',                   # bzip2
+    b'\xfd7zXZ\x00',          # xz
+    b'(\xb5/\xfd',            # zstandard
+    b'PK\x03\x04',            # zip, jar, docx, ...
+    b'7z\xbc\xaf\x27\x1c',    # 7-zip
+    b'Rar!\x1a\x07',          # rar
+    b'\x89PNG\r\n\x1a\n',     # png
+    b'\xff\xd8\xff',          # jpeg
+    b'GIF8',                  # gif
+    b'OggS',                  # ogg
+    b'fLaC',                  # flac
+    b'ID3',                   # mp3
+)
+
+
+class Codec:
+
+    """Interface of a compression codec
+
+    Subclasses set a unique id (1-255) and name, and implement compress and
+    decompress.
+    """
+
+    id = None
+    name = None
+    default_level = None
+
+    def compress(self, content, level):
+        """Returns the compressed content"""
+        raise NotImplementedError
+
+    def decompress(self, payload):
+        """Returns the original content of compressed content"""
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+
+    """Codec using zlib (deflate)"""
+
+    id = 1
+    name = 'zlib'
+    default_level = 6
+
+    def compress(self, content, level):
+        return zlib.compress(content, level)
+
+    def decompress(self, payload):
+        return zlib.decompress(payload)
+
+
+class Bz2Codec(Codec):
+
+    """Codec using bzip2"""
+
+    id = 2
+    name = 'bz2'
+    default_level = 9
+
+    def compress(self, content, level):
+        return bz2.compress(content, level)
+
+    def decompress(self, payload):
+        return bz2.decompress(payload)
+
+
+class LzmaCodec(Codec):
+
+    """Codec using lzma (xz), the level is used as preset"""
+
+    id = 3
+    name = 'lzma'
+    default_level = 6
+
+    def compress(self, content, level):
+        return lzma.compress(content, preset=level)
+
+    def decompress(self, payload):
+        return lzma.decompress(payload)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """Registers a codec so it can be found by id or name"""
+    if codec.id in CODECS:
+        raise ValueError('Codec id already registered: {}'.format(codec.id))
+    CODECS[codec.id] = codec
+
+
+def get_codec(codec_id):
+    """Returns the registered codec with the given id or name
+
+    Raises:
+      ValueError: If no codec is registered with the id or name
+    """
+    if codec_id in CODECS:
+        return CODECS[codec_id]
+    for codec in CODECS.values():
+        if codec.name == codec_id:
+            return codec
+    raise ValueError('Unknown compression codec: {}'.format(codec_id))
+
+
+def is_compressible(content):
+    """Estimates if compressing the content is worthwhile
+
+    Content starting with the signature of an already compressed format is
+    skipped, otherwise a sample of the content is compressed quickly.
+    """
+    if content.startswith(COMPRESSED_SIGNATURES):
+        return False
+
+    sample = content[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MAX_RATIO
+
+
+for _codec in (ZlibCodec(), Bz2Codec(), LzmaCodec()):
+    register_codec(_codec)
@@ -0,0 +1,203 @@
+"""On-disk map of paths to the hash of the object last stored for them"""
+import collections.abc
+import os
+import pickle
+import sqlite3
+import threading
+
+import pybranchback.snapshotdb as ssdb
+
+
+CREATE = """
+    CREATE TABLE IF NOT EXISTS objhashcache (
+        path TEXT PRIMARY KEY NOT NULL,
+        hash TEXT NOT NULL
+    ) WITHOUT ROWID
+"""
+SELECT = """SELECT hash FROM objhashcache WHERE path = ?"""
+SELECT_PATHS = """SELECT path FROM objhashcache ORDER BY path"""
+SELECT_HASHES = """SELECT DISTINCT hash FROM objhashcache"""
+COUNT = """SELECT COUNT(*) FROM objhashcache"""
+UPSERT = """INSERT OR REPLACE INTO objhashcache (path, hash) VALUES (?, ?)"""
+DELETE = """DELETE FROM objhashcache WHERE path = ?"""
+DELETE_ALL = """DELETE FROM objhashcache"""
+# Paths under a directory, '0' is the character following '/'
+DELETE_TREE = """
+    DELETE FROM objhashcache WHERE path = ? OR (path >= ? AND path < ?)
+"""
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+class ObjHashCache(collections.abc.MutableMapping):
+
+    """Map of paths to object hashes stored in a SQLite table
+
+    Lookups only query the paths that are used, and remember the result.
+    Changes are kept in memory until save, which then only writes the
+    entries that changed.
+    """
+
+    def __init__(self, db_path):
+        """Initialize instance variables"""
+        self.db_path = db_path
+
+        # Instance variables
+        self._loaded = {}
+        self._changes = {}
+        self._cleared = False
+        self._removed_trees = []
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Opens the store, converting a pickled map of an older repository"""
+        with self._lock:
+            if self._is_pickle():
+                self._convert_pickle()
+            ssdb.connect(self.db_path).execute(CREATE)
+            self._loaded = {}
+            self._changes = {}
+            self._cleared = False
+            self._removed_trees = []
+
+    def save(self):
+        """Writes all changed entries in a single transaction"""
+        with self._lock:
+            con = ssdb.connect(self.db_path)
+            with con:
+                con.execute(CREATE)
+                if self._cleared:
+                    con.execute(DELETE_ALL)
+                for path in self._removed_trees:
+                    con.execute(DELETE_TREE, self._tree_range(path))
+                con.executemany(UPSERT, [
+                    (path, obj_hash)
+                    for path, obj_hash in self._changes.items()
+                    if obj_hash is not None
+                ])
+                con.executemany(DELETE, [
+                    (path,)
+                    for path, obj_hash in self._changes.items()
+                    if obj_hash is None
+                ])
+
+            # Saved changes are now known values of the store
+            self._loaded.update(self._changes)
+            self._changes = {}
+            self._cleared = False
+            self._removed_trees = []
+
+    def __getitem__(self, path):
+        obj_hash = self._lookup(path)
+        if obj_hash is None:
+            raise KeyError(path)
+        return obj_hash
+
+    def __setitem__(self, path, obj_hash):
+        with self._lock:
+            self._changes[path] = obj_hash
+
+    def __delitem__(self, path):
+        if self._lookup(path) is None:
+            raise KeyError(path)
+        with self._lock:
+            self._changes[path] = None
+
+    def __contains__(self, path):
+        return self._lookup(path) is not None
+
+    def __iter__(self):
+        """Iterates all paths, reading every path from the store"""
+        with self._lock:
+            self.save()
+            rows = ssdb.connect(self.db_path).execute(SELECT_PATHS).fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        with self._lock:
+            self.save()
+            return ssdb.connect(self.db_path).execute(COUNT).fetchone()[0]
+
+    def hashes(self):
+        """Returns the set of all distinct hashes in the store"""
+        with self._lock:
+            self.save()
+            rows = ssdb.connect(self.db_path).execute(SELECT_HASHES).fetchall()
+        return {row[0] for row in rows}
+
+    def clear(self):
+        """Removes every entry without reading them"""
+        with self._lock:
+            self._loaded = {}
+            self._changes = {}
+            self._removed_trees = []
+            self._cleared = True
+
+    def remove_tree(self, path):
+        """Removes a path and all paths under it without reading them"""
+        with self._lock:
+            prefix = path + '/'
+            for cached in (self._loaded, self._changes):
+                for cached_path in list(cached):
+                    if cached_path == path or cached_path.startswith(prefix):
+                        del cached[cached_path]
+            self._removed_trees.append(path)
+
+    def _lookup(self, path):
+        """Returns the hash of a path or None, querying the store if needed"""
+        with self._lock:
+            if path in self._changes:
+                return self._changes[path]
+            if path in self._loaded:
+                return self._loaded[path]
+
+            # Entries of a cleared or removed tree are gone from the store
+            prefix_removed = any(
+                path == removed or path.startswith(removed + '/')
+                for removed in self._removed_trees
+            )
+            if self._cleared or prefix_removed:
+                return None
+
+            row = ssdb.connect(self.db_path).execute(
+                SELECT, (path,)
+            ).fetchone()
+            obj_hash = row[0] if row is not None else None
+            self._loaded[path] = obj_hash
+            return obj_hash
+
+    def _tree_range(self, path):
+        """Returns the parameters of DELETE_TREE for a path"""
+        return (path, path + '/', path + '0')
+
+    def _is_pickle(self):
+        """Check if the store file is a pickle from an older repository"""
+        try:
+            with open(self.db_path, 'rb') as store_file:
+                header = store_file.read(len(SQLITE_MAGIC))
+        except FileNotFoundError:
+            return False
+        return header != SQLITE_MAGIC and len(header) > 0
+
+    def _convert_pickle(self):
+        """Converts a pickled dictionary into the store in place
+
+        The new store is written to a temporary file and moved over the
+        pickle, so an interrupted conversion leaves the pickle untouched.
+        """
+        with open(self.db_path, 'rb') as hash_file:
+            entries = pickle.load(hash_file)
+
+        temp_path = self.db_path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        con = sqlite3.connect(temp_path)
+        try:
+            with con:
+                con.execute(CREATE)
+                con.executemany(UPSERT, sorted(entries.items()))
+        finally:
+            con.close()
+
+        ssdb.close(self.db_path)
+        os.replace(temp_path, self.db_path)
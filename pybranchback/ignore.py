@@ -0,0 +1,298 @@
+"""Ignore files excluding paths of the working directory from snapshots
+
+Patterns use the gitignore syntax:
+  - Blank lines and lines starting with '#' are skipped
+  - A leading '!' includes paths excluded by an earlier pattern again
+  - A trailing '/' only matches directories
+  - Patterns containing a '/' are relative to the directory of the ignore
+    file, others match a name in that directory or any directory below
+  - '*' and '?' match anything but '/', '[...]' matches a set of
+    characters, '**/' matches any directories and '/**' everything inside
+  - A backslash escapes the following character
+
+Patterns of the ignore file in a directory take precedence over those of
+the directories above it, which take precedence over the global ignore
+files, and later patterns over earlier ones. Paths inside an excluded
+directory cannot be included again, as the directory is never walked.
+"""
+import hashlib
+import os
+import posixpath
+import re
+
+import pybranchback.utils as utils
+
+
+# Name of the ignore file of a directory
+IGNORE_FILE = '.pbbignore'
+
+
+class IgnoreRules:
+
+    """Compiled patterns of one ignore file
+
+    All patterns are combined into a single regular expression, with the
+    later patterns first so the first alternative that matches decides.
+    """
+
+    def __init__(self, lines):
+        """Compiles the patterns of the lines of an ignore file"""
+        patterns = [
+            pattern for pattern in map(parse_pattern, lines)
+            if pattern is not None
+        ]
+        patterns.reverse()
+
+        self._negated = [negated for _, negated, _ in patterns]
+        self._file_regex = _combine([
+            (regex if not dir_only else None)
+            for regex, _, dir_only in patterns
+        ])
+        self._dir_regex = _combine([regex for regex, _, _ in patterns])
+
+    def __bool__(self):
+        return self._dir_regex is not None
+
+    def match(self, path, is_dir):
+        """Returns True if a relative path is excluded, False if included
+
+        Returns None if no pattern matches the path.
+        """
+        regex = self._dir_regex if is_dir else self._file_regex
+        if regex is None:
+            return None
+        match = regex.fullmatch(path)
+        if match is None:
+            return None
+        return not self._negated[match.lastindex - 1]
+
+
+class IgnoreMatcher:
+
+    """Decides which paths of a working directory are ignored
+
+    The ignore file of each directory is read once, when a path in the
+    directory is first matched. Call reset to read changed files again.
+    """
+
+    def __init__(self, root_dir, global_paths=()):
+        """Initialize instance variables"""
+        self.root_dir = root_dir
+        self.global_paths = global_paths
+
+        # Instance variables
+        self._stacks = {}
+        self._global_stack = None
+
+    def reset(self):
+        """Forgets the patterns read so far"""
+        self._stacks = {}
+        self._global_stack = None
+
+    def is_ignored(self, path, is_dir=False):
+        """Check if a path relative to the root directory is ignored"""
+        path = posixpath.normpath(path)
+        if path == '.':
+            return False
+        return self._match(
+            self._stack(posixpath.dirname(path) or '.'), path, is_dir
+        )
+
+    def prune(self, directory, listing):
+        """Returns a utils.Listing of a directory without ignored entries
+
+        The type of each entry is known from the listing, so nothing is
+        read from the ignored entries.
+        """
+        stack = self._stack(directory)
+        if not stack:
+            return listing
+        return utils.Listing(
+            [
+                entry for entry in listing.directories
+                if not self._match(
+                    stack, utils.posixjoin(directory, entry.name), True
+                )
+            ],
+            [
+                entry for entry in listing.files
+                if not self._match(
+                    stack, utils.posixjoin(directory, entry.name), False
+                )
+            ],
+        )
+
+    def global_key(self):
+        """Returns a digest of the global ignore files, to detect changes"""
+        hasher = hashlib.sha1()
+        for path in self.global_paths:
+            hasher.update(path.encode('utf-8', 'surrogateescape') + b'\0')
+            hasher.update(_read_bytes(path) or b'')
+        return hasher.hexdigest()
+
+    def _match(self, stack, path, is_dir):
+        """Returns if the rules of a stack exclude a path"""
+        for base, rules in stack:
+            relative = path if base == '.' else path[len(base) + 1:]
+            result = rules.match(relative, is_dir)
+            if result is not None:
+                return result
+        return False
+
+    def _stack(self, directory):
+        """Returns the (base directory, rules) applying in a directory
+
+        The rules of the directory itself come first, the global rules last.
+        """
+        stack = self._stacks.get(directory)
+        if stack is not None:
+            return stack
+
+        if directory == '.':
+            parent = self._global_rules()
+        else:
+            parent = self._stack(posixpath.dirname(directory) or '.')
+        rules = IgnoreRules(_read_lines(
+            os.path.join(self.root_dir, directory, IGNORE_FILE)
+        ))
+        stack = ((directory, rules),) + parent if rules else parent
+        self._stacks[directory] = stack
+        return stack
+
+    def _global_rules(self):
+        """Returns the stack of rules of the global ignore files"""
+        if self._global_stack is None:
+            stack = ()
+            for path in self.global_paths:
+                rules = IgnoreRules(_read_lines(path))
+                if rules:
+                    stack = ((os.curdir, rules),) + stack
+            self._global_stack = stack
+        return self._global_stack
+
+
+def parse_pattern(line):
+    """Returns the (regex, negated, dir_only) of a line of an ignore file
+
+    Returns None for blank lines and comments.
+    """
+    line = line.rstrip('\r\n')
+    if not line or line.startswith('#'):
+        return None
+
+    # Trailing spaces are ignored unless escaped
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+
+    # Patterns with a slash are relative to the directory of the file
+    anchored = '/' in line
+    line = line.lstrip('/')
+    regex = translate(line)
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return regex, negated, dir_only
+
+
+def translate(pattern):
+    """Returns the regular expression of a pattern relative to a directory"""
+    parts = []
+    index = 0
+    length = len(pattern)
+    while index < length:
+        char = pattern[index]
+        if pattern.startswith('**', index):
+            at_start = index == 0 or pattern[index - 1] == '/'
+            end = index + 2
+            if at_start and pattern.startswith('/', end):
+                # Any directories, including none
+                parts.append('(?:.*/)?')
+                index = end + 1
+                continue
+            if at_start and end == length:
+                # Everything inside a directory
+                parts.append('.*')
+                index = end
+                continue
+            parts.append('[^/]*')
+            index = end
+        elif char == '*':
+            parts.append('[^/]*')
+            index += 1
+        elif char == '?':
+            parts.append('[^/]')
+            index += 1
+        elif char == '[':
+            regex, index = _translate_class(pattern, index)
+            parts.append(regex)
+        elif char == '\\' and index + 1 < length:
+            parts.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            parts.append(re.escape(char))
+            index += 1
+    return ''.join(parts)
+
+
+def _translate_class(pattern, index):
+    """Returns the regex of the character class at an index and its end
+
+    A '[' without a closing ']' matches itself.
+    """
+    end = index + 1
+    if end < len(pattern) and pattern[end] in '!^':
+        end += 1
+    if end < len(pattern) and pattern[end] == ']':
+        end += 1
+    end = pattern.find(']', end)
+    if end < 0:
+        return re.escape('['), index + 1
+
+    content = pattern[index + 1:end]
+    negated = content[:1] in ('!', '^')
+    if negated:
+        content = content[1:]
+    content = content.replace('\\', '\\\\').replace('[', '\\[')
+    if negated:
+        # Negated sets never match a separator
+        return '[^/{}]'.format(content), end + 1
+    return '[{}]'.format(content), end + 1
+
+
+def _combine(regexes):
+    """Returns a single compiled regex with a group for each pattern
+
+    Patterns that are None never match but keep their group number.
+    """
+    if not any(regex is not None for regex in regexes):
+        return None
+    return re.compile('|'.join(
+        '({})'.format(regex if regex is not None else '(?!)')
+        for regex in regexes
+    ))
+
+
+def _read_bytes(path):
+    """Returns the content of a file or None if it does not exist"""
+    try:
+        with open(path, 'rb') as ignore_file:
+            return ignore_file.read()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return None
+
+
+def _read_lines(path):
+    """Returns the lines of an ignore file or no lines if it does not exist"""
+    content = _read_bytes(path)
+    if content is None:
+        return []
+    return content.decode('utf-8', 'surrogateescape').splitlines()
@@ -0,0 +1,319 @@
+"""Persistent index of stat data and content hashes for working files"""
+import os
+import pickle
+import posixpath
+
+
+class WorkingTreeIndex:
+
+    """Caches the content hash of each working file keyed by its stat data
+
+    Every entry records the size, mtime_ns, inode and digest of a path. A
+    cached digest is only trusted while the stat data of the file is still
+    identical and the entry is not racy, so unchanged files never have to be
+    read and rehashed to prove the directory is clean.
+
+    Racy entries:
+      A file modified again within the same timestamp tick as it was hashed
+      keeps its mtime. Following git, any entry with an mtime no older than
+      the last write of the index file itself is not trusted and is rehashed
+      (and refreshed) on the next lookup.
+
+    Tree hashes:
+      The hash of every walked directory is kept along with the state of
+      the file system monitor journal at the time of the walk. While the
+      monitor reports no changes under a directory its tree hash is reused
+      without walking it again.
+
+    Sparse trees:
+      For each directory a sparse checkout only partially materialized, the
+      entries of its tree in the snapshot are kept as (type, hash, name,
+      materialized). Entries that are not materialized stay part of the
+      directory as references to their stored objects. A lost index loses
+      them too, and the repository restores them from the snapshot.
+
+    Saving:
+      The index is written whole, then saves of a few changes only append
+      the changed entries to the file. Once the appended changes outgrow
+      MAX_APPENDED_RATIO of the whole index, it is written whole again.
+    """
+
+    # Changes are appended until they outgrow this fraction of the index
+    MAX_APPENDED_RATIO = 0.5
+
+    def __init__(self, index_path):
+        """Initialize instance variables"""
+        self.index_path = index_path
+
+        # Instance variables
+        self.entries = {}
+        self.trees = {}
+        self.monitor_state = None
+        self.sparse = {}
+        self.timestamp = None
+        self.changed = False
+        self._seen = set()
+        self._kept = set()
+        self._changed_entries = set()
+        self._changed_trees = set()
+        self._changed_sparse = set()
+        self._saved_size = 0
+        self._appended_size = 0
+
+    def load(self):
+        """Loads a saved index and the changes appended to it, if any"""
+        appended = []
+        torn = False
+        try:
+            with open(self.index_path, 'rb') as index_file:
+                saved = pickle.load(index_file)
+                file_stat = os.fstat(index_file.fileno())
+                self._saved_size = index_file.tell()
+
+                # A change torn by a crash ends the appended changes, and
+                # the index is written whole on the next save
+                while index_file.tell() < file_stat.st_size:
+                    try:
+                        appended.append(pickle.load(index_file))
+                    except (EOFError, pickle.UnpicklingError, ValueError):
+                        self._saved_size = 0
+                        torn = True
+                        break
+                self._appended_size = index_file.tell() - self._saved_size
+                self.timestamp = file_stat.st_mtime_ns
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # A missing or unreadable index only means everything is
+            # rehashed, the repository restores the sparse trees itself
+            saved = ({}, {}, None, {})
+            self.timestamp = None
+            self._saved_size = 0
+            self._appended_size = 0
+
+        # Older indexes only saved the dictionary of file entries, and no
+        # sparse trees
+        if isinstance(saved, dict):
+            saved = (saved, {}, None)
+        if len(saved) == 3:
+            saved += ({},)
+        self.entries, self.trees, self.monitor_state, self.sparse = saved
+        for entries, trees, monitor_state, sparse_trees in appended:
+            _apply_changes(self.entries, entries)
+            _apply_changes(self.trees, trees)
+            _apply_changes(self.sparse, sparse_trees)
+            self.monitor_state = monitor_state
+
+        # Sparse trees that may miss a torn change are restored whole by the
+        # repository from the current snapshot
+        if torn:
+            self.sparse = {}
+        self.changed = False
+        self._seen = set()
+        self._kept = set()
+        self._changed_entries = set()
+        self._changed_trees = set()
+        self._changed_sparse = set()
+
+    def save(self):
+        """Saves the index if any entries have changed since loading"""
+        if not self.changed:
+            return
+
+        # Append only the changed entries while they are few, None for the
+        # paths that were removed
+        changes = pickle.dumps((
+            {path: self.entries.get(path) for path in self._changed_entries},
+            {path: self.trees.get(path) for path in self._changed_trees},
+            self.monitor_state,
+            {path: self.sparse.get(path) for path in self._changed_sparse},
+        ))
+        appended_size = self._appended_size + len(changes)
+        if self._saved_size and \
+                appended_size <= self._saved_size * self.MAX_APPENDED_RATIO:
+            with open(self.index_path, 'ab') as index_file:
+                index_file.write(changes)
+            self._appended_size = appended_size
+        else:
+            self._write_whole()
+
+        # The index mtime is the reference point for racy entries
+        self.timestamp = os.stat(self.index_path).st_mtime_ns
+        self.changed = False
+        self._changed_entries = set()
+        self._changed_trees = set()
+        self._changed_sparse = set()
+
+    def lookup(self, path, stat_result):
+        """Returns the cached digest for a path or None if must be rehashed"""
+        self._seen.add(path)
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+
+        size, mtime_ns, inode, digest = entry
+        if (size, mtime_ns, inode) != self._stat_key(stat_result):
+            return None
+
+        if self.is_racy(mtime_ns):
+            return None
+
+        return digest
+
+    def update(self, path, stat_result, digest):
+        """Records the digest of a path along with its current stat data"""
+        self._seen.add(path)
+        entry = self._stat_key(stat_result) + (digest,)
+
+        # Racy entries are saved again so the index timestamp moves past them
+        if self.entries.get(path) != entry or self.is_racy(entry[1]):
+            self.entries[path] = entry
+            self._changed_entries.add(path)
+            self.changed = True
+
+    def update_tree(self, path, tree_hash):
+        """Records the tree hash of a walked directory"""
+        self._seen.add(path)
+        if self.trees.get(path) != tree_hash:
+            self.trees[path] = tree_hash
+            self._changed_trees.add(path)
+            self.changed = True
+
+    def keep_tree(self, path):
+        """Marks a directory and everything under it as seen without a walk"""
+        self._kept.add(path)
+
+    def set_sparse_tree(self, path, entries):
+        """Records the snapshot entries of a partially materialized directory
+
+        The entries that are not materialized are part of the tree hash of
+        the directory without anything on disk changing. When they change,
+        the tree hashes of the directory, its parents and any directories
+        created in place of those entries are forgotten.
+        """
+        entries = list(entries)
+        old_entries = self.sparse.get(path)
+        if old_entries == entries:
+            return
+        self.sparse[path] = entries
+        self._changed_sparse.add(path)
+        self.changed = True
+
+        self._forget_trees([
+            posixpath.normpath(posixpath.join(path, name))
+            for _, _, name, materialized in
+            set(entries).symmetric_difference(old_entries or ())
+            if not materialized
+        ])
+        while True:
+            if self.trees.pop(path, None) is not None:
+                self._changed_trees.add(path)
+                self.changed = True
+            if path in ('', '.'):
+                break
+            path = posixpath.dirname(path) or '.'
+
+    def clear_sparse(self):
+        """Forgets the sparse trees of every directory"""
+        if self.sparse:
+            self._changed_sparse.update(self.sparse)
+            self.sparse = {}
+            self.changed = True
+
+    def set_monitor_state(self, monitor_state):
+        """Records the monitor journal state the tree hashes are valid for"""
+        if self.monitor_state != monitor_state:
+            self.monitor_state = monitor_state
+            self.changed = True
+
+    def remove_tree(self, path):
+        """Removes the entries of a path and all paths under it"""
+        prefix = path + '/'
+        for entries, changed in self._tracked():
+            for entry_path in list(entries):
+                if entry_path == path or entry_path.startswith(prefix):
+                    del entries[entry_path]
+                    changed.add(entry_path)
+                    self.changed = True
+
+    def _forget_trees(self, paths):
+        """Removes the tree hashes of directories and all directories below"""
+        if not paths:
+            return
+        prefixes = tuple(path + '/' for path in paths)
+        paths = set(paths)
+        for tree_path in list(self.trees):
+            if tree_path in paths or tree_path.startswith(prefixes):
+                del self.trees[tree_path]
+                self._changed_trees.add(tree_path)
+                self.changed = True
+
+    def is_racy(self, mtime_ns):
+        """Check if an entry could have changed without changing its mtime"""
+        return self.timestamp is None or mtime_ns >= self.timestamp
+
+    def prune(self):
+        """Removes entries for all paths not seen since the last prune
+
+        Should only be called after a walk of the entire working directory.
+        Everything under a directory marked with keep_tree counts as seen.
+        """
+        for entries, changed in self._tracked()[:2]:
+            stale = [
+                path for path in entries.keys() - self._seen
+                if not self._is_kept(path)
+            ]
+            for path in stale:
+                del entries[path]
+            if stale:
+                changed.update(stale)
+                self.changed = True
+        self._seen = set()
+        self._kept = set()
+
+    def _is_kept(self, path):
+        """Check if a path is under a directory that was kept without a walk"""
+        if not self._kept:
+            return False
+        while path not in ('', '.'):
+            if path in self._kept:
+                return True
+            path = posixpath.dirname(path)
+        return '.' in self._kept
+
+    def _tracked(self):
+        """Returns the (entries, changed paths) of the saved dictionaries"""
+        return (
+            (self.entries, self._changed_entries),
+            (self.trees, self._changed_trees),
+            (self.sparse, self._changed_sparse),
+        )
+
+    def _write_whole(self):
+        """Writes the whole index, replacing any appended changes
+
+        Written to a temporary file first so a crash never truncates the
+        index.
+        """
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as index_file:
+            pickle.dump(
+                (self.entries, self.trees, self.monitor_state, self.sparse),
+                index_file,
+            )
+            self._saved_size = index_file.tell()
+        os.replace(temp_path, self.index_path)
+        self._appended_size = 0
+
+    def _stat_key(self, stat_result):
+        """Returns the tuple of stat data used to detect a changed file"""
+        return (
+            stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino
+        )
+
+
+def _apply_changes(saved, changes):
+    """Applies appended changes to a dictionary, None removes a path"""
+    for path, value in changes.items():
+        if value is None:
+            saved.pop(path, None)
+        else:
+            saved[path] = value
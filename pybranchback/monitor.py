@@ -0,0 +1,472 @@
+"""File system monitor recording the paths changed in a working directory
+
+The monitor is a separate process using Linux inotify. It appends every
+changed path to a journal in the repository directory, so snapshots and
+dirty checks only need to walk directories with changes.
+
+Journal format:
+  The journal is a sequence of records, each terminated by a NUL byte. The
+  first record is the header 'H<pid> <id>' written once all directories are
+  watched, where the id is unique to this journal. The records after it are
+    F<path>    the file or directory at path changed
+    R<path>    everything under the directory at path may have changed
+    S<name>    sync cookie, every change before it has been recorded
+    !<reason>  the journal is no longer complete (overflow, stopped, ...)
+  Paths are posix paths relative to the working directory.
+
+A reader creates a cookie file and waits for its sync record, so changes
+made just before are never missed because the monitor has not seen them
+yet. Whenever the journal cannot be trusted (no monitor running, another
+journal, a '!' record or no sync in time) the reader falls back to a full
+scan of the directory.
+"""
+import ctypes
+import ctypes.util
+import os
+import posixpath
+import signal
+import struct
+import subprocess
+import sys
+import time
+import uuid
+
+
+# inotify event masks
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+    IN_ONLYDIR | IN_DONT_FOLLOW
+)
+EVENT = struct.Struct('iIII')
+
+COOKIE_PREFIX = 'cookie-'
+STOPPED = b'!stopped'
+# Journals larger than this are replaced by a new journal
+MAX_JOURNAL_SIZE = 16 * 1024 * 1024
+# Seconds to wait for a started monitor to become ready
+START_TIMEOUT = 10.0
+
+
+class MonitorException(Exception):
+
+    """The file system monitor is not available or failed"""
+
+    pass
+
+
+class ChangeSet:
+
+    """Paths reported changed by the monitor between two journal positions"""
+
+    def __init__(self):
+        """Initialize instance variables"""
+        self.dirty = set()
+        self.recursive = set()
+
+    def add(self, path, recursive=False):
+        """Adds a changed path, marking every directory above it dirty"""
+        if recursive:
+            self.recursive.add(path)
+        while path not in self.dirty:
+            self.dirty.add(path)
+            if path == '.':
+                break
+            path = posixpath.dirname(path) or '.'
+
+    def is_dirty(self, directory):
+        """Check if anything under a directory may have changed"""
+        if directory in self.dirty:
+            return True
+        while directory != '.':
+            directory = posixpath.dirname(directory) or '.'
+            if directory in self.recursive:
+                return True
+        return False
+
+
+def read_changes(journal_path, since=None, timeout=1.0):
+    """Returns the current (journal id, position) and changes since then
+
+    Changes are returned as a ChangeSet of everything recorded after the
+    given state of a previous call, or None if the directory must be
+    scanned completely. The state is None if no monitor is running or the
+    journal cannot be trusted.
+    """
+    try:
+        journal_file = open(journal_path, 'rb')
+    except FileNotFoundError:
+        return None, None
+
+    with journal_file:
+        header, start = _read_header(journal_file)
+        if header is None or not _is_running(header[0]):
+            return None, None
+        journal_id = header[1]
+
+        # Continue from the previous position in the same journal
+        full_scan = since is None or since[0] != journal_id
+        if not full_scan:
+            start = since[1]
+
+        # Wait for the monitor to record every change made until now
+        records, end = _sync(journal_file, journal_path, start, timeout)
+        if records is None:
+            return None, None
+
+    if full_scan:
+        return (journal_id, end), None
+
+    changes = ChangeSet()
+    for record in records:
+        kind, path = record[:1], record[1:]
+        changes.add(path, recursive=(kind == 'R'))
+    return (journal_id, end), changes
+
+
+def monitor_pid(journal_path):
+    """Returns the process id of the running monitor or None"""
+    try:
+        with open(journal_path, 'rb') as journal_file:
+            header, _ = _read_header(journal_file)
+            stopped = _is_stopped(journal_file)
+    except FileNotFoundError:
+        return None
+    if header is None or stopped or not _is_running(header[0]):
+        return None
+    return header[0]
+
+
+def start(root_dir, journal_path, foreground=False):
+    """Starts monitoring a working directory and returns the process id
+
+    Unless in the foreground, the monitor is started as a detached process
+    and this returns once it has watched every directory.
+
+    Raises:
+      MonitorException: If inotify is not available or the monitor failed
+    """
+    pid = monitor_pid(journal_path)
+    if pid is not None:
+        return pid
+
+    if foreground:
+        Monitor(root_dir, journal_path).run()
+        return os.getpid()
+
+    # Make this package importable by the monitor process
+    Inotify.check_available()
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [package_dir, env.get('PYTHONPATH')])
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'pybranchback.monitor', root_dir, journal_path],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, env=env, start_new_session=True,
+    )
+
+    # Wait for the monitor to write the header of its journal
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if monitor_pid(journal_path) == process.pid:
+            return process.pid
+        if process.poll() is not None:
+            break
+        time.sleep(0.01)
+    raise MonitorException('Monitor failed to start')
+
+
+def stop(journal_path):
+    """Stops the running monitor, returns False if none was running"""
+    pid = monitor_pid(journal_path)
+    if pid is None:
+        return False
+    os.kill(pid, signal.SIGTERM)
+    return True
+
+
+def _read_header(journal_file):
+    """Returns ((pid, journal id), position after the header) or None"""
+    data = journal_file.read(128)
+    end = data.find(b'\0')
+    if not data.startswith(b'H') or end < 0:
+        return None, 0
+    pid, journal_id = data[1:end].decode().split(' ')
+    return (int(pid), journal_id), end + 1
+
+
+def _is_stopped(journal_file):
+    """Check if the last record of a journal is the stop of its monitor"""
+    journal_file.seek(0, os.SEEK_END)
+    journal_file.seek(max(0, journal_file.tell() - len(STOPPED) - 1))
+    return journal_file.read().endswith(STOPPED + b'\0')
+
+
+def _is_running(pid):
+    """Check if a process with the given id exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _sync(journal_file, journal_path, start, timeout):
+    """Creates a cookie and reads records until the monitor has seen it
+
+    Returns the records before the cookie and the position after it, or
+    (None, None) if the journal is no longer complete or no sync happened
+    within the timeout.
+    """
+    # Create and remove a uniquely named file next to the journal
+    cookie = COOKIE_PREFIX + uuid.uuid4().hex
+    cookie_path = os.path.join(os.path.dirname(journal_path), cookie)
+    os.close(os.open(cookie_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    os.remove(cookie_path)
+
+    records = []
+    position = start
+    buffered = b''
+    journal_file.seek(start)
+    deadline = time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        # Only complete records are parsed, a partial one is kept
+        buffered += journal_file.read()
+        *complete, buffered = buffered.split(b'\0')
+        for raw_record in complete:
+            position += len(raw_record) + 1
+            record = os.fsdecode(raw_record)
+            if record.startswith('!'):
+                return None, None
+            if record == 'S' + cookie:
+                return records, position
+            if not record.startswith('S'):
+                records.append(record)
+
+        if time.monotonic() >= deadline:
+            return None, None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.01)
+
+
+class Inotify:
+
+    """Minimal wrapper of the Linux inotify API"""
+
+    _libc = None
+
+    def __init__(self):
+        """Initialize instance variables"""
+        self.check_available()
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    @classmethod
+    def check_available(cls):
+        """Raises MonitorException if inotify is not available"""
+        if cls._libc is not None:
+            return
+        if not sys.platform.startswith('linux'):
+            raise MonitorException('inotify is only available on Linux')
+        try:
+            libc = ctypes.CDLL(
+                ctypes.util.find_library('c') or 'libc.so.6', use_errno=True
+            )
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            raise MonitorException('inotify is not available')
+        cls._libc = libc
+
+    def add_watch(self, path, mask):
+        """Watches a directory and returns the watch descriptor or None"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            # The directory may already have been removed again
+            return None
+        return wd
+
+    def read_events(self):
+        """Blocks until events are available and yields (wd, mask, name)"""
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        """Closes the inotify instance"""
+        os.close(self.fd)
+
+
+class Monitor:
+
+    """Watches a working directory and writes changed paths to a journal"""
+
+    def __init__(self, root_dir, journal_path):
+        """Initialize instance variables"""
+        self.root_dir = os.path.abspath(root_dir)
+        self.journal_path = os.path.abspath(journal_path)
+        self.repo_dir = os.path.dirname(self.journal_path)
+
+        # Instance variables
+        self.inotify = Inotify()
+        self.watches = {}
+        self.repo_wd = None
+        self.journal_file = None
+
+    def run(self):
+        """Watches the directory until terminated"""
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGINT, self._terminate)
+        try:
+            # Cookies are created in the repository directory
+            self.repo_wd = self.inotify.add_watch(
+                self.repo_dir, IN_CREATE | IN_ONLYDIR
+            )
+            self._watch_tree('.')
+            self._new_journal()
+
+            while True:
+                self._process(self.inotify.read_events())
+        except SystemExit:
+            pass
+        finally:
+            if self.journal_file is not None:
+                self._write([STOPPED])
+                self.journal_file.close()
+            self.inotify.close()
+
+    def _process(self, events):
+        """Writes the records of a batch of events to the journal"""
+        records = []
+        seen = set()
+
+        def add(record):
+            if record not in seen:
+                seen.add(record)
+                records.append(os.fsencode(record))
+
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, start over with a new journal
+                self._write(records + [b'!overflow'])
+                self._watch_tree('.')
+                self._new_journal()
+                return
+
+            if wd == self.repo_wd:
+                if name.startswith(COOKIE_PREFIX):
+                    add('S' + name)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                add('R' + directory)
+                continue
+
+            path = posixpath.join(directory, name) if name else directory
+            path = posixpath.normpath(path)
+            if path == self._repo_rel_dir():
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may be created before the new directory is watched
+                self._watch_tree(path)
+                add('R' + path)
+            elif mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                add('R' + path)
+            else:
+                add('F' + path)
+
+        self._write(records)
+        if self.journal_file.tell() > MAX_JOURNAL_SIZE:
+            self._write([b'!rotated'])
+            self._new_journal()
+
+    def _watch_tree(self, directory):
+        """Watches a directory and every directory under it"""
+        for current_dir, directories, _ in os.walk(
+                os.path.join(self.root_dir, directory)):
+            rel_dir = posixpath.normpath(
+                os.path.relpath(current_dir, self.root_dir).replace(
+                    os.sep, '/'
+                )
+            )
+            if rel_dir == '.':
+                directories[:] = [
+                    d for d in directories
+                    if os.path.join(self.root_dir, d) != self.repo_dir
+                ]
+            wd = self.inotify.add_watch(current_dir, WATCH_MASK)
+            if wd is not None:
+                self.watches[wd] = rel_dir
+
+    def _new_journal(self):
+        """Replaces the journal with a new empty journal with a new id"""
+        temp_path = self.journal_path + '.tmp'
+        journal_file = open(temp_path, 'wb')
+        journal_file.write('H{} {}\0'.format(
+            os.getpid(), uuid.uuid4().hex
+        ).encode())
+        journal_file.flush()
+        os.replace(temp_path, self.journal_path)
+
+        if self.journal_file is not None:
+            self.journal_file.close()
+        self.journal_file = journal_file
+
+    def _write(self, records):
+        """Appends records to the journal"""
+        if records:
+            self.journal_file.write(b''.join(
+                record + b'\0' for record in records
+            ))
+            self.journal_file.flush()
+
+    def _repo_rel_dir(self):
+        """Returns the repository directory relative to the root"""
+        return os.path.relpath(self.repo_dir, self.root_dir).replace(
+            os.sep, '/'
+        )
+
+    def _terminate(self, signum, frame):
+        """Signal handler stopping the monitor"""
+        raise SystemExit(0)
+
+
+def main():
+    """Runs a monitor in the foreground: monitor.py <root> <journal>"""
+    Monitor(sys.argv[1], sys.argv[2]).run()
+
+
+if __name__ == '__main__':
+    main()
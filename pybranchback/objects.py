@@ -0,0 +1,90 @@
+"""Binary format of the objects stored in a repository
+
+Every stored object starts with a fixed size header:
+  magic:  'PBBO'
+  type:   FULL, DELTA, COMPRESSED or CHUNKED (u8)
+  codec:  identifier of the codec for COMPRESSED objects, otherwise 0 (u8)
+  depth:  number of patches needed to rebuild the object (u16)
+  base:   raw digest of the base object of a DELTA, otherwise zeros
+  length: length of the uncompressed object content (u64)
+
+The payload that follows is the object content for FULL objects, the patch
+(starting with the id of its delta engine) for DELTA objects, the encoded
+content for COMPRESSED objects and a list of (raw digest, u64 length)
+entries of the chunk objects that make up the content for CHUNKED objects.
+"""
+import collections
+import struct
+
+
+MAGIC = b'PBBO'
+HEADER = struct.Struct('>4sBBH20sQ')
+CHUNK_ENTRY = struct.Struct('>20sQ')
+NO_BASE = bytes(20)
+
+# Object types
+FULL = 0
+DELTA = 1
+COMPRESSED = 2
+CHUNKED = 3
+TYPES = (FULL, DELTA, COMPRESSED, CHUNKED)
+
+ObjectHeader = collections.namedtuple(
+    'ObjectHeader', ['type', 'codec', 'depth', 'base', 'length']
+)
+
+
+class ObjectFormatException(Exception):
+
+    """Stored object content does not have a valid object header"""
+
+    pass
+
+
+def encode(obj_type, payload, length, base=None, depth=0, codec=0):
+    """Returns the stored form of an object with the header prepended"""
+    base_digest = NO_BASE if base is None else bytes.fromhex(base)
+    header = HEADER.pack(MAGIC, obj_type, codec, depth, base_digest, length)
+    return header + payload
+
+
+def decode(content):
+    """Returns the (header, payload) of stored object content
+
+    Raises:
+      ObjectFormatException: If the content does not have a valid header
+    """
+    if not is_encoded(content):
+        raise ObjectFormatException('Object has no valid header')
+
+    _, obj_type, codec, depth, base_digest, length = HEADER.unpack_from(
+        content
+    )
+    base = None if obj_type != DELTA else base_digest.hex()
+    header = ObjectHeader(obj_type, codec, depth, base, length)
+    return header, content[HEADER.size:]
+
+
+def is_encoded(content):
+    """Check if stored content starts with a valid object header"""
+    return (
+        len(content) >= HEADER.size and
+        content[:len(MAGIC)] == MAGIC and
+        content[len(MAGIC)] in TYPES
+    )
+
+
+def encode_chunk_list(chunks):
+    """Returns the payload of a CHUNKED object from (hash, length) pairs"""
+    return b''.join(
+        CHUNK_ENTRY.pack(bytes.fromhex(chunk_hash), length)
+        for chunk_hash, length in chunks
+    )
+
+
+def decode_chunk_list(payload):
+    """Returns the (hash, length) pairs from the payload of a CHUNKED object"""
+    return [
+        (digest.hex(), length)
+        for digest, length in CHUNK_ENTRY.iter_unpack(payload)
+    ]
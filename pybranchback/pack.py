@@ -0,0 +1,225 @@
+"""Packfiles that consolidate many stored objects into a single file
+
+Pack file layout:
+  header:  magic 'PBBP', version (u32), object count (u32)
+  records: the stored content of each object, back to back
+
+Index file layout:
+  header:  magic 'PBBI', version (u32), object count (u32)
+  fanout:  256 x u32, number of objects whose first digest byte is <= i
+  entries: count x (20 byte digest, u64 offset, u64 length), sorted
+
+The index has fixed-width entries so it can be memory-mapped and binary
+searched without loading it.
+"""
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+
+
+PACK_MAGIC = b'PBBP'
+INDEX_MAGIC = b'PBBI'
+VERSION = 1
+
+HEADER = struct.Struct('>4sII')
+FANOUT = struct.Struct('>256I')
+ENTRY = struct.Struct('>20sQQ')
+DIGEST_SIZE = 20
+
+
+class PackException(Exception):
+
+    """A pack or pack index is corrupt or has an unsupported format"""
+
+    pass
+
+
+class PackIndex:
+
+    """Memory-mapped sorted index of the objects stored in a pack"""
+
+    def __init__(self, index_path):
+        """Initialize instance variables"""
+        self.index_path = index_path
+
+        with open(index_path, 'rb') as index_file:
+            self._map = mmap.mmap(
+                index_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+
+        magic, version, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC or version != VERSION:
+            self.close()
+            raise PackException('Invalid pack index: {}'.format(index_path))
+        self._fanout = FANOUT.unpack_from(self._map, HEADER.size)
+        self._entries_offset = HEADER.size + FANOUT.size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yields the hex digest of every object in the index"""
+        for position in range(self.count):
+            yield self._digest_at(position).hex()
+
+    def find(self, obj_hash):
+        """Returns the (offset, length) of an object or None if not found"""
+        digest = bytes.fromhex(obj_hash)
+
+        # Narrow the search to the objects sharing the first digest byte
+        first = digest[0]
+        low = self._fanout[first - 1] if first else 0
+        high = self._fanout[first]
+
+        position = bisect.bisect_left(
+            _DigestView(self), digest, low, high
+        )
+        if position < high and self._digest_at(position) == digest:
+            _, offset, length = ENTRY.unpack_from(
+                self._map, self._entries_offset + position * ENTRY.size
+            )
+            return offset, length
+        return None
+
+    def close(self):
+        """Releases the memory map of the index"""
+        self._map.close()
+
+    def _digest_at(self, position):
+        """Returns the raw digest of the entry at the given position"""
+        start = self._entries_offset + position * ENTRY.size
+        return self._map[start:start + DIGEST_SIZE]
+
+
+class _DigestView:
+
+    """Sequence view of the sorted digests of an index for bisect"""
+
+    def __init__(self, pack_index):
+        self.pack_index = pack_index
+
+    def __len__(self):
+        return len(self.pack_index)
+
+    def __getitem__(self, position):
+        return self.pack_index._digest_at(position)
+
+
+class Pack:
+
+    """A pack file and its index, read through memory maps"""
+
+    def __init__(self, pack_path):
+        """Initialize instance variables"""
+        self.pack_path = pack_path
+        self.index = PackIndex(os.path.splitext(pack_path)[0] + '.idx')
+
+        with open(pack_path, 'rb') as pack_file:
+            self._map = mmap.mmap(
+                pack_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+
+        magic, version, count = HEADER.unpack_from(self._map, 0)
+        if magic != PACK_MAGIC or version != VERSION or \
+                count != self.index.count:
+            self.close()
+            raise PackException('Invalid pack: {}'.format(pack_path))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, obj_hash):
+        return self.index.find(obj_hash) is not None
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def read(self, obj_hash, size=None):
+        """Returns the stored content of an object or None if not found
+
+        If a size is given, at most that many bytes are returned.
+        """
+        location = self.index.find(obj_hash)
+        if location is None:
+            return None
+        offset, length = location
+        if size is not None:
+            length = min(length, size)
+        return self._map[offset:offset + length]
+
+    def close(self):
+        """Releases the memory maps of the pack and its index"""
+        self._map.close()
+        self.index.close()
+
+
+def list_packs(pack_dir):
+    """Returns the paths of every complete pack in the pack directory"""
+    try:
+        names = sorted(os.listdir(pack_dir))
+    except FileNotFoundError:
+        return []
+
+    # A pack is only complete once its index has been written
+    return [
+        os.path.join(pack_dir, name[:-len('.idx')] + '.pack')
+        for name in names
+        if name.endswith('.idx')
+    ]
+
+
+def write_pack(pack_dir, obj_hashes, read_content):
+    """Writes a pack of the given objects and returns the path of the pack
+
+    The stored content of each object is requested from read_content one at
+    a time, so memory use does not grow with the size of the pack. The pack
+    and index are written to temporary files and synced before being
+    renamed into place, index last, so a pack is never visible before it is
+    complete.
+    """
+    obj_hashes = sorted(obj_hashes)
+    name_hasher = hashlib.sha1()
+    entries = []
+
+    os.makedirs(pack_dir, exist_ok=True)
+    temp_pack = os.path.join(pack_dir, 'tmp-pack')
+    temp_index = os.path.join(pack_dir, 'tmp-idx')
+
+    # Write the records of the pack
+    with open(temp_pack, 'wb') as pack_file:
+        pack_file.write(HEADER.pack(PACK_MAGIC, VERSION, len(obj_hashes)))
+        offset = HEADER.size
+        for obj_hash in obj_hashes:
+            content = read_content(obj_hash)
+            pack_file.write(content)
+            entries.append((bytes.fromhex(obj_hash), offset, len(content)))
+            name_hasher.update(entries[-1][0])
+            offset += len(content)
+        pack_file.flush()
+        os.fsync(pack_file.fileno())
+
+    # Count the objects for each first digest byte
+    fanout = [0] * 256
+    for digest, _, _ in entries:
+        fanout[digest[0]] += 1
+    for first in range(1, 256):
+        fanout[first] += fanout[first - 1]
+
+    # Write the index of the pack
+    with open(temp_index, 'wb') as index_file:
+        index_file.write(HEADER.pack(INDEX_MAGIC, VERSION, len(entries)))
+        index_file.write(FANOUT.pack(*fanout))
+        for entry in entries:
+            index_file.write(ENTRY.pack(*entry))
+        index_file.flush()
+        os.fsync(index_file.fileno())
+
+    # Move the pack into place before the index that makes it visible
+    base_path = os.path.join(
+        pack_dir, 'pack-{}'.format(name_hasher.hexdigest())
+    )
+    os.replace(temp_pack, base_path + '.pack')
+    os.replace(temp_index, base_path + '.idx')
+    return base_path + '.pack'
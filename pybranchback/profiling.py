@@ -0,0 +1,160 @@
+"""Counters and timings of the phases of repository operations"""
+import collections
+import contextlib
+import cProfile
+import functools
+import threading
+import time
+
+
+class Stats:
+
+    """Collects counters, value distributions and timings of phases
+
+    Timings are inclusive wall clock times. A phase that calls itself
+    recursively is only timed at its outermost call in each thread, so
+    nested time is never counted twice. Phases running in several threads
+    at once are summed, so their time may exceed the elapsed time.
+
+    Nothing is recorded while disabled, and the only cost of the
+    instrumentation is the check of the enabled flag.
+    """
+
+    def __init__(self, enabled=False):
+        """Initialize instance variables"""
+        self.enabled = enabled
+
+        # Instance variables
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Discards everything recorded so far"""
+        with self._lock:
+            self.counters = collections.Counter()
+            self.values = {}
+            self.timings = {}
+
+    def count(self, name, amount=1):
+        """Adds an amount to a counter"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += amount
+
+    def record(self, name, value):
+        """Adds a value to a distribution, such as a delta chain length"""
+        if not self.enabled:
+            return
+        with self._lock:
+            count, total, maximum = self.values.get(name, (0, 0, value))
+            self.values[name] = (count + 1, total + value, max(maximum, value))
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Context manager that adds the time spent inside to a phase"""
+        if not self.enabled:
+            yield
+            return
+
+        # Only the outermost of nested calls of a phase is timed
+        active = self._active()
+        if name in active:
+            yield
+            return
+
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            active.discard(name)
+            with self._lock:
+                calls, seconds = self.timings.get(name, (0, 0.0))
+                self.timings[name] = (calls + 1, seconds + elapsed)
+
+    def report(self):
+        """Returns everything recorded as a dictionary"""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'values': {
+                    name: {
+                        'count': count,
+                        'mean': total / count,
+                        'max': maximum,
+                    }
+                    for name, (count, total, maximum) in self.values.items()
+                },
+                'timings': {
+                    name: {'calls': calls, 'seconds': seconds}
+                    for name, (calls, seconds) in self.timings.items()
+                },
+            }
+
+    def format(self):
+        """Returns everything recorded as a human readable table"""
+        report = self.report()
+        lines = ['{: <28} {: >10} {: >12}'.format('phase', 'calls', 'seconds')]
+        for name, timing in sorted(
+                report['timings'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append('{: <28} {: >10} {: >12.4f}'.format(
+                name, timing['calls'], timing['seconds']
+            ))
+
+        lines.append('')
+        lines.append('{: <28} {: >10}'.format('counter', 'total'))
+        for name, total in sorted(report['counters'].items()):
+            lines.append('{: <28} {: >10}'.format(name, total))
+
+        if report['values']:
+            lines.append('')
+            lines.append('{: <28} {: >10} {: >12} {: >8}'.format(
+                'value', 'count', 'mean', 'max'
+            ))
+            for name, value in sorted(report['values'].items()):
+                lines.append('{: <28} {: >10} {: >12.2f} {: >8}'.format(
+                    name, value['count'], value['mean'], value['max']
+                ))
+        return '\n'.join(lines)
+
+    def _active(self):
+        """Returns the set of phases being timed in the current thread"""
+        active = getattr(self._local, 'active', None)
+        if active is None:
+            active = self._local.active = set()
+        return active
+
+
+def timed(name):
+    """Decorator that times a method as a phase in the stats of its object"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.stats.enabled:
+                return method(self, *args, **kwargs)
+            with self.stats.timer(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def cprofile(output_path):
+    """Context manager that dumps a cProfile of its body to a file
+
+    Does nothing if the output path is None.
+    """
+    if output_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
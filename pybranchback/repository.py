@@ -1,11 +1,34 @@
+import collections
+import concurrent.futures
+import contextlib
+import calendar
 import ctypes
 import hashlib
 import os
 import pickle
+import posixpath
 import shutil
+import stat
+import tempfile
+import threading
+import time
 
 import pybranchback.bindifflib as bindifflib
+import pybranchback.bundle as bundle
+import pybranchback.cache as cache
+import pybranchback.chunking as chunking
+import pybranchback.compression as compression
+import pybranchback.hashcache as hashcache
+import pybranchback.ignore as ignore
+import pybranchback.index as index
+import pybranchback.monitor as monitor
+import pybranchback.objects as objects
+import pybranchback.pack as pack
+import pybranchback.profiling as profiling
+import pybranchback.similarity as similarity
 import pybranchback.snapshotdb as ssdb
+import pybranchback.sparse as sparse
+import pybranchback.trees as trees
 import pybranchback.utils as utils
 
 
@@ -47,6 +70,18 @@ class DetachedHeadException(RepositoryException):
     pass
 
 
+# A path that differs between two trees, stats are only set if requested
+# and the old path is only set for renames
+Change = collections.namedtuple(
+    'Change', ['status', 'path', 'old_hash', 'new_hash', 'stats', 'old_path']
+)
+Change.__new__.__defaults__ = (None, None)
+ADDED = 'added'
+MODIFIED = 'modified'
+REMOVED = 'removed'
+RENAMED = 'renamed'
+
+
 class Repository:
 
     """Manages a repository instance
@@ -56,12 +91,21 @@ class Repository:
     |  +--objects/
     |     +--<first 2 hash chars>/
     |        <remaining 38 harsh chars>
+    |     +--pack/
+    |        pack-<hash>.pack
+    |        pack-<hash>.idx
+    |     +--tmp/
     |  +--refs/
     |     +--heads/
     |        master
     |  objhashcache
+    |  format
     |  HEAD
+    |  ignore
+    |  index
+    |  journal
     |  snapshots
+    |  sparse
     """
 
     DEFAULT_BRANCH = 'master'
@@ -71,20 +115,154 @@ class Repository:
         'objects': utils.posixjoin(REPO_DIR, 'objects'),
         'refs': utils.posixjoin(REPO_DIR, 'refs'),
         'heads': utils.posixjoin(REPO_DIR, 'refs', 'heads'),
+        'packs': utils.posixjoin(REPO_DIR, 'objects', 'pack'),
+        'staging': utils.posixjoin(REPO_DIR, 'objects', 'tmp'),
     }
     FILES = {
         'objhashcache': '.pbb/objhashcache',
         'head': '.pbb/HEAD',
         'snapshots': '.pbb/snapshots',
+        'index': '.pbb/index',
+        'format': '.pbb/format',
+        'journal': '.pbb/journal',
+        'ignore': '.pbb/ignore',
+        'sparse': '.pbb/sparse',
     }
-
-    def __init__(self, root_dir, create=False):
+    # Directories and files that are created on demand if missing
+    OPTIONAL_PATHS = (
+        'packs', 'staging', 'index', 'format', 'journal', 'ignore',
+        'sparse',
+    )
+    # Ignore file of the user applying to every repository, with a lower
+    # precedence than the ignore file of the repository, None disables it
+    GLOBAL_IGNORE_FILE = os.path.join('~', '.config', 'pbb', 'ignore')
+    # Version of the repository format, repositories without a format file
+    # are version 1 and may contain objects without an object header, and
+    # version 3 writes binary instead of text trees
+    FORMAT_VERSION = 3
+    # Version older repositories are migrated to, text trees are never
+    # rewritten as that would change the hash of every snapshot
+    MIGRATE_VERSION = 2
+    # Number of patches that may be chained before a full copy is stored
+    MAX_DELTA_DEPTH = 50
+    # Bytes of reconstructed object content kept in memory
+    CACHE_SIZE = 64 * 1024 * 1024
+    # Estimated bytes of parsed tree entries kept in memory
+    TREE_CACHE_SIZE = 16 * 1024 * 1024
+    # Bytes of objects written to a single pack before starting another
+    MAX_PACK_SIZE = 1024 * 1024 * 1024
+    # Number of workers storing or restoring files, 1 disables the pool
+    WORKERS = 1
+    # Files at least this large are diffed in a worker process
+    PROCESS_DIFF_SIZE = 1024 * 1024
+    # Delta engine used for patches, None chooses the engine of each patch
+    # by the memory its diff needs
+    DELTA_ENGINE = None
+    # Bytes of memory a single diff may use besides its inputs
+    DELTA_MEMORY = bindifflib.MEMORY_BUDGET
+    # Codec used to compress full objects, a level of 0 disables compression
+    CODEC = 'zlib'
+    COMPRESSION_LEVEL = None
+    # Files at least this large are stored as content-defined chunks, None
+    # disables chunking
+    CHUNK_THRESHOLD = None
+    # Bytes read at a time while hashing files
+    READ_SIZE = 1024 * 1024
+    # Candidates listed when a partial hash is ambiguous
+    MAX_MATCHES = 10
+    # Collect counters and timings of operations in stats
+    PROFILE = False
+    # Seconds to wait for the file system monitor to report recent changes
+    MONITOR_TIMEOUT = 1.0
+    # Flush written objects to disk before a snapshot is recorded
+    FSYNC = True
+    # Unreachable objects written less than this many seconds ago are kept
+    # by gc, as a snapshot in progress may still refer to them
+    GC_GRACE_PERIOD = 60 * 60
+    # Recently stored objects of similar size searched for a delta base of
+    # a file without a previous version, 0 disables the search
+    SIMILARITY_WINDOW = 10
+    # Fraction of content an object must share with a delta base or with
+    # the removed file of a rename
+    MIN_SIMILARITY = 0.5
+    # Files smaller than this are neither fingerprinted nor paired as renames
+    # unless their content is identical
+    MIN_SIMILARITY_SIZE = 256
+    # Removed and added files compared by content to detect renames
+    MAX_RENAME_CANDIDATES = 1000
+
+    def __init__(
+            self, root_dir, create=False, max_delta_depth=None,
+            cache_size=None, workers=None, codec=None,
+            compression_level=None, chunk_threshold=None, profile=None,
+            similarity_window=None, delta_engine=None, delta_memory=None):
         """Initialize instance variables"""
         self.root_dir = root_dir
         self.create = create
+        if max_delta_depth is None:
+            max_delta_depth = self.MAX_DELTA_DEPTH
+        self.max_delta_depth = max_delta_depth
+        if cache_size is None:
+            cache_size = self.CACHE_SIZE
+        if workers is None:
+            workers = self.WORKERS
+        self.workers = workers
+        if codec is None:
+            codec = self.CODEC
+        self.codec = compression.get_codec(codec)
+        if compression_level is None:
+            compression_level = self.COMPRESSION_LEVEL
+        if compression_level is None:
+            compression_level = self.codec.default_level
+        self.compression_level = compression_level
+        if chunk_threshold is None:
+            chunk_threshold = self.CHUNK_THRESHOLD
+        self.chunk_threshold = chunk_threshold
+        self.chunker = chunking.Chunker()
+        if delta_engine is None:
+            delta_engine = self.DELTA_ENGINE
+        if delta_engine is not None:
+            delta_engine = bindifflib.get_engine(delta_engine).id
+        self.delta_engine = delta_engine
+        if delta_memory is None:
+            delta_memory = self.DELTA_MEMORY
+        self.delta_memory = delta_memory
+        if similarity_window is None:
+            similarity_window = self.SIMILARITY_WINDOW
+        self.similarity_window = similarity_window
+        if profile is None:
+            profile = self.PROFILE
+        self.stats = profiling.Stats(profile)
 
         # Instance variables
-        self.objhashcache = {}
+        self.objhashcache = hashcache.ObjHashCache(
+            self._join_root(self.FILES['objhashcache'])
+        )
+        self.fingerprints = similarity.FingerprintIndex(
+            self._join_root(self.FILES['objhashcache'])
+        )
+        self.object_cache = cache.ObjectCache(cache_size)
+        self.tree_cache = cache.ObjectCache(
+            self.TREE_CACHE_SIZE, trees.tree_size
+        )
+        self._packs = None
+        self._packs_lock = threading.Lock()
+        self._diff_executor = None
+        self._pending_blobs = None
+        self._staged_objects = None
+        self._staging_lock = threading.Lock()
+        self._changes = None
+        self._held_blobs = None
+        self._held_paths = set()
+        self.index = index.WorkingTreeIndex(
+            self._join_root(self.FILES['index'])
+        )
+        global_ignore_files = [self._join_root(self.FILES['ignore'])]
+        if self.GLOBAL_IGNORE_FILE is not None:
+            global_ignore_files.insert(
+                0, os.path.expanduser(self.GLOBAL_IGNORE_FILE)
+            )
+        self.ignore = ignore.IgnoreMatcher(root_dir, global_ignore_files)
 
         # Validate that a repository exists at the given location
         if not self.validate_repo():
@@ -95,6 +273,10 @@ class Repository:
 
         # Load any existing attributes
         self._load_hashmap()
+        self.index.load()
+        self.format_version = self._load_format_version()
+        self.sparse = self._load_sparse()
+        self._restore_sparse_trees()
 
     def validate_repo(self):
         """Check that the repository structure exists and is valid"""
@@ -104,9 +286,15 @@ class Repository:
         def is_file(rel_path):
             return os.path.isfile(self._join_root(rel_path))
 
+        def required(paths):
+            return [
+                rel_path for key, rel_path in paths.items()
+                if key not in self.OPTIONAL_PATHS
+            ]
+
         return (
-            all(map(is_dir, self.DIRS.values())) and
-            all(map(is_file, self.FILES.values()))
+            all(map(is_dir, required(self.DIRS))) and
+            all(map(is_file, required(self.FILES)))
         )
 
     def create_repo(self):
@@ -115,10 +303,12 @@ class Repository:
         for rel_dir in self.DIRS.values():
             os.makedirs(self._join_root(rel_dir), exist_ok=True)
 
-        # Make the new version control folder hidden
-        ctypes.windll.kernel32.SetFileAttributesW(
-            self._join_root(self.REPO_DIR), 0x02
-        )
+        # Make the new version control folder hidden (dot directories are
+        # already hidden on other platforms)
+        if os.name == 'nt':
+            ctypes.windll.kernel32.SetFileAttributesW(
+                self._join_root(self.REPO_DIR), 0x02
+            )
 
         # Create HEAD file and set branch to the default name
         self._set_branch(self.DEFAULT_BRANCH)
@@ -126,8 +316,15 @@ class Repository:
         # Create objhashcache file and set as empty
         self._save_objhashcache()
 
+        # New repositories only ever contain objects with a header
+        self._save_format_version(self.FORMAT_VERSION)
+
         # Create the snapshots database
-        ssdb.execute(self.FILES['snapshots'], ssdb.CREATE)
+        with self.stats.timer('snapshotdb'):
+            ssdb.execute(
+                self._join_root(self.FILES['snapshots']), ssdb.CREATE
+            )
+            ssdb.create_indexes(self._join_root(self.FILES['snapshots']))
 
     def current_branch(self):
         """Returns the name of the current branch"""
@@ -136,9 +333,18 @@ class Repository:
 
     def snapshot(self, message='', user=''):
         """Takes a snapshot of the the current status of the directory"""
-        # Recursively build tree structure
-        with utils.temp_wd(self.root_dir):
-            top_hash = self._create_tree_node('.')
+        # Recursively build tree structure, the new objects are written to
+        # disk together once the whole tree is stored
+        with utils.temp_wd(self.root_dir), self._monitored_scan(), \
+                self._object_batch():
+            if self.workers > 1:
+                top_hash = self._create_tree_node_parallel('.')
+            else:
+                top_hash = self._create_tree_node('.')
+
+        # Save the refreshed stat data of every file that was walked
+        self.index.prune()
+        self.index.save()
 
         # Get hash of the current snapshot and if it is detached
         old_hash, detached = self._current_snapshot_hash()
@@ -161,6 +367,10 @@ class Repository:
 
         # Insert snapshot data into the snapshot database
         self._insert_snapshot(top_hash, message, user)
+
+        # Record the files renamed since the previous snapshot
+        if old_hash is not None:
+            self._insert_renames(top_hash, old_hash)
         return top_hash
 
     def create_branch(self, name, snapshot=None, message='', user=''):
@@ -186,10 +396,28 @@ class Repository:
 
     def list_snapshots(self):
         """Return a list of sqlite.Row objects for each snapshot"""
-        return ssdb.execute(
-            self.FILES['snapshots'], ssdb.SELECT,
-            row_factory=ssdb.Row, cursor='fetchall'
-        )
+        with self.stats.timer('snapshotdb'):
+            return ssdb.execute(
+                self._join_root(self.FILES['snapshots']), ssdb.SELECT,
+                row_factory=ssdb.Row, cursor='fetchall'
+            )
+
+    def list_renames(self, snapshot):
+        """Return a list of sqlite.Row objects for each rename of a snapshot
+
+        Renames are recorded against the previous snapshot of the branch
+        when a snapshot is taken.
+
+        Raises:
+          InvalidHashException: If not a single unique hash is found
+        """
+        full_hash = self._resolve_snapshot(snapshot)
+        with self.stats.timer('snapshotdb'):
+            return ssdb.execute(
+                self._join_root(self.FILES['snapshots']), ssdb.SELECT_RENAMES,
+                {'snapshot': full_hash}, row_factory=ssdb.Row,
+                cursor='fetchall'
+            )
 
     def checkout(self, checkout, create=None, force=False, branch=False):
         """Checks out a different snapshot in the repository
@@ -212,7 +440,7 @@ class Repository:
 
         # Raise exception on a dirty directory if no force option
         if not force:
-            self._check_dirty()
+            self._check_dirty(full_hash)
 
         # Check if create option was given
         if create is not None:
@@ -220,18 +448,20 @@ class Repository:
             # following code will simply check out that branch
             self.create_branch(create, full_hash)
             self.switch_branch(create, force)
-        else:
-            # Check if the hash matches any current branch
-            branch = self._match_branch(full_hash)
-            if branch is not None:
-                # Just switch branch instead of checkout a detached HEAD
-                self.switch_branch(branch, force)
-                return
-            # If the hash doesn't match a branch, we need to detach the HEAD
-            self._set_branch(full_hash)
+            return
 
-        # TODO: Switch all files in the directory
-        self._update_files()
+        # Check if the hash matches any current branch
+        branch = self._match_branch(full_hash)
+        if branch is not None:
+            # Just switch branch instead of checkout a detached HEAD
+            self.switch_branch(branch, force)
+            return
+
+        # If the hash doesn't match a branch, we need to detach the HEAD
+        # once the files are updated
+        old_hash, rebuild = self._checkout_base(full_hash, force)
+        self._update_files(old_hash, rebuild, full_hash)
+        self._set_branch(full_hash)
 
     def switch_branch(self, name, force=False):
         """Sets the branch to the given name then updates all files
@@ -245,46 +475,713 @@ class Repository:
             raise ValueError('No branch found: {}'.format(name))
 
         # Raise exception on a dirty directory if no force option
+        new_hash = self._get_branch_head(name)
         if not force:
-            self._check_dirty()
+            self._check_dirty(new_hash)
 
-        # Switch the the existing branch
+        # Switch the the existing branch once the files are updated
+        old_hash, rebuild = self._checkout_base(new_hash, force)
+        self._update_files(old_hash, rebuild, new_hash)
         self._set_branch(name)
-        self._update_files()
 
     def list_branches(self):
         """Returns a list of all existing branch names"""
         return utils.list_files(self._join_root(self.DIRS['heads']))
 
-    def _check_dirty(self):
-        """Raises exception if the directory has changes since last save
+    def sparse_checkout(self, patterns, force=False):
+        """Materializes only the paths of the snapshot matching patterns
+
+        Everything else is kept as references to the stored objects, which
+        snapshots and the dirty check treat as unchanged. The patterns apply
+        to every later checkout. No patterns materializes every path again.
 
         Raises:
           DirtyDirectoryException: If changes made since last save
         """
-        # Get hash of directory in it's current form
-        with utils.temp_wd(self.root_dir):
-            dir_hash = self._get_tree_hash('.')
+        # Raise exception on a dirty directory if no force option
+        cur_hash, _ = self._current_snapshot_hash()
+        if not force:
+            self._check_dirty(cur_hash)
+
+        # Rebuild the directory with the new patterns
+        self._save_sparse(patterns)
+        self.sparse = self._load_sparse()
+        self._update_files(cur_hash, rebuild=True)
+
+    def sparse_patterns(self):
+        """Returns the patterns of the sparse checkout, empty if disabled"""
+        return list(self.sparse.patterns)
 
-        # Check if any outstanding changes are in the directory
+    def status(self, stats=False):
+        """Returns the changes of files since the current snapshot
+
+        Only directories whose tree hash differs from the snapshot are
+        compared file by file. Removed and added files with the same or
+        similar content are listed as renames. If stats is True, each
+        change includes the sizes and the size of the patch between the two
+        versions.
+        """
         cur_hash, _ = self._current_snapshot_hash()
-        if cur_hash != dir_hash:
+        with utils.temp_wd(self.root_dir), self._monitored_scan():
+            dir_hash = self._get_tree_hash('.')
+            changes = self._detect_renames(list(self._tree_changes(
+                cur_hash, dir_hash, '.', self._working_tree_entries
+            )), working=True)
+
+        # Save the refreshed stat data of every file that was walked
+        self.index.prune()
+        self.index.save()
+
+        if stats:
+            changes = [
+                self._change_stats(change, working=True)
+                for change in changes
+            ]
+        return changes
+
+    def diff(self, old, new=None, stats=False):
+        """Returns the changes of files between two snapshots
+
+        Snapshots are given by branch name or (partial) hash. Without a new
+        snapshot, the old snapshot is compared with the directory instead.
+        Identical subtrees are skipped without reading them, and renames
+        are detected as in status.
+
+        Raises:
+          InvalidHashException: If not a single unique hash is found
+        """
+        old_hash = self._resolve_snapshot(old)
+        if new is None:
+            with utils.temp_wd(self.root_dir), self._monitored_scan():
+                dir_hash = self._get_tree_hash('.')
+                changes = self._detect_renames(list(self._tree_changes(
+                    old_hash, dir_hash, '.', self._working_tree_entries
+                )), working=True)
+            self.index.prune()
+            self.index.save()
+        else:
+            changes = self._detect_renames(list(self._tree_changes(
+                old_hash, self._resolve_snapshot(new), '.'
+            )))
+
+        if stats:
+            changes = [
+                self._change_stats(change, working=(new is None))
+                for change in changes
+            ]
+        return changes
+
+    def start_monitor(self, foreground=False):
+        """Starts the file system monitor and returns its process id
+
+        Raises:
+          MonitorException: If the monitor is not available on this system
+        """
+        return monitor.start(
+            self.root_dir, self._join_root(self.FILES['journal']), foreground
+        )
+
+    def stop_monitor(self):
+        """Stops the file system monitor, returns False if not running"""
+        return monitor.stop(self._join_root(self.FILES['journal']))
+
+    def monitor_pid(self):
+        """Returns the process id of the file system monitor or None"""
+        return monitor.monitor_pid(self._join_root(self.FILES['journal']))
+
+    def profile_report(self):
+        """Returns the counters and timings collected while profiling
+
+        Counters and timings are only collected if the repository was
+        created with profiling enabled, the object cache counters always are.
+        """
+        report = self.stats.report()
+        report['object_cache'] = self.object_cache.stats()
+        return report
+
+    def pack(self, max_pack_size=None):
+        """Consolidates all loose objects into one or more packfiles
+
+        Loose objects are only removed once the packs holding them have been
+        completely written. Returns a dictionary with the number of objects
+        packed and the paths of the new packs.
+        """
+        if max_pack_size is None:
+            max_pack_size = self.MAX_PACK_SIZE
+
+        # Group loose objects into packs of at most the maximum size
+        groups = [[]]
+        group_size = 0
+        for obj_hash in self._list_loose_objects():
+            obj_size = os.path.getsize(self._loose_object_path(obj_hash))
+            if groups[-1] and group_size + obj_size > max_pack_size:
+                groups.append([])
+                group_size = 0
+            groups[-1].append(obj_hash)
+            group_size += obj_size
+
+        pack_dir = self._join_root(self.DIRS['packs'])
+        pack_paths = []
+        for group in groups:
+            if not group:
+                continue
+            pack_paths.append(
+                pack.write_pack(pack_dir, group, self._read_loose_object)
+            )
+
+            # The objects are safely packed, so remove the loose copies
+            for obj_hash in group:
+                os.remove(self._loose_object_path(obj_hash))
+
+        self._remove_empty_fanout_dirs()
+        self._reload_packs()
+        return {
+            'objects': sum(len(group) for group in groups),
+            'packs': pack_paths,
+        }
+
+    def gc(self, rebase=False, repack=True, grace_period=None):
+        """Removes objects no snapshot can reach and repacks the others
+
+        Objects reachable from the branch heads, the snapshots table and a
+        detached HEAD are kept, along with the delta bases and chunks needed
+        to rebuild them and the objects the objhashcache uses as delta bases
+        for the next snapshot. Unreachable objects written within the grace
+        period are kept too, with everything they refer to.
+
+        With rebase, delta chains longer than the maximum delta depth are
+        cut by storing full copies, deltas larger than their content are
+        replaced by full copies and stale recorded depths are corrected.
+
+        Nothing is removed before marking is complete, objects are replaced
+        atomically and packs are only removed once their reachable objects
+        are stored again, so gc can be interrupted and simply run again.
+        Returns a dictionary with the number of objects removed and rebased,
+        the bytes of the removed objects and packs, and the change in size
+        from storing kept objects again, which repacking and rebasing can
+        grow.
+
+        Raises:
+          RepositoryException: If rebasing objects of an older repository
+        """
+        if grace_period is None:
+            grace_period = self.GC_GRACE_PERIOD
+        if rebase and self.format_version < self.MIGRATE_VERSION:
+            raise RepositoryException(
+                'Run migrate before rebasing objects of an older repository'
+            )
+
+        size_before = self._object_storage_size()
+        self._reload_packs()
+        stored = self._stored_objects()
+
+        # Mark everything needed to check out any snapshot
+        reachable = set()
+        walked_trees = set()
+        for root_hash in self._snapshot_roots():
+            self._mark_reachable(root_hash, True, reachable, walked_trees)
+        for obj_hash in self.objhashcache.hashes() & stored.keys():
+            self._mark_reachable(obj_hash, False, reachable, walked_trees)
+
+        # Keep recently written objects and everything they refer to
+        cutoff = time.time() - grace_period
+        for obj_hash, mtime in stored.items():
+            if obj_hash not in reachable and mtime >= cutoff:
+                self._mark_reachable(
+                    obj_hash, self._is_stored_tree(obj_hash, stored),
+                    reachable, walked_trees,
+                )
+
+        rebased = set()
+        if rebase:
+            rebased = self._rebase_deltas(reachable)
+
+        # Remove unreachable loose objects
+        removed = set()
+        reclaimed = 0
+        for obj_hash in self._list_loose_objects():
+            if obj_hash not in reachable:
+                obj_path = self._loose_object_path(obj_hash)
+                reclaimed += os.path.getsize(obj_path)
+                os.remove(obj_path)
+                removed.add(obj_hash)
+
+        # Remove objects staged by snapshots that never completed
+        staging_dir = self._join_root(self.DIRS['staging'])
+        try:
+            staged_names = os.listdir(staging_dir)
+        except FileNotFoundError:
+            staged_names = []
+        for name in staged_names:
+            temp_path = os.path.join(staging_dir, name)
+            if os.path.getmtime(temp_path) < cutoff:
+                os.remove(temp_path)
+
+        # Rewrite packs without unreachable objects and rebased objects,
+        # which are now stored as loose objects
+        pack_dir = self._join_root(self.DIRS['packs'])
+        for obj_pack in list(self._packs):
+            keep = [
+                obj_hash for obj_hash in obj_pack
+                if obj_hash in reachable and obj_hash not in rebased
+            ]
+            if len(keep) == len(obj_pack):
+                continue
+            unreachable = [
+                obj_hash for obj_hash in obj_pack if obj_hash not in reachable
+            ]
+            removed.update(unreachable)
+            if keep:
+                pack.write_pack(pack_dir, keep, obj_pack.read)
+                reclaimed += sum(
+                    obj_pack.index.find(obj_hash)[1]
+                    for obj_hash in unreachable
+                )
+            else:
+                reclaimed += os.path.getsize(obj_pack.index.index_path)
+                reclaimed += os.path.getsize(obj_pack.pack_path)
+
+            # The index goes first so the pack is never visible incomplete
+            self._packs.remove(obj_pack)
+            obj_pack.close()
+            os.remove(obj_pack.index.index_path)
+            os.remove(obj_pack.pack_path)
+        self._reload_packs()
+
+        # Removed objects can no longer be delta bases
+        self.fingerprints.remove(removed)
+        self.fingerprints.save()
+
+        if repack:
+            self.pack()
+        else:
+            self._remove_empty_fanout_dirs()
+
+        return {
+            'objects_removed': len(removed),
+            'objects_rebased': len(rebased),
+            'bytes_reclaimed': reclaimed,
+            'repack_growth': (
+                self._object_storage_size() - size_before + reclaimed
+            ),
+        }
+
+    def migrate(self):
+        """Rewrites all objects without an object header to the new format
+
+        Each object is replaced atomically and objects already converted
+        are skipped, so an interrupted migration can simply be run again.
+        The format version is only updated once every object is converted.
+        Returns the number of objects converted.
+        """
+        if self.format_version >= self.MIGRATE_VERSION:
+            return 0
+
+        converted = 0
+        for obj_hash in self._list_loose_objects():
+            if self._write_migrated_object(obj_hash):
+                converted += 1
+
+        # Unpack legacy packs into converted loose objects and pack again
+        self._reload_packs()
+        legacy_packs = list(self._packs)
+        for obj_pack in legacy_packs:
+            for obj_hash in obj_pack:
+                if self._write_migrated_object(obj_hash, force=True):
+                    converted += 1
+            self._packs.remove(obj_pack)
+            obj_pack.close()
+            os.remove(obj_pack.index.index_path)
+            os.remove(obj_pack.pack_path)
+        if legacy_packs:
+            self.pack()
+
+        self._save_format_version(self.MIGRATE_VERSION)
+        self.format_version = self.MIGRATE_VERSION
+        return converted
+
+    def export_bundle(self, output, snapshot=None, base=None):
+        """Streams a bundle of a snapshot and its objects to a binary stream
+
+        Defaults to the current snapshot. With a base, every snapshot of the
+        branch after the base up to the snapshot is included, but only the
+        objects the base does not need, as the receiver must already have
+        the base. Returns the number of objects written.
+
+        Raises:
+          InvalidHashException: If not a single unique hash is found
+          ValueError: If the base is not older than the snapshot
+        """
+        # Find the snapshots of the bundle
+        tip_row = self._snapshot_row(snapshot)
+        rows = [tip_row]
+        base_hash = None
+        if base is not None:
+            base_hash = self._resolve_snapshot(base)
+            with self.stats.timer('snapshotdb'):
+                base_row = ssdb.execute(
+                    self._join_root(self.FILES['snapshots']),
+                    ssdb.SELECT_SNAPSHOT_BEFORE,
+                    {'hash': base_hash, 'id': tip_row['id']},
+                    row_factory=ssdb.Row, cursor='fetchone',
+                )
+                if base_row is None:
+                    raise ValueError(
+                        'Base is not older than the snapshot: {}'.format(base)
+                    )
+                rows = ssdb.execute(
+                    self._join_root(self.FILES['snapshots']),
+                    ssdb.SELECT_BRANCH_RANGE,
+                    {
+                        'branch': tip_row['branch'], 'low': base_row['id'],
+                        'high': tip_row['id'],
+                    },
+                    row_factory=ssdb.Row, cursor='fetchall',
+                )
+
+        # Leave out the objects the receiver already has through the base
+        reachable = set()
+        walked_trees = set()
+        if base_hash is not None:
+            self._mark_reachable(base_hash, True, reachable, walked_trees)
+        known = set(reachable)
+        for row in rows:
+            self._mark_reachable(row['hash'], True, reachable, walked_trees)
+        needed = sorted(reachable - known)
+
+        writer = bundle.BundleWriter(output, self.format_version)
+        if base_hash is not None:
+            writer.prerequisite(base_hash)
+        for row in rows:
+            writer.snapshot(self._bundle_snapshot(row))
+        for obj_hash in needed:
+            writer.object(obj_hash, self._bundle_object(obj_hash))
+        writer.finish()
+        return len(needed)
+
+    def import_bundle(self, stream):
+        """Adds the snapshots and objects of a bundle read from a stream
+
+        Objects that already exist are skipped. The new objects only become
+        visible once the whole bundle has been read and its checksum checked.
+        Branches of the bundle that do not exist are created, and existing
+        branches at the base of the bundle are moved to its last snapshot,
+        except for the current branch. Returns a dictionary with the number
+        of objects written and skipped, and the snapshots and branches added.
+        Snapshots the repository already has are not counted as added.
+
+        Raises:
+          BundleException: If the bundle is corrupt, its base is missing or
+            its trees are not in the tree format of this repository
+        """
+        prerequisites = []
+        snapshots = []
+        written = 0
+        skipped = 0
+        with self._object_batch():
+            for kind, value in bundle.read_bundle(stream):
+                if kind == bundle.FORMAT and \
+                        (value >= 3) != (self.format_version >= 3):
+                    # Trees are written in the local format, so imported
+                    # trees of the other format would never match again
+                    raise bundle.BundleException(
+                        'Bundle trees are in the format of version {}, '
+                        'the repository is version {}'.format(
+                            value, self.format_version
+                        )
+                    )
+                if kind == bundle.PREREQUISITE:
+                    if not self._object_exists(value):
+                        raise bundle.BundleException(
+                            'Missing base snapshot of bundle: {}'.format(value)
+                        )
+                    prerequisites.append(value)
+                if kind == bundle.SNAPSHOT:
+                    snapshots.append(value)
+                if kind == bundle.OBJECT:
+                    obj_hash, content = value
+                    if self._object_exists(obj_hash):
+                        skipped += 1
+                        continue
+                    if not objects.is_encoded(content):
+                        raise bundle.BundleException(
+                            'Invalid object in bundle: {}'.format(obj_hash)
+                        )
+                    self._write_object(obj_hash, content)
+                    written += 1
+
+        # Record the snapshots and their renames, unless already recorded
+        added = []
+        with self.stats.timer('snapshotdb'):
+            con = ssdb.connect(self._join_root(self.FILES['snapshots']))
+            with con:
+                for data in snapshots:
+                    cursor = con.execute(ssdb.INSERT_IMPORTED, {
+                        key: data[key] for key in (
+                            'hash', 'branch', 'message', 'user', 'timestamp'
+                        )
+                    })
+                    if cursor.rowcount:
+                        added.append(data['hash'])
+                        con.executemany(ssdb.INSERT_RENAME, [
+                            dict(rename, snapshot=data['hash'])
+                            for rename in data['renames']
+                        ])
+
+        # Create or move the branches to their last snapshot of the bundle
+        heads = collections.OrderedDict(
+            (data['branch'], data['hash']) for data in snapshots
+        )
+        current_branch = self.current_branch()
+        branches = []
+        for branch, tip_hash in heads.items():
+            head = self._get_branch_head(branch)
+            if branch == current_branch or head == tip_hash:
+                continue
+            if head is None or head in prerequisites:
+                self._update_branch_head(tip_hash, branch)
+                branches.append(branch)
+
+        return {
+            'objects_written': written,
+            'objects_skipped': skipped,
+            'snapshots': added,
+            'branches': branches,
+        }
+
+    def export_archive(self, output, snapshot=None):
+        """Streams a tar archive of the files of a snapshot to a stream
+
+        Defaults to the current snapshot. Files are rebuilt from the stored
+        objects as they are written, a chunk at a time for chunked files.
+
+        Raises:
+          InvalidHashException: If not a single unique hash is found
+        """
+        row = self._snapshot_row(snapshot)
+        mtime = calendar.timegm(
+            time.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S')
+        )
+        bundle.write_archive(
+            output, self._archive_entries(row['hash'], '.'), mtime
+        )
+
+    @contextlib.contextmanager
+    def _monitored_scan(self):
+        """Context manager for a walk of the working directory
+
+        If the file system monitor is running, only directories with changes
+        reported since the last walk are walked again inside the context,
+        and the tree hashes of all other directories are reused from the
+        index. Otherwise every directory is walked. Ignore files are read
+        again for every walk.
+        """
+        self.ignore.reset()
+        ignore_key = self.ignore.global_key()
+        since = self.index.monitor_state
+        with self.stats.timer('monitor'):
+            state, self._changes = monitor.read_changes(
+                self._join_root(self.FILES['journal']),
+                since, self.MONITOR_TIMEOUT,
+            )
+
+        # Changed ignore files change what is walked under their directory
+        if self._changes is not None and since[2:] != (ignore_key,):
+            self._changes = None
+        if self._changes is not None:
+            for path in list(self._changes.dirty):
+                if posixpath.basename(path) == ignore.IGNORE_FILE:
+                    self._changes.add(
+                        posixpath.dirname(path) or '.', recursive=True
+                    )
+        try:
+            yield
+        finally:
+            self._changes = None
+
+        # The tree hashes in the index are now valid as of this state
+        if state is not None:
+            state += (ignore_key,)
+        self.index.set_monitor_state(state)
+
+    def _unchanged_tree_hash(self, directory, stored=False):
+        """Returns the saved tree hash of an unchanged directory or None
+
+        If stored, the tree object must also exist, which guarantees that
+        everything under the directory has been stored as well.
+        """
+        if self._changes is None or self._changes.is_dirty(directory):
+            return None
+        tree_hash = self.index.trees.get(directory)
+        if tree_hash is None:
+            return None
+        if stored and not self._object_exists(tree_hash):
+            return None
+
+        self.index.keep_tree(directory)
+        self.stats.count('trees_unchanged')
+        return tree_hash
+
+    def _check_dirty(self, target_hash):
+        """Raises exception if a checkout would lose changes since last save
+
+        Untracked files, including ignored files, are kept by a checkout and
+        only count if the target snapshot has a path where one is.
+
+        Raises:
+          DirtyDirectoryException: If changes made since last save
+        """
+        if self._checkout_blocked(target_hash):
             # Changes have been made and we want to warn the user
             raise DirtyDirectoryException(
                 'Changes have been made to the directory. '
                 'Use force option to overwrite.'
             )
 
+    def _checkout_blocked(self, target_hash):
+        """Check if a checkout of a snapshot would lose changes
+
+        Changes of tracked files always count. Untracked files only count
+        if the target snapshot has a path where one is, and ignored files
+        only if they are in the way of a file of the target snapshot.
+        """
+        cur_hash, _ = self._current_snapshot_hash()
+        with utils.temp_wd(self.root_dir), self._monitored_scan():
+            dir_hash = self._get_tree_hash('.')
+            blocked = any(
+                change.status != ADDED or
+                self._tree_has_path(target_hash, change.path)
+                for change in self._tree_changes(
+                    cur_hash, dir_hash, '.', self._working_tree_entries
+                )
+            ) or any(
+                self._path_in_way(change.path, cur_hash)
+                for change in self._tree_changes(cur_hash, target_hash, '.')
+                if change.status != REMOVED
+            )
+
+        # Save the refreshed stat data of every file that was walked
+        self.index.prune()
+        self.index.save()
+        return blocked
+
+    def _path_in_way(self, path, cur_hash):
+        """Check if untracked paths are in the way of writing a file
+
+        Paths left in a directory that becomes the file, or a file where a
+        directory of the file goes, would have to be removed. Paths of the
+        current snapshot are removed by the checkout itself.
+        """
+        parts = path.split('/')
+        tree_hash = cur_hash
+        for depth, name in enumerate(parts, 1):
+            obj_type, obj_hash = None, None
+            if tree_hash is not None:
+                obj_type, obj_hash = self._tree_entries(tree_hash, None).get(
+                    name, (None, None)
+                )
+            current_path = '/'.join(parts[:depth])
+            try:
+                mode = os.lstat(current_path).st_mode
+            except FileNotFoundError:
+                return False
+            if not stat.S_ISDIR(mode):
+                return obj_type != 'blob'
+            tree_hash = obj_hash if obj_type == 'tree' else None
+        return self._has_untracked(path, tree_hash)
+
+    def _has_untracked(self, directory, tree_hash):
+        """Check if a directory holds any path a tree object does not"""
+        tracked = {}
+        if tree_hash is not None:
+            tracked = self._tree_entries(tree_hash, directory)
+        for entry in os.scandir(directory):
+            obj_type, obj_hash = tracked.get(entry.name, (None, None))
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if obj_type == 'tree' and is_dir:
+                if self._has_untracked(
+                        utils.posixjoin(directory, entry.name), obj_hash):
+                    return True
+            elif obj_type != 'blob' or is_dir:
+                return True
+        return False
+
+    def _tree_has_path(self, tree_hash, path):
+        """Check if a tree has an entry at a path or a file above it"""
+        for name in path.split('/'):
+            if tree_hash is None:
+                return False
+            obj_type, tree_hash = self._tree_entries(tree_hash, None).get(
+                name, (None, None)
+            )
+            if obj_type == 'blob':
+                return True
+        return tree_hash is not None
+
+    def _snapshot_row(self, identifier=None):
+        """Returns the sqlite.Row of a snapshot, the current one if None
+
+        The row of the branch is returned if a branch name is given.
+
+        Raises:
+          InvalidHashException: If not a single unique hash is found
+        """
+        branch = None
+        if identifier is None:
+            snapshot_hash, detached = self._current_snapshot_hash()
+            if not detached:
+                branch = self.current_branch()
+        else:
+            snapshot_hash = self._resolve_snapshot(identifier)
+            if identifier in self.list_branches():
+                branch = identifier
+
+        with self.stats.timer('snapshotdb'):
+            row = ssdb.execute(
+                self._join_root(self.FILES['snapshots']),
+                ssdb.SELECT_SNAPSHOT,
+                {'hash': snapshot_hash, 'branch': branch},
+                row_factory=ssdb.Row, cursor='fetchone',
+            )
+        if row is None:
+            raise InvalidHashException(
+                'No snapshots found for: {}'.format(identifier), []
+            )
+        return row
+
+    def _checkout_base(self, target_hash, force=False):
+        """Returns the current snapshot hash and if it must be rebuilt
+
+        The directory is rebuilt completely if a forced checkout would lose
+        changes. Unless forced, the caller is expected to have already
+        checked that the directory is not dirty.
+        """
+        old_hash, _ = self._current_snapshot_hash()
+        return old_hash, force and self._checkout_blocked(target_hash)
+
+    def _resolve_snapshot(self, identifier):
+        """Returns the snapshot hash of a branch name or a partial hash
+
+        Raises:
+          InvalidHashException: If not a single unique hash is found
+        """
+        if identifier in self.list_branches():
+            return self._get_branch_head(identifier)
+        return self._full_hash(identifier)
+
     def _full_hash(self, partial):
         """Returns a unique full snapshot hash from from a partial hash
 
         Raises:
           InvalidHashException: If not a single unique hash is found
         """
-        snapshots = self.list_snapshots()
-        matches = utils.get_matches(
-            partial, [row['hash'] for row in snapshots],
-        )
+        # Distinct hashes only, snapshots of the same hash on different
+        # branches are the same snapshot for checking out
+        with self.stats.timer('snapshotdb'):
+            matches = ssdb.prefix_matches(
+                self._join_root(self.FILES['snapshots']), partial.lower(),
+                self.MAX_MATCHES,
+            )
 
         if len(matches) < 1:
             raise InvalidHashException(
@@ -292,14 +1189,6 @@ class Repository:
             )
 
         if len(matches) > 1:
-            # If multiple matches are all the same, pick the first
-            # (All should be the same, just different branch names, which
-            #  we don't care about at the moment as we're not checking out)
-            if len(set(matches)) == 1:
-                # Matches have the same hash
-                return matches[0]
-
-            print([(row['hash'], row['branch']) for row in snapshots])
             raise InvalidHashException(
                 'No unique match for: {}'.format(partial), matches
             )
@@ -307,64 +1196,715 @@ class Repository:
         # Get the full matched hash
         return matches[0]
 
-    def _update_files(self):
+    def _update_files(self, old_hash, rebuild=False, new_hash=None):
         """Updates directory with the files for the given snapshot
 
-        Clears out the entire directory, then rebuilds the directory from
-        the repository. Would be better in the future to probably only
-        overwrite files that needed updates and remove files that no longer
-        should be there, but this was simple and I can optimize later if
-        it needs better performance.
+        The old hash is the snapshot the directory was checked out from,
+        None for a new repository, and the new hash the snapshot to check
+        out, the current snapshot if None. Only the paths that differ
+        between the two snapshots are touched, unless rebuilding. Otherwise
+        removes every path of the old snapshot, then rebuilds the directory
+        from the repository. Untracked and ignored paths are kept either
+        way, unless they are in the way of a path of the new snapshot.
         """
-        # Get all files and directories for this level (excluding repo)
-        directories = utils.list_directories(self.root_dir, [self.REPO_DIR])
-        files = utils.list_files(self.root_dir)
+        # Get hash of the snapshot to check out
+        top_hash = new_hash
+        if top_hash is None:
+            top_hash, _ = self._current_snapshot_hash()
+
+        if old_hash is not None and not rebuild:
+            with utils.temp_wd(self.root_dir), \
+                    self._held_renames(old_hash, top_hash), \
+                    self._blob_writer():
+                self._checkout_tree_diff(
+                    old_hash, top_hash, '.', bool(self.sparse)
+                )
+
+            # Save the updated hashcache and the stat data of written files
+            self._save_objhashcache()
+            self.index.save()
+            return
 
-        # Remove all of these files and recursively remove directories
-        # Remove files
-        for file in files:
-            os.remove(self._join_root(file))
-        # Remove directories
-        for directory in directories:
-            shutil.rmtree(self._join_root(directory))
+        # Remove the files and directories of the old snapshot
+        if old_hash is not None:
+            with utils.temp_wd(self.root_dir):
+                self._remove_tree(old_hash, '.')
 
         # Clears the current hashcache; must be rebuild along with files
-        self.objhashcache = {}
-
-        # Get hash of the current snapshot
-        top_hash, _ = self._current_snapshot_hash()
+        self.objhashcache.clear()
+        self.index.clear_sparse()
 
-        self._build_tree(top_hash, self.root_dir)
+        with utils.temp_wd(self.root_dir), self._blob_writer():
+            self._build_tree(top_hash, '.', bool(self.sparse))
 
-        # Save the rebuilt hashcache
+        # Save the rebuilt hashcache and the stat data of every written file
         self._save_objhashcache()
+        self.index.prune()
+        self.index.save()
+
+    @profiling.timed('checkout_tree_diff')
+    def _checkout_tree_diff(self, old_hash, new_hash, current_path,
+                            partial=False):
+        """Recursive function to update a directory between two trees
+
+        Walks the old and new tree objects together, skipping any entries
+        (including whole subtrees) whose hashes match, and only creates,
+        updates or removes the paths that changed. In a partial directory
+        only the entries the sparse patterns select are touched. Returns
+        False if a partial directory was removed for having no materialized
+        entries.
+        """
+        if old_hash == new_hash:
+            return not partial or current_path in self.index.sparse
 
-    def _build_tree(self, node_hash, current_path):
-        """Recursive function to rebuild file structure for objects"""
-        content = self._read_object(node_hash).decode().rstrip()
+        old_entries = {
+            obj_name: (obj_type, obj_hash)
+            for obj_type, obj_hash, obj_name in self._read_tree(old_hash)
+        }
+        new_entries = {
+            obj_name: (obj_type, obj_hash)
+            for obj_type, obj_hash, obj_name in self._read_tree(new_hash)
+        }
 
-        for line in content.split('\n'):
-            obj_type, obj_hash, obj_name = self._parse_tree_line(line)
-            new_path = os.path.join(current_path, obj_name)
+        # Remove paths that no longer exist or have changed type first
+        for obj_name, (obj_type, obj_hash) in old_entries.items():
+            new_entry = new_entries.get(obj_name)
+            if new_entry is None or new_entry[0] != obj_type:
+                old_path = utils.posixjoin(current_path, obj_name)
+                if not self._on_disk(old_path, obj_type, partial):
+                    # Never materialized, only forget the cached hashes
+                    self.objhashcache.remove_tree(old_path)
+                    continue
+                self._remove_path(old_path, obj_type, obj_hash)
+
+        sparse_entries = []
+        for obj_name, (obj_type, obj_hash) in new_entries.items():
+            old_entry = old_entries.get(obj_name)
+            new_path = utils.posixjoin(current_path, obj_name)
 
             # Add the new file or directory to the objhashcache
             self.objhashcache[new_path] = obj_hash
 
-            # Process each type of object
+            # Nothing to do if the entry is unchanged or not materialized,
+            # partial directories without materialized entries were removed
+            mode = self._sparse_mode(new_path, obj_type, partial)
+            materialized = mode != sparse.EXCLUDED
+            if old_entry == (obj_type, obj_hash):
+                if mode == sparse.PARTIAL:
+                    materialized = new_path in self.index.sparse
+            elif mode != sparse.EXCLUDED or (
+                    old_entry is not None and old_entry[0] == obj_type and
+                    self._on_disk(new_path, obj_type, partial)):
+                # Paths created in place of entries that were not
+                # materialized are updated, but nothing is added
+                if obj_type == 'tree':
+                    self._make_directory(new_path)
+                    if old_entry is None or old_entry[0] != 'tree':
+                        # Build a directory that did not exist before
+                        kept = self._build_tree(
+                            obj_hash, new_path, mode != sparse.FULL
+                        )
+                    else:
+                        # Recursively update the changed directory, which
+                        # may have been removed since
+                        kept = self._checkout_tree_diff(
+                            old_entry[1], obj_hash, new_path,
+                            mode != sparse.FULL,
+                        )
+                    materialized = materialized and kept
+                if obj_type == 'blob':
+                    self._write_blob(obj_hash, new_path)
+            if partial:
+                sparse_entries.append(
+                    (obj_type, obj_hash, obj_name, materialized)
+                )
+
+        # Keep the entries that were not materialized as references
+        if partial:
+            return self._keep_partial_tree(current_path, sparse_entries)
+        return True
+
+    def _tree_changes(self, old_hash, new_hash, current_path, new_entries=None):
+        """Recursively yields the changed files between two trees
+
+        Walks both trees together and skips any entries (including whole
+        subtrees) whose hashes match. Either hash may be None for a tree
+        that does not exist. Entries of the new tree are read with
+        new_entries(hash, path), tree objects are read by default.
+        """
+        if old_hash == new_hash:
+            return
+        if new_entries is None:
+            new_entries = self._tree_entries
+
+        old_tree = {}
+        if old_hash is not None:
+            old_tree = self._tree_entries(old_hash, current_path)
+        new_tree = {}
+        if new_hash is not None:
+            new_tree = new_entries(new_hash, current_path)
+
+        for obj_name in sorted(old_tree.keys() | new_tree.keys()):
+            old_type, old_obj = old_tree.get(obj_name, (None, None))
+            new_type, new_obj = new_tree.get(obj_name, (None, None))
+            path = utils.posixjoin(current_path, obj_name)
+            if (old_type, old_obj) == (new_type, new_obj):
+                continue
+
+            if old_type == 'blob' and new_type == 'blob':
+                yield Change(MODIFIED, path, old_obj, new_obj)
+                continue
+
+            # A path that changed type is removed before it is added again
+            if old_type == 'blob':
+                yield Change(REMOVED, path, old_obj, None)
+            if old_type == 'tree' or new_type == 'tree':
+                yield from self._tree_changes(
+                    old_obj if old_type == 'tree' else None,
+                    new_obj if new_type == 'tree' else None,
+                    path, new_entries,
+                )
+            if new_type == 'blob':
+                yield Change(ADDED, path, None, new_obj)
+
+    def _tree_entries(self, node_hash, path):
+        """Returns {name: (type, hash)} of the entries of a tree object"""
+        return {
+            obj_name: (obj_type, obj_hash)
+            for obj_type, obj_hash, obj_name in self._read_tree(node_hash)
+        }
+
+    def _working_tree_entries(self, node_hash, path):
+        """Returns {name: (type, hash)} of the entries of a directory
+
+        Tree hashes are taken from the index, so the directory must have
+        been hashed with _get_tree_hash first.
+        """
+        listing = self._scan_directory(path)
+        entries = {}
+        for entry in listing.directories:
+            subdir_path = utils.posixjoin(path, entry.name)
+            tree_hash = self.index.trees.get(subdir_path)
+            if tree_hash is None:
+                # Created since the directory was hashed
+                tree_hash = self._get_tree_hash(subdir_path)
+            entries[entry.name] = ('tree', tree_hash)
+        for entry in listing.files:
+            blob_hash = self._get_blob_hash(
+                utils.posixjoin(path, entry.name), utils.stat_entry(entry)
+            )
+            entries[entry.name] = ('blob', blob_hash)
+
+        # Entries a sparse checkout did not materialize are unchanged
+        for obj_type, obj_hash, obj_name, materialized in \
+                self._sparse_stored_entries(path) or ():
+            if not materialized and obj_name not in entries:
+                entries[obj_name] = (obj_type, obj_hash)
+        return entries
+
+    def _change_stats(self, change, working=False):
+        """Returns a change with sizes of both versions and of their patch
+
+        The new version is read from the directory if working is True.
+        """
+        old_content = b''
+        if change.old_hash is not None:
+            old_content = self._read_object(change.old_hash)
+        new_content = b''
+        if change.new_hash is not None and working:
+            with open(self._join_root(change.path), 'rb') as new_file:
+                new_content = new_file.read()
+        elif change.new_hash is not None:
+            new_content = self._read_object(change.new_hash)
+
+        return change._replace(
+            stats=bindifflib.diff_stats(
+                new_content, old_content, self.delta_engine, self.delta_memory
+            )
+        )
+
+    @profiling.timed('detect_renames')
+    def _detect_renames(self, changes, working=False):
+        """Returns the changes with removed and added files paired as renames
+
+        Files with identical content are paired first, then the remaining
+        files by the similarity of their fingerprints, most similar first.
+        A rename replaces the added file and the removed file is dropped.
+        The added files are read from the directory if working is True.
+        """
+        removed = [change for change in changes if change.status == REMOVED]
+        added = [change for change in changes if change.status == ADDED]
+        if not removed or not added:
+            return changes
+
+        # Pair files with identical content
+        removed_by_hash = collections.defaultdict(list)
+        for change in removed:
+            removed_by_hash[change.old_hash].append(change)
+        pairs = {}
+        for change in added:
+            if removed_by_hash[change.new_hash]:
+                pairs[change.path] = removed_by_hash[change.new_hash].pop(0)
+
+        # Pair similar files, unless there are too many to compare
+        paired = {change.path for change in pairs.values()}
+        removed = [change for change in removed if change.path not in paired]
+        added = [change for change in added if change.path not in pairs]
+        if (self.similarity_window and removed and added and
+                len(removed) <= self.MAX_RENAME_CANDIDATES and
+                len(added) <= self.MAX_RENAME_CANDIDATES):
+            old_sketches = [
+                (change, self._content_sketch(change.old_hash))
+                for change in removed
+            ]
+            scores = []
+            for new_change in added:
+                new_sketch = self._content_sketch(
+                    new_change.new_hash, new_change.path if working else None
+                )
+                if new_sketch is None:
+                    continue
+                for old_change, old_sketch in old_sketches:
+                    if old_sketch is None:
+                        continue
+                    score = similarity.similarity(new_sketch, old_sketch)
+                    if score >= self.MIN_SIMILARITY:
+                        scores.append((-score, new_change.path, old_change))
+            for _, new_path, old_change in sorted(
+                    scores, key=lambda item: item[:2]):
+                if new_path not in pairs and old_change.path not in paired:
+                    pairs[new_path] = old_change
+                    paired.add(old_change.path)
+
+        renames = []
+        for change in changes:
+            if change.status == REMOVED and change.path in paired:
+                continue
+            old_change = pairs.get(change.path)
+            if change.status == ADDED and old_change is not None:
+                change = change._replace(
+                    status=RENAMED, old_hash=old_change.old_hash,
+                    old_path=old_change.path,
+                )
+            renames.append(change)
+        return renames
+
+    def _content_sketch(self, obj_hash, path=None):
+        """Returns the fingerprint of an object or of the file at path
+
+        Returns None if the content is too small to be compared.
+        """
+        if path is None:
+            sketch = self.fingerprints.get(obj_hash)
+            if sketch is not None:
+                return sketch
+            content = self._read_object(obj_hash)
+        else:
+            with open(self._join_root(path), 'rb') as input_file:
+                content = input_file.read()
+
+        if len(content) < self.MIN_SIMILARITY_SIZE:
+            return None
+        return similarity.fingerprint(content)
+
+    @contextlib.contextmanager
+    def _held_renames(self, old_hash, new_hash):
+        """Context manager to move renamed files instead of rebuilding them
+
+        Unmodified files of the old snapshot whose content is added at
+        another path by the new snapshot are moved to the staging directory
+        before the directory is updated. _write_blob then moves them into
+        place and _remove_path leaves them alone. Held files that were not
+        used are removed when the context exits.
+        """
+        changes = list(self._tree_changes(old_hash, new_hash, '.'))
+        added = {
+            change.new_hash for change in changes if change.status == ADDED
+        }
+
+        staging_dir = self._join_root(self.DIRS['staging'])
+        os.makedirs(staging_dir, exist_ok=True)
+        self._held_blobs = collections.defaultdict(list)
+        self._held_paths = set()
+        try:
+            for change in changes:
+                if change.status != REMOVED or change.old_hash not in added:
+                    continue
+
+                # Only hold files that still match the old snapshot
+                try:
+                    stat_result = os.stat(change.path)
+                except FileNotFoundError:
+                    continue
+                if self.index.lookup(change.path, stat_result) != \
+                        change.old_hash:
+                    continue
+
+                temp_fd, temp_path = tempfile.mkstemp(
+                    suffix='.tmp', dir=staging_dir
+                )
+                os.close(temp_fd)
+                os.replace(change.path, temp_path)
+                self._held_blobs[change.old_hash].append(temp_path)
+                self._held_paths.add(change.path)
+            yield
+        finally:
+            for temp_paths in self._held_blobs.values():
+                for temp_path in temp_paths:
+                    os.remove(temp_path)
+            self._held_blobs = None
+            self._held_paths = set()
+
+    def _remove_path(self, path, obj_type, obj_hash):
+        """Removes a file or directory and forgets any cached hashes"""
+        if obj_type == 'tree':
+            self._remove_tree(obj_hash, path)
+        elif path not in self._held_paths and os.path.lexists(path):
+            os.remove(path)
+
+        # Remove the path and anything under it from the caches
+        self.objhashcache.remove_tree(path)
+        self.index.remove_tree(path)
+
+    def _remove_tree(self, node_hash, directory):
+        """Removes the paths of a tree object from a directory
+
+        Untracked and ignored paths are left alone, as are paths that are
+        no longer files or directories. The directory itself is removed if
+        nothing else is left in it.
+        """
+        for obj_type, obj_hash, obj_name in self._read_tree(node_hash):
+            path = utils.posixjoin(directory, obj_name)
             if obj_type == 'tree':
+                if os.path.isdir(path) and not os.path.islink(path):
+                    self._remove_tree(obj_hash, path)
+            elif path not in self._held_paths and (
+                    os.path.islink(path) or os.path.isfile(path)):
+                os.remove(path)
+
+        if directory != '.':
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Untracked and ignored paths are left in the directory
+                pass
+
+    @profiling.timed('build_tree')
+    def _build_tree(self, node_hash, current_path, partial=False):
+        """Recursive function to rebuild file structure for objects
+
+        In a partial directory only the entries the sparse patterns select
+        are rebuilt. Returns False if a partial directory was removed for
+        having no materialized entries.
+        """
+        sparse_entries = []
+        for obj_type, obj_hash, obj_name in self._read_tree(node_hash):
+            new_path = utils.posixjoin(current_path, obj_name)
+
+            # Add the new file or directory to the objhashcache
+            self.objhashcache[new_path] = obj_hash
+
+            # Skip entries that are not materialized
+            mode = self._sparse_mode(new_path, obj_type, partial)
+            materialized = mode != sparse.EXCLUDED
+
+            # Process each type of object
+            if obj_type == 'tree' and materialized:
+                # Make the directory, which may remain with ignored paths
+                self._make_directory(new_path)
                 # Make the directory
-                os.makedirs(new_path)
-                # Make the directory
-                self._build_tree(obj_hash, new_path)
-            if obj_type == 'blob':
+                materialized = self._build_tree(
+                    obj_hash, new_path, mode == sparse.PARTIAL
+                )
+            if obj_type == 'blob' and materialized:
                 # Rebuild the file
-                with open(new_path, 'wb') as obj_file:
-                    obj_file.write(self._read_object(obj_hash))
+                self._write_blob(obj_hash, new_path)
+            if partial:
+                sparse_entries.append(
+                    (obj_type, obj_hash, obj_name, materialized)
+                )
+
+        # Keep the entries that were not materialized as references
+        if partial:
+            return self._keep_partial_tree(current_path, sparse_entries)
+        return True
+
+    def _keep_partial_tree(self, directory, sparse_entries):
+        """Records the entries of a partial directory, returns if it is kept
+
+        A directory without any materialized entries is removed again, and
+        its parent keeps the whole tree as a reference instead, so patterns
+        matching in any directory do not leave every directory on disk.
+        """
+        if directory != '.' and not any(
+                materialized for _, _, _, materialized in sparse_entries):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Untracked and ignored paths are left in the directory
+                pass
+            self.index.remove_tree(directory)
+            return False
+        self.index.set_sparse_tree(directory, sparse_entries)
+        return True
+
+    def _restore_sparse_trees(self):
+        """Restores the sparse trees of a lost index from the snapshot
+
+        The index is a cache that may be lost, but the sparse trees are the
+        only record of the paths a sparse checkout did not materialize. A
+        sparse checkout always records the top directory, so without it the
+        sparse trees are recorded again from the current snapshot and the
+        patterns, as the checkout recorded them.
+        """
+        if not self.sparse or '.' in self.index.sparse:
+            return
+        cur_hash, _ = self._current_snapshot_hash()
+        if cur_hash is None:
+            return
+        with utils.temp_wd(self.root_dir):
+            self._restore_partial_tree(cur_hash, '.')
+        self.index.save()
 
-    def _parse_tree_line(self, line):
-        """Parses each line in a tree object"""
-        clean = line.rstrip()
-        return clean[:5].rstrip(), clean[5:46].rstrip(), clean[46:].rstrip()
+    def _restore_partial_tree(self, node_hash, directory):
+        """Records the entries of a partial directory without writing them
+
+        Returns False if the directory has no materialized entries.
+        """
+        sparse_entries = []
+        for obj_type, obj_hash, obj_name in self._read_tree(node_hash):
+            path = utils.posixjoin(directory, obj_name)
+            mode = self._sparse_mode(path, obj_type, True)
+            materialized = mode != sparse.EXCLUDED
+            if mode == sparse.PARTIAL:
+                materialized = self._restore_partial_tree(obj_hash, path)
+            sparse_entries.append(
+                (obj_type, obj_hash, obj_name, materialized)
+            )
+        return self._keep_partial_tree(directory, sparse_entries)
+
+    def _make_directory(self, path):
+        """Creates a directory, replacing a file left in its place
+
+        Unless forced, a checkout is blocked when an untracked file is in
+        the way.
+        """
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+        os.makedirs(path, exist_ok=True)
+
+    def _on_disk(self, path, obj_type, partial):
+        """Check if an entry of a tree was materialized or created on disk"""
+        if self._sparse_mode(path, obj_type, partial) != sparse.EXCLUDED:
+            return True
+        return os.path.lexists(path) or path in self._held_paths
+
+    def _sparse_mode(self, path, obj_type, partial):
+        """Returns the sparse.FULL, PARTIAL or EXCLUDED mode of an entry
+
+        Entries of directories that are not partial are always FULL, as are
+        the ignore files of partial directories, whose rules apply to the
+        paths on disk.
+        """
+        if not partial:
+            return sparse.FULL
+        if obj_type == 'blob' and \
+                posixpath.basename(path) == ignore.IGNORE_FILE:
+            return sparse.FULL
+        return self.sparse.mode(path, obj_type == 'tree')
+
+    def _sparse_entries(self, directory, node_entries):
+        """Returns the (type, hash, name) of a directory with its references
+
+        The entries of a partial directory that were not materialized keep
+        their hashes in the snapshot, unless a path was created in their
+        place. Directories created in place of a tree that was not
+        materialized are merged with that tree the same way. Entries keep
+        the order of the snapshot, followed by any new entries.
+        """
+        stored = self._sparse_stored_entries(directory)
+        if stored is None:
+            return node_entries
+
+        on_disk = {
+            obj_name: (obj_type, obj_hash)
+            for obj_type, obj_hash, obj_name in node_entries
+        }
+        merged = []
+        for obj_type, obj_hash, obj_name, materialized in stored:
+            if obj_name in on_disk:
+                merged.append(on_disk.pop(obj_name) + (obj_name,))
+            elif not materialized:
+                merged.append((obj_type, obj_hash, obj_name))
+        merged.extend(
+            entry for entry in node_entries if entry[2] in on_disk
+        )
+        return merged
+
+    def _sparse_stored_entries(self, directory):
+        """Returns the (type, hash, name, materialized) a directory stores
+
+        Returns None unless the directory is partial or inside a tree that
+        was not materialized, in which case none of its entries are.
+        """
+        if not self.index.sparse:
+            return None
+        stored = self.index.sparse.get(directory)
+        if stored is not None or directory == '.':
+            return stored
+
+        # Look up the directory in the stored entries of its parent
+        parent_entries = self._sparse_stored_entries(
+            posixpath.dirname(directory) or '.'
+        )
+        name = posixpath.basename(directory)
+        for obj_type, obj_hash, obj_name, materialized in \
+                parent_entries or ():
+            if obj_name == name and obj_type == 'tree' and not materialized:
+                return [
+                    (entry_type, entry_hash, entry_name, False)
+                    for entry_type, entry_hash, entry_name
+                    in self._read_tree(obj_hash)
+                ]
+        return None
+
+    def _archive_entries(self, node_hash, current_path):
+        """Recursively yields the (path, type, size, pieces) of a tree
+
+        The pieces of each blob are only read as they are consumed.
+        """
+        for obj_type, obj_hash, obj_name in self._read_tree(node_hash):
+            new_path = utils.posixjoin(current_path, obj_name)
+            if obj_type == 'tree':
+                yield new_path, obj_type, 0, ()
+                yield from self._archive_entries(obj_hash, new_path)
+            if obj_type == 'blob':
+                yield (
+                    new_path, obj_type, self._object_length(obj_hash),
+                    self._iter_object(obj_hash),
+                )
+
+    def _object_length(self, obj_hash):
+        """Returns the length of the content of an object"""
+        header = self._read_object_header(obj_hash)
+        if header.length is None:
+            # Legacy deltas do not record the length of their content
+            return len(self._read_object(obj_hash))
+        return header.length
+
+    def _bundle_snapshot(self, row):
+        """Returns the data of a snapshot row and its renames for a bundle"""
+        with self.stats.timer('snapshotdb'):
+            renames = ssdb.execute(
+                self._join_root(self.FILES['snapshots']), ssdb.SELECT_RENAMES,
+                {'snapshot': row['hash']}, row_factory=ssdb.Row,
+                cursor='fetchall',
+            )
+        data = {
+            key: row[key]
+            for key in ('hash', 'branch', 'message', 'user', 'timestamp')
+        }
+        data['renames'] = [
+            dict(zip(rename.keys(), rename)) for rename in renames
+        ]
+        return data
+
+    def _bundle_object(self, obj_hash):
+        """Returns the stored content of an object with an object header
+
+        Objects of repositories older than format version 2 may have no
+        header, so they are bundled as full copies.
+        """
+        if self.format_version < 2:
+            return self._encode_full(self._read_object(obj_hash))
+        return bytes(self._read_raw_object(obj_hash))
+
+    def _write_blob(self, obj_hash, path):
+        """Writes the content of a blob object to the given file path
+
+        Inside of a concurrent _blob_writer the blob is only queued, and a
+        file held by _held_renames with the same content is moved instead.
+        A directory left in the place of the file is removed, which unless
+        forced only happens when it is empty.
+        """
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+
+        held = self._held_blobs
+        if held is not None and held.get(obj_hash):
+            os.replace(held[obj_hash].pop(), path)
+            self.stats.count('files_moved')
+            self.index.update(path, os.stat(path), obj_hash)
+            return
+        if self._pending_blobs is not None:
+            self._pending_blobs.append((obj_hash, path))
+            return
+        stat_result = self._materialize_blob(obj_hash, path)
+        self.index.update(path, stat_result, obj_hash)
+
+    def _materialize_blob(self, obj_hash, path):
+        """Rebuilds a blob into a file and returns the stat of the file"""
+        with open(path, 'wb') as obj_file:
+            for content in self._iter_object(obj_hash):
+                obj_file.write(content)
+        return os.stat(path)
+
+    def _iter_object(self, obj_hash):
+        """Yields the content of an object in pieces
+
+        Chunked objects are yielded one chunk at a time so they are never
+        held in memory at once, any other object is yielded whole.
+        """
+        header = self._read_object_header(obj_hash)
+        if header.type != objects.CHUNKED:
+            yield self._read_object(obj_hash)
+            return
+
+        _, payload = self._decode_object(
+            obj_hash, self._read_raw_object(obj_hash)
+        )
+        for chunk_hash, _ in objects.decode_chunk_list(payload):
+            yield self._read_object(chunk_hash)
+
+    @contextlib.contextmanager
+    def _blob_writer(self):
+        """Context manager to restore blobs concurrently when using workers
+
+        Blobs written inside the context are queued while the directory
+        skeleton is created, then rebuilt and written by a pool of threads
+        when the context exits. The stat data of the written files is merged
+        into the index afterwards in the order the blobs were queued.
+        """
+        if self.workers <= 1:
+            yield
+            return
+
+        self._pending_blobs = []
+        try:
+            yield
+            pending = self._pending_blobs
+        finally:
+            self._pending_blobs = None
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            stat_results = list(pool.map(
+                lambda blob: self._materialize_blob(*blob), pending
+            ))
+
+        for (obj_hash, path), stat_result in zip(pending, stat_results):
+            self.index.update(path, stat_result, obj_hash)
+
+    def _read_tree(self, node_hash):
+        """Returns the list of TreeEntry of a binary or text tree object
+
+        Entries unpack as (type, hash, name). Parsed trees are cached and
+        shared, so the list must not be modified.
+        """
+        entries = self.tree_cache.get(node_hash)
+        if entries is None:
+            entries = trees.decode(self._read_object(node_hash))
+            self.tree_cache.put(node_hash, entries)
+        return entries
 
     def _join_root(self, rel_path):
         """Return a joined relative path with the instance root directory"""
@@ -375,15 +1915,56 @@ class Repository:
         with open(self.FILES['head'], 'w') as head_file:
             head_file.write(branch_name)
 
+    @profiling.timed('objhashcache')
     def _save_objhashcache(self):
-        """Saves the current state of the hashmap"""
-        with open(self.FILES['objhashcache'], 'wb') as hash_file:
-            pickle.dump(self.objhashcache, hash_file)
+        """Saves the changed entries of the hashmap and new fingerprints"""
+        self.objhashcache.save()
+        self.fingerprints.save()
+
+    def _load_format_version(self):
+        """Returns the object format version of the repository"""
+        try:
+            with open(self._join_root(self.FILES['format']), 'r') as fmt_file:
+                return int(fmt_file.read().strip())
+        except FileNotFoundError:
+            return 1
 
+    def _load_sparse(self):
+        """Returns the SparsePatterns of the sparse checkout"""
+        try:
+            with open(self._join_root(self.FILES['sparse']), 'r') as \
+                    sparse_file:
+                return sparse.SparsePatterns(sparse_file.read().splitlines())
+        except FileNotFoundError:
+            return sparse.SparsePatterns([])
+
+    def _save_sparse(self, patterns):
+        """Saves the patterns of the sparse checkout, removed if empty"""
+        sparse_path = self._join_root(self.FILES['sparse'])
+        if not patterns:
+            try:
+                os.remove(sparse_path)
+            except FileNotFoundError:
+                pass
+            return
+        with open(sparse_path + '.tmp', 'w') as sparse_file:
+            sparse_file.write(''.join(
+                pattern + '\n' for pattern in patterns
+            ))
+        os.replace(sparse_path + '.tmp', sparse_path)
+
+    def _save_format_version(self, version):
+        """Saves the object format version of the repository"""
+        fmt_path = self._join_root(self.FILES['format'])
+        with open(fmt_path + '.tmp', 'w') as fmt_file:
+            fmt_file.write(str(version))
+        os.replace(fmt_path + '.tmp', fmt_path)
+
+    @profiling.timed('objhashcache')
     def _load_hashmap(self):
-        """Loads a saved hashmap from a file"""
-        with open(self.FILES['objhashcache'], 'rb') as hash_file:
-            self.objhashcache = pickle.load(hash_file)
+        """Opens the saved hashmap, converting an older pickled hashmap"""
+        self.objhashcache.load()
+        self.fingerprints.load()
 
     def _current_snapshot_hash(self):
         """Returns the hash of the current snapshot and if it is detached"""
@@ -430,9 +2011,37 @@ class Repository:
         # Construct path to the reference file
         ref_path = self._join_root(os.path.join(self.DIRS['heads'], branch))
 
-        # Overwrite the reference file with the new hash
-        with open(ref_path, 'w') as ref_file:
+        # Replace the reference file with the new hash, a crash never
+        # leaves the branch without a reference
+        with open(ref_path + '.tmp', 'w') as ref_file:
             ref_file.write(new_hash)
+            ref_file.flush()
+            if self.FSYNC:
+                os.fsync(ref_file.fileno())
+        os.replace(ref_path + '.tmp', ref_path)
+
+    def _insert_renames(self, snapshot_hash, parent_hash):
+        """Records the renamed files of a snapshot in the snapshot database"""
+        changes = self._detect_renames(list(
+            self._tree_changes(parent_hash, snapshot_hash, '.')
+        ))
+        renames = [
+            {
+                'snapshot': snapshot_hash,
+                'old_path': change.old_path,
+                'new_path': change.path,
+                'old_hash': change.old_hash,
+                'new_hash': change.new_hash,
+            }
+            for change in changes if change.status == RENAMED
+        ]
+        if not renames:
+            return
+
+        with self.stats.timer('snapshotdb'):
+            con = ssdb.connect(self._join_root(self.FILES['snapshots']))
+            with con:
+                con.executemany(ssdb.INSERT_RENAME, renames)
 
     def _insert_snapshot(self, obj_hash, message='', user='', branch=None):
         """Updates snapshots database with snapshot data"""
@@ -445,121 +2054,423 @@ class Repository:
             'user': user,
         }
 
-        ssdb.execute(self.FILES['snapshots'], ssdb.INSERT, data, commit=True)
+        with self.stats.timer('snapshotdb'):
+            ssdb.execute(
+                self._join_root(self.FILES['snapshots']), ssdb.INSERT, data,
+                commit=True,
+            )
 
+    @profiling.timed('create_tree_node')
     def _create_tree_node(self, directory):
         """Recursive function creates tree nodes for current snapshot"""
-        # Validate the given root directory
-        if not os.path.isdir(directory):
-            raise ValueError('Not a directory: {}'.format(directory))
+        # Skip directories without changes since they were last stored
+        tree_hash = self._unchanged_tree_hash(directory, stored=True)
+        if tree_hash is not None:
+            return tree_hash
 
         # Get all files & directories for this level (excluding our pbb dir)
-        directories = utils.list_directories(directory, [self.REPO_DIR])
-        files = utils.list_files(directory)
+        listing = self._scan_directory(directory)
 
         node_entries = []
 
         # Recursively create nodes for subdirectories
-        for subdir in directories:
+        for entry in listing.directories:
             node_hash = self._create_tree_node(
-                utils.posixjoin(directory, subdir)
+                utils.posixjoin(directory, entry.name)
             )
-            node_entries.append('tree {} {}'.format(node_hash, subdir))
+            node_entries.append(('tree', node_hash, entry.name))
 
-        for file in files:
+        for entry in listing.files:
             node_hash = self._create_blob_node(
-                utils.posixjoin(directory, file)
+                utils.posixjoin(directory, entry.name),
+                utils.stat_entry(entry),
             )
-            node_entries.append('blob {} {}'.format(node_hash, file))
-
-        # Join node entries into the node content
-        node_content = '\n'.join(node_entries) + '\n'
+            node_entries.append(('blob', node_hash, entry.name))
 
         # Save the node contents to a vc object
-        return self._save_node(directory, node_content)
+        node_entries = self._sparse_entries(directory, node_entries)
+        tree_hash = self._save_node(
+            directory, self._tree_content(node_entries)
+        )
+        self.index.update_tree(directory, tree_hash)
+        return tree_hash
+
+    @profiling.timed('create_tree_node')
+    def _create_tree_node_parallel(self, directory):
+        """Creates tree nodes for current snapshot using a pool of workers
+
+        The directory structure is listed first, then all files are hashed
+        and stored concurrently by a pool of threads, with large deltas
+        computed in worker processes. Tree nodes are created afterwards
+        from the same listings as _create_tree_node, so the resulting tree
+        objects are identical to the serial path.
+        """
+        # List every directory, subdirectories before their parent
+        listings = []
+        tree_hashes = {}
+        self._list_tree(directory, listings, tree_hashes)
+
+        # Store all blobs concurrently
+        blob_entries = [
+            (utils.posixjoin(current_dir, entry.name), entry)
+            for current_dir, listing in listings
+            for entry in listing.files
+        ]
+        thread_pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        process_pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        with thread_pool, process_pool:
+            self._diff_executor = process_pool
+            try:
+                blob_hashes = dict(zip(
+                    (path for path, _ in blob_entries),
+                    thread_pool.map(
+                        lambda blob: self._create_blob_node(
+                            blob[0], utils.stat_entry(blob[1])
+                        ),
+                        blob_entries,
+                    ),
+                ))
+            finally:
+                self._diff_executor = None
+
+        # Create the tree nodes bottom up in a deterministic order
+        for current_dir, listing in listings:
+            node_entries = [
+                ('tree', tree_hashes[utils.posixjoin(current_dir, d.name)],
+                 d.name)
+                for d in listing.directories
+            ] + [
+                ('blob', blob_hashes[utils.posixjoin(current_dir, f.name)],
+                 f.name)
+                for f in listing.files
+            ]
+            node_entries = self._sparse_entries(current_dir, node_entries)
+            tree_hashes[current_dir] = self._save_node(
+                current_dir, self._tree_content(node_entries)
+            )
+            self.index.update_tree(current_dir, tree_hashes[current_dir])
+
+        return tree_hashes[directory]
+
+    def _list_tree(self, directory, listings, tree_hashes):
+        """Recursively lists (directory, Listing) in post-order
+
+        Directories without changes are not listed, their saved tree hashes
+        are added to tree_hashes instead.
+        """
+        # Skip directories without changes since they were last stored
+        tree_hash = self._unchanged_tree_hash(directory, stored=True)
+        if tree_hash is not None:
+            tree_hashes[directory] = tree_hash
+            return
+
+        # Get all files & directories for this level (excluding our pbb dir)
+        listing = self._scan_directory(directory)
+
+        for entry in listing.directories:
+            self._list_tree(
+                utils.posixjoin(directory, entry.name), listings, tree_hashes
+            )
+        listings.append((directory, listing))
+
+    def _create_blob_node(self, path, stat_result=None):
+        """Creates nodes for files in the current snapshot
+
+        The stat data of the file is read unless it is given.
+        """
+        # Skip reading files that are unchanged since they were last stored
+        if stat_result is None:
+            stat_result = os.stat(path)
+        digest = self.index.lookup(path, stat_result)
+        if digest is not None and self.objhashcache.get(path) == digest:
+            self.stats.count('files_unchanged')
+            return digest
+
+        # Large files are stored as chunks without reading them at once
+        if (self.chunk_threshold is not None and
+                stat_result.st_size >= self.chunk_threshold):
+            digest = self._save_chunked_node(path)
+            self.index.update(path, stat_result, digest)
+            return digest
 
-    def _create_blob_node(self, path):
-        """Creates nodes for files in the current snapshot"""
         with open(path, 'rb') as input_file:
             node_content = input_file.read()
 
         # Save the node contents to a vc object
-        return self._save_node(path, node_content)
+        digest = self._save_node(path, node_content, similar=True)
+        self.index.update(path, stat_result, digest)
+        return digest
+
+    def _save_chunked_node(self, path):
+        """Saves a file as content-defined chunks and a chunk list object
 
+        The file is streamed through the chunker, so memory use is bounded
+        by the maximum chunk size. Chunks already stored for any file or
+        snapshot are not written again. The hash of the chunk list object
+        is the hash of the whole file content, like any other blob.
+        """
+        hasher = hashlib.sha1()
+        chunks = []
+        with open(path, 'rb') as input_file:
+            for chunk in self.chunker.split(input_file):
+                hasher.update(chunk)
+                chunks.append((self._save_chunk(chunk), len(chunk)))
+        digest = hasher.hexdigest()
+
+        if not self._object_exists(digest):
+            self._write_object(digest, objects.encode(
+                objects.CHUNKED, objects.encode_chunk_list(chunks),
+                sum(length for _, length in chunks),
+            ))
+
+        # Update hashmap
+        self.objhashcache[path] = digest
+        return digest
+
+    def _save_chunk(self, chunk):
+        """Saves a single chunk as a full object and returns its hash"""
+        digest = self._hash_diget(chunk)
+        if not self._object_exists(digest):
+            self._write_object(digest, self._encode_full(chunk))
+        return digest
+
+    @profiling.timed('get_tree_hash')
     def _get_tree_hash(self, directory):
         """Recursively generate hashes of nodes for current directory"""
-        # Validate the given root directory
-        if not os.path.isdir(directory):
-            raise ValueError('Not a directory: {}'.format(directory))
+        # Skip directories without changes since they were last hashed
+        tree_hash = self._unchanged_tree_hash(directory)
+        if tree_hash is not None:
+            return tree_hash
 
         # Get all files & directories for this level (excluding our pbb dir)
-        directories = utils.list_directories(directory, [self.REPO_DIR])
-        files = utils.list_files(directory)
+        listing = self._scan_directory(directory)
 
         node_entries = []
 
         # Recursively create nodes for subdirectories
-        for subdir in directories:
+        for entry in listing.directories:
             node_hash = self._get_tree_hash(
-                utils.posixjoin(directory, subdir)
+                utils.posixjoin(directory, entry.name)
             )
-            node_entries.append('tree {} {}'.format(node_hash, subdir))
+            node_entries.append(('tree', node_hash, entry.name))
 
-        for file in files:
+        for entry in listing.files:
             node_hash = self._get_blob_hash(
-                utils.posixjoin(directory, file)
+                utils.posixjoin(directory, entry.name),
+                utils.stat_entry(entry),
             )
-            node_entries.append('blob {} {}'.format(node_hash, file))
-
-        # Join node entries into the node content
-        node_content = '\n'.join(node_entries) + '\n'
+            node_entries.append(('blob', node_hash, entry.name))
 
         # Get node content hash
-        return self._hash_diget(self._byte_convert(node_content))
+        node_entries = self._sparse_entries(directory, node_entries)
+        node_content = self._tree_content(node_entries)
+        tree_hash = self._hash_diget(self._byte_convert(node_content))
+        self.index.update_tree(directory, tree_hash)
+        return tree_hash
 
-    def _get_blob_hash(self, path):
-        """Get the hash for a given blob file at the path"""
-        with open(path, 'rb') as input_file:
-            node_content = input_file.read()
+    def _scan_directory(self, directory):
+        """Returns the Listing of a directory excluding our pbb dir
 
-        # Convert to bytes if necessary
-        bytes_content = self._byte_convert(node_content)
+        Ignored entries are left out, so nothing under them is ever read.
 
-        # Get node content hash
-        return self._hash_diget(bytes_content)
+        Raises:
+          ValueError: If the path is not a directory
+        """
+        try:
+            listing = utils.scan_directory(directory, [self.REPO_DIR])
+        except (FileNotFoundError, NotADirectoryError):
+            raise ValueError('Not a directory: {}'.format(directory))
+        return self.ignore.prune(directory, listing)
+
+    def _tree_content(self, node_entries):
+        """Returns the content of a tree node from (type, hash, name)
+
+        Repositories created before binary trees keep writing text trees,
+        so the hashes of unchanged directories stay the same.
+        """
+        if self.format_version >= 3:
+            return trees.encode(node_entries)
+        return trees.encode_text(node_entries)
+
+    def _get_blob_hash(self, path, stat_result=None):
+        """Get the hash for a given blob file at the path
+
+        The stat data of the file is read unless it is given.
+        """
+        # Only rehash files whose stat data changed since the last hash
+        if stat_result is None:
+            stat_result = os.stat(path)
+        digest = self.index.lookup(path, stat_result)
+        if digest is not None:
+            self.stats.count('files_unchanged')
+            return digest
+
+        # Get node content hash without reading the whole file at once
+        with self.stats.timer('hash'):
+            hasher = hashlib.sha1()
+            with open(path, 'rb') as input_file:
+                for block in iter(
+                        lambda: input_file.read(self.READ_SIZE), b''):
+                    hasher.update(block)
+            digest = hasher.hexdigest()
+        self.stats.count('bytes_hashed', stat_result.st_size)
+        self.stats.count('files_hashed')
+        self.index.update(path, stat_result, digest)
+        return digest
+
+    def _save_node(self, path, node_content, similar=False):
+        """Calculates a content hash and saves the content to a file
 
-    def _save_node(self, path, node_content):
-        """Calculates a content hash and saves the content to a file"""
+        If similar is True, a new object without a previous version at the
+        path may be stored as a delta of a similar object, and its
+        fingerprint is recorded as a base for later objects.
+        """
         # Convert to bytes if necessary
         bytes_content = self._byte_convert(node_content)
         # Get node content hash
         digest = self._hash_diget(bytes_content)
 
-        # Parse object directory and filename
-        obj_dir = self._join_root(
-            os.path.join(self.DIRS['objects'], digest[:2])
-        )
-        obj_path = os.path.join(obj_dir, digest[2:])
+        # Objects are never rewritten, a different base for the same content
+        # could otherwise create a cycle of deltas
+        if self._object_exists(digest):
+            self.objhashcache[path] = digest
+            return digest
 
-        # Make the directory if it does not exist
-        os.makedirs(obj_dir, exist_ok=True)
+        # Sample the content of files large enough to be worth a delta
+        sketch = None
+        if (similar and self.similarity_window and
+                len(bytes_content) >= self.MIN_SIMILARITY_SIZE):
+            with self.stats.timer('fingerprint'):
+                sketch = similarity.fingerprint(bytes_content)
 
         # Binary compress new files or return original if no reference
-        final_content = self._delta_compress(path, digest, bytes_content)
+        final_content = self._delta_compress(
+            path, digest, bytes_content, sketch
+        )
 
         # Return the hash with no further processing if no changes
         if final_content is None:
             return digest
 
         # Write the final content to the final object file
-        with open(obj_path, 'wb') as obj_file:
-            obj_file.write(final_content)
+        self._write_object(digest, final_content)
+        if sketch is not None:
+            self.fingerprints.add(digest, len(bytes_content), sketch)
 
         # Update hashmap
         self.objhashcache[path] = digest
 
         return digest
 
+    @profiling.timed('write_object')
+    def _write_object(self, digest, final_content):
+        """Writes the stored content of an object to a loose object file
+
+        Inside of an _object_batch the object is only staged.
+        """
+        if self._staged_objects is not None:
+            self._stage_object(digest, final_content)
+            return
+
+        # Parse object directory and filename
+        obj_path = self._loose_object_path(digest)
+        obj_dir = os.path.dirname(obj_path)
+
+        # Make the directory if it does not exist
+        os.makedirs(obj_dir, exist_ok=True)
+
+        # Write the final content to a temporary file and move it into
+        # place, so concurrent writers of the same object never interleave
+        temp_fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=obj_dir)
+        with open(temp_fd, 'wb') as obj_file:
+            obj_file.write(final_content)
+        os.replace(temp_path, obj_path)
+        self.stats.count('objects_written')
+        self.stats.count('bytes_written', len(final_content))
+
+    @contextlib.contextmanager
+    def _object_batch(self):
+        """Context manager to write all new objects at once when it exits
+
+        Objects written inside the context are staged in temporary files,
+        which only this instance reads them from. When the context exits,
+        the staged files are flushed to disk together, moved into place and
+        the moves flushed again. A crash can therefore never leave a
+        truncated object, without an fsync for every object. Staged objects
+        are discarded if an exception is raised inside the context.
+        """
+        if self._staged_objects is not None:
+            yield
+            return
+
+        os.makedirs(self._join_root(self.DIRS['staging']), exist_ok=True)
+        self._staged_objects = {}
+        try:
+            yield
+            staged = self._staged_objects
+        except BaseException:
+            for temp_path in self._staged_objects.values():
+                os.remove(temp_path)
+            raise
+        finally:
+            self._staged_objects = None
+
+        if not staged:
+            return
+
+        # Flush the content of every object before it becomes visible
+        self._flush_to_disk(staged.values())
+
+        # Move the objects into place, creating each directory only once
+        obj_paths = {
+            digest: self._loose_object_path(digest) for digest in staged
+        }
+        obj_dirs = {
+            os.path.dirname(obj_path) for obj_path in obj_paths.values()
+        }
+        synced_dirs = set(obj_dirs)
+        for obj_dir in obj_dirs:
+            if not os.path.isdir(obj_dir):
+                os.makedirs(obj_dir, exist_ok=True)
+                synced_dirs.add(os.path.dirname(obj_dir))
+        for digest, temp_path in staged.items():
+            os.replace(temp_path, obj_paths[digest])
+
+        # Flush the moves and any new directories before anything refers to
+        # the new objects
+        self._flush_to_disk(synced_dirs)
+        self.stats.count('objects_written', len(staged))
+
+    def _stage_object(self, digest, final_content):
+        """Writes the stored content of an object to a staged file"""
+        temp_fd, temp_path = tempfile.mkstemp(
+            suffix='.tmp', dir=self._join_root(self.DIRS['staging'])
+        )
+        with open(temp_fd, 'wb') as obj_file:
+            obj_file.write(final_content)
+        self.stats.count('bytes_written', len(final_content))
+
+        # The same object may be stored by several threads at once
+        with self._staging_lock:
+            if digest not in self._staged_objects:
+                self._staged_objects[digest] = temp_path
+                return
+        os.remove(temp_path)
+
+    def _flush_to_disk(self, paths):
+        """Flushes written files and directories to disk
+
+        Uses a single sync of the file system holding the repository where
+        available, otherwise each file and directory is synced on its own.
+        """
+        if not self.FSYNC:
+            return
+        with self.stats.timer('sync'):
+            if utils.sync_file_system(self._join_root(self.DIRS['objects'])):
+                return
+            for path in paths:
+                utils.fsync_path(path)
+
     def _byte_convert(self, payload):
         """Check that an object is bytes, otherwise attempt to encode"""
         if type(payload) is bytes:
@@ -568,69 +2479,468 @@ class Repository:
         # Try to encode if not bytes already
         return payload.encode()
 
+    @profiling.timed('hash')
     def _hash_diget(self, payload):
         """Returns a hex digest for the hash of the given payload"""
+        self.stats.count('bytes_hashed', len(payload))
         hasher = hashlib.sha1()
         hasher.update(payload)
         return hasher.hexdigest()
 
-    def _delta_compress(self, obj_path, obj_hash, obj_content):
+    @profiling.timed('delta_compress')
+    def _delta_compress(self, obj_path, obj_hash, obj_content, sketch=None):
         """Compresses a new object file by replacing with a delta
 
-        Returns either a patch to a previous version of this file or returns
-        the original content to be written as a new reference.
+        Returns the stored form of either a patch to a previous version of
+        this file or of the original content to be written as a new
+        reference. A full copy (keyframe) is also returned once the chain of
+        patches leading to the previous version has reached the maximum
+        delta depth. If the path has no previous version and the fingerprint
+        of the content is given, a similar object stored for another path,
+        such as the file before it was renamed or copied, is used instead.
 
         NOTE:
           The file name hash no longer will reflect the true file
           content, rather the content that the delta reflects.
         """
-
-        # Check if the path is in the objhashcache
-        if obj_path not in self.objhashcache:
-            # Return the uncompress content
-            return obj_content
+        # Get the reference file from the objhashcache
+        ref_hash = self.objhashcache.get(obj_path)
 
         # Check if changes were made to the object file
-        if self.objhashcache[obj_path] == obj_hash:
+        if ref_hash == obj_hash:
             return None
 
-        # Get paths to the reference file
-        ref_hash = self.objhashcache[obj_path]
+        # Otherwise search for a similar object
+        if ref_hash is None and sketch is not None:
+            ref_hash = self._similar_base(len(obj_content), sketch)
+
+        # Return the full content if there is no reference
+        if ref_hash is None:
+            return self._encode_full(obj_content)
+
+        # Store a keyframe if the delta chain would grow too long
+        depth = self._delta_depth(ref_hash) + 1
+        if depth > self.max_delta_depth:
+            return self._encode_full(obj_content)
 
         # Calculate delta from the reference version to the new version
-        patch = bindifflib.diff(
+        patch = self._diff(
             self._byte_convert(obj_content),
             self._read_object(ref_hash),
         )
 
         # Format delta contents
-        patch_tuple = (ref_hash, patch)
-        return pickle.dumps(patch_tuple)
+        self.stats.count('deltas_created')
+        return objects.encode(
+            objects.DELTA, patch, len(obj_content), ref_hash, depth
+        )
+
+    @profiling.timed('similar_base')
+    def _similar_base(self, size, sketch):
+        """Returns the hash of the most similar recent object or None
 
+        Only objects within one size class of the content and within the
+        similarity window are compared, and only objects that can still
+        take another delta without exceeding the maximum delta depth.
+        """
+        best_hash = None
+        best_similarity = self.MIN_SIMILARITY
+        for obj_hash, other in self.fingerprints.candidates(
+                size, self.similarity_window):
+            self.stats.count('similarity_compared')
+            score = similarity.similarity(sketch, other)
+            if score < best_similarity:
+                continue
+            if (not self._object_exists(obj_hash) or
+                    self._delta_depth(obj_hash) >= self.max_delta_depth):
+                continue
+            best_hash, best_similarity = obj_hash, score
+
+        if best_hash is not None:
+            self.stats.count('similar_bases')
+        return best_hash
+
+    def _encode_full(self, obj_content):
+        """Returns the stored form of a full object, compressed if useful
+
+        Content that does not compress well, such as already compressed
+        media, is stored as is.
+        """
+        if self.compression_level and compression.is_compressible(obj_content):
+            payload = self.codec.compress(obj_content, self.compression_level)
+            if len(payload) < len(obj_content):
+                return objects.encode(
+                    objects.COMPRESSED, payload, len(obj_content),
+                    codec=self.codec.id,
+                )
+
+        return objects.encode(objects.FULL, obj_content, len(obj_content))
+
+    @profiling.timed('diff')
+    def _diff(self, obj_content, ref_content):
+        """Returns a patch, computed in a worker process if one is available
+
+        Small files are always diffed directly since sending them to another
+        process costs more than the diff itself.
+        """
+        if (self._diff_executor is None or
+                len(obj_content) < self.PROCESS_DIFF_SIZE):
+            return bindifflib.diff(
+                obj_content, ref_content, self.delta_engine, self.delta_memory
+            )
+
+        return self._diff_executor.submit(
+            bindifflib.diff, obj_content, ref_content, self.delta_engine,
+            self.delta_memory,
+        ).result()
+
+    @profiling.timed('read_object')
     def _read_object(self, obj_hash):
         """Reads and returns the contents of an object file with given hash
 
-        Recursively rebuilds any necessary files from their deltas
+        Iteratively rebuilds any necessary files from their deltas. Every
+        version rebuilt along the way is kept in the object cache, so deltas
+        sharing a base do not rebuild it again.
         """
-        obj_dir = self._join_root(
-            os.path.join(self.DIRS['objects'], obj_hash[:2])
-        )
-        obj_path = os.path.join(obj_dir, obj_hash[2:])
+        # Follow the delta chain back to a cached version or a full copy
+        patches = []
+        content = self.object_cache.get(obj_hash)
+        while content is None:
+            header, payload = self._decode_object(
+                obj_hash, self._read_raw_object(obj_hash)
+            )
+            self.stats.count('objects_read')
+            if header.type == objects.COMPRESSED:
+                content = compression.get_codec(header.codec).decompress(
+                    payload
+                )
+            elif header.type == objects.CHUNKED:
+                content = b''.join(
+                    self._read_object(chunk_hash) for chunk_hash, _ in
+                    objects.decode_chunk_list(payload)
+                )
+            elif header.type != objects.DELTA:
+                content = payload
+            if content is not None:
+                self.object_cache.put(obj_hash, content)
+                break
+            patches.append((obj_hash, payload))
+            obj_hash = header.base
+            content = self.object_cache.get(obj_hash)
+
+        # Apply the patches from the oldest to the newest version
+        if patches:
+            self.stats.record('delta_chain_length', len(patches))
+        for patched_hash, patch in reversed(patches):
+            content = bindifflib.patch(patch, content)
+            self.object_cache.put(patched_hash, content)
+            self.stats.count('patches_applied')
 
-        # Read the object file content
-        with open(obj_path, 'rb') as obj_file:
-            content = obj_file.read()
+        return content
+
+    def _read_raw_object(self, obj_hash, size=None):
+        """Reads the stored content of an object without rebuilding
 
-        # Check if a delta by comparing the content to the hash value
-        if obj_hash != self._hash_diget(content):
-            # Delta object must be rebuilt
-            patch_tuple = pickle.loads(content)
-            ref_content = self._read_object(patch_tuple[0])
-            return bindifflib.patch(patch_tuple[1], ref_content)
+        Loose objects are read first, then each of the packs. If a size is
+        given, at most that many bytes are read from the start.
 
-        # If object is not a delta, simply return it's content
+        Raises:
+          FileNotFoundError: If the object is not stored in the repository
+        """
+        try:
+            return self._read_loose_object(obj_hash, size)
+        except FileNotFoundError:
+            pass
+
+        content = self._read_packed_object(obj_hash, size)
+        if content is None:
+            # The object may have been packed since the packs were loaded
+            self._reload_packs()
+            content = self._read_packed_object(obj_hash, size)
+        if content is None:
+            raise FileNotFoundError('Object not found: {}'.format(obj_hash))
         return content
 
+    def _read_loose_object(self, obj_hash, size=None):
+        """Reads the stored content of a loose or staged object file"""
+        obj_path = self._loose_object_path(obj_hash)
+        staged = self._staged_objects
+        if staged is not None and obj_hash in staged:
+            obj_path = staged[obj_hash]
+        with open(obj_path, 'rb') as obj_file:
+            return obj_file.read(size)
+
+    def _read_packed_object(self, obj_hash, size=None):
+        """Reads the stored content of a packed object or returns None"""
+        if self._packs is None:
+            self._reload_packs()
+        for obj_pack in self._packs:
+            content = obj_pack.read(obj_hash, size)
+            if content is not None:
+                return content
+        return None
+
+    def _object_exists(self, obj_hash):
+        """Check if an object is stored either loose or in a pack"""
+        staged = self._staged_objects
+        if staged is not None and obj_hash in staged:
+            return True
+        if os.path.isfile(self._loose_object_path(obj_hash)):
+            return True
+        if self._packs is None:
+            self._reload_packs()
+        return any(obj_hash in obj_pack for obj_pack in self._packs)
+
+    def _reload_packs(self):
+        """Loads any new packs and closes the packs that no longer exist"""
+        with self._packs_lock:
+            loaded = {
+                obj_pack.pack_path: obj_pack for obj_pack in self._packs or []
+            }
+            packs = [
+                loaded.pop(pack_path, None) or pack.Pack(pack_path)
+                for pack_path in pack.list_packs(
+                    self._join_root(self.DIRS['packs'])
+                )
+            ]
+            for obj_pack in loaded.values():
+                obj_pack.close()
+            self._packs = packs
+
+    def _loose_object_path(self, obj_hash):
+        """Returns the path to the loose object file with the given hash"""
+        return self._join_root(
+            os.path.join(self.DIRS['objects'], obj_hash[:2], obj_hash[2:])
+        )
+
+    def _list_loose_objects(self):
+        """Returns a list of the hashes of all loose objects"""
+        objects_dir = self._join_root(self.DIRS['objects'])
+        return [
+            fanout.name + entry.name
+            for fanout in utils.iter_entries(objects_dir)
+            if len(fanout.name) == 2 and utils.is_directory(fanout)
+            for entry in utils.iter_entries(fanout.path)
+            if len(entry.name) == 38
+        ]
+
+    def _decode_object(self, obj_hash, raw_content):
+        """Returns the (header, payload) of the stored content of an object
+
+        Repositories older than format version 2 may also contain objects
+        without a header. Those are full copies if the content matches the
+        hash and pickled (base hash, patch[, depth]) deltas otherwise. Their
+        depth is None if it was not recorded.
+        """
+        if self.format_version >= 2:
+            return objects.decode(raw_content)
+
+        # Legacy full copies are detected by comparing the content hash
+        if obj_hash == self._hash_diget(raw_content):
+            header = objects.ObjectHeader(
+                objects.FULL, 0, 0, None, len(raw_content)
+            )
+            return header, raw_content
+
+        if objects.is_encoded(raw_content):
+            return objects.decode(raw_content)
+
+        # Legacy deltas are pickled tuples
+        patch_tuple = pickle.loads(raw_content)
+        depth = patch_tuple[2] if len(patch_tuple) > 2 else None
+        header = objects.ObjectHeader(
+            objects.DELTA, 0, depth, patch_tuple[0], None
+        )
+        return header, patch_tuple[1]
+
+    def _read_object_header(self, obj_hash):
+        """Returns the header of an object without reading its payload
+
+        Objects of older repositories may have no header, in which case the
+        whole object has to be read to construct one.
+        """
+        if self.format_version >= 2:
+            raw_header = self._read_raw_object(obj_hash, objects.HEADER.size)
+            return objects.decode(raw_header)[0]
+
+        header, _ = self._decode_object(
+            obj_hash, self._read_raw_object(obj_hash)
+        )
+        return header
+
+    def _delta_depth(self, obj_hash):
+        """Returns the number of patches needed to rebuild an object
+
+        Full objects have a depth of 0. Deltas written before the depth was
+        recorded in the metadata are counted by following their chain.
+        """
+        depth = 0
+        header = self._read_object_header(obj_hash)
+        while header.depth is None:
+            depth += 1
+            header = self._read_object_header(header.base)
+        return depth + header.depth
+
+    def _write_migrated_object(self, obj_hash, force=False):
+        """Rewrites an object in the current object format if necessary
+
+        Returns True if the object was written. With force the object is
+        always written as a loose object, even if it is already converted.
+        """
+        raw_content = self._read_raw_object(obj_hash)
+        is_legacy = (
+            obj_hash == self._hash_diget(raw_content) or
+            not objects.is_encoded(raw_content)
+        )
+        if not is_legacy and not force:
+            return False
+
+        if is_legacy:
+            header, payload = self._decode_object(obj_hash, raw_content)
+            if header.type == objects.DELTA:
+                raw_content = objects.encode(
+                    objects.DELTA, payload,
+                    len(self._read_object(obj_hash)),
+                    header.base, self._delta_depth(obj_hash),
+                )
+            else:
+                raw_content = self._encode_full(payload)
+
+        # Replace the object atomically
+        obj_path = self._loose_object_path(obj_hash)
+        os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+        with open(obj_path + '.tmp', 'wb') as obj_file:
+            obj_file.write(raw_content)
+        os.replace(obj_path + '.tmp', obj_path)
+        return is_legacy
+
+    def _remove_empty_fanout_dirs(self):
+        """Removes the fan-out directories without loose objects"""
+        objects_dir = self._join_root(self.DIRS['objects'])
+        for name in os.listdir(objects_dir):
+            fanout_dir = os.path.join(objects_dir, name)
+            if len(name) == 2 and not os.listdir(fanout_dir):
+                os.rmdir(fanout_dir)
+
+    def _object_storage_size(self):
+        """Returns the total size of all loose object and pack files"""
+        size = sum(
+            os.path.getsize(self._loose_object_path(obj_hash))
+            for obj_hash in self._list_loose_objects()
+        )
+        for pack_path in pack.list_packs(self._join_root(self.DIRS['packs'])):
+            size += os.path.getsize(pack_path)
+            size += os.path.getsize(pack_path[:-len('.pack')] + '.idx')
+        return size
+
+    def _stored_objects(self):
+        """Returns {hash: time last written} of every stored object"""
+        stored = {}
+        for obj_pack in self._packs:
+            mtime = os.path.getmtime(obj_pack.pack_path)
+            for obj_hash in obj_pack:
+                stored[obj_hash] = max(stored.get(obj_hash, 0), mtime)
+        for obj_hash in self._list_loose_objects():
+            mtime = os.path.getmtime(self._loose_object_path(obj_hash))
+            stored[obj_hash] = max(stored.get(obj_hash, 0), mtime)
+        return stored
+
+    def _snapshot_roots(self):
+        """Returns the hashes of every snapshot that can be checked out"""
+        with self.stats.timer('snapshotdb'):
+            roots = set(ssdb.prefix_matches(
+                self._join_root(self.FILES['snapshots']), '', -1
+            ))
+        for branch in self.list_branches():
+            roots.add(self._get_branch_head(branch))
+        roots.add(self._current_snapshot_hash()[0])
+        roots.discard(None)
+        return roots
+
+    def _mark_reachable(self, obj_hash, is_tree, reachable, walked_trees):
+        """Adds an object and every object it depends on to reachable
+
+        The entries of trees are followed, as are the delta bases and
+        chunks needed to rebuild each object.
+        """
+        stack = [(obj_hash, is_tree)]
+        while stack:
+            obj_hash, is_tree = stack.pop()
+            if is_tree and obj_hash not in walked_trees:
+                walked_trees.add(obj_hash)
+                stack.extend(
+                    (entry_hash, obj_type == 'tree')
+                    for obj_type, entry_hash, _ in self._read_tree(obj_hash)
+                )
+            if obj_hash in reachable:
+                continue
+            reachable.add(obj_hash)
+            stack.extend(
+                (dependency, False)
+                for dependency in self._object_dependencies(obj_hash)
+            )
+
+    def _object_dependencies(self, obj_hash):
+        """Returns the hashes of the objects needed to rebuild an object"""
+        header = self._read_object_header(obj_hash)
+        if header.type == objects.DELTA:
+            return [header.base]
+        if header.type == objects.CHUNKED:
+            _, payload = self._decode_object(
+                obj_hash, self._read_raw_object(obj_hash)
+            )
+            return [
+                chunk_hash
+                for chunk_hash, _ in objects.decode_chunk_list(payload)
+            ]
+        return []
+
+    def _is_stored_tree(self, obj_hash, stored):
+        """Check if an object is a tree whose entries are all stored"""
+        try:
+            entries = self._read_tree(obj_hash)
+        except trees.TreeFormatException:
+            return False
+        return all(
+            obj_type in ('tree', 'blob') and entry_hash in stored
+            for obj_type, entry_hash, _ in entries
+        )
+
+    def _rebase_deltas(self, reachable):
+        """Bounds the delta chains of objects and returns those rewritten"""
+        rebased = set()
+        depths = {}
+        for obj_hash in sorted(reachable):
+            # Follow the chain back to an object with a known depth
+            chain = []
+            while obj_hash not in depths:
+                header = self._read_object_header(obj_hash)
+                if header.type != objects.DELTA:
+                    depths[obj_hash] = 0
+                    break
+                chain.append((obj_hash, header))
+                obj_hash = header.base
+
+            # Then rewrite the deltas from the oldest to the newest version
+            depth = depths[obj_hash]
+            for obj_hash, header in reversed(chain):
+                depth += 1
+                _, payload = objects.decode(self._read_raw_object(obj_hash))
+                if depth > self.max_delta_depth or len(payload) >= header.length:
+                    self._write_object(
+                        obj_hash, self._encode_full(self._read_object(obj_hash))
+                    )
+                    depth = 0
+                    rebased.add(obj_hash)
+                elif depth != header.depth:
+                    self._write_object(obj_hash, objects.encode(
+                        objects.DELTA, payload, header.length, header.base,
+                        depth,
+                    ))
+                    rebased.add(obj_hash)
+                depths[obj_hash] = depth
+        return rebased
+
     def _match_branch(self, snapshot_hash):
         """Checks if any current branch matches the given hash"""
         head_dir = self._join_root(self.DIRS['heads'])
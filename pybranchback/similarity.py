@@ -0,0 +1,202 @@
+"""Content fingerprints used to find similar objects as delta bases
+
+A fingerprint is a sample of the hashes of the pieces of some content.
+Content is split into pieces at newlines, so the pieces only depend on the
+content around them and an insertion does not change every piece after
+it. Long pieces are split again into blocks. The fingerprint keeps the
+smallest piece hashes (a bottom-k sketch), so the fingerprints of two
+versions sample the same pieces wherever the versions are identical.
+"""
+import collections
+import heapq
+import itertools
+import struct
+import threading
+import zlib
+
+import pybranchback.snapshotdb as ssdb
+
+
+# Number of piece hashes kept in a fingerprint
+SKETCH_SIZE = 64
+# Pieces longer than this are split into blocks of BLOCK_SIZE bytes
+MAX_PIECE = 1024
+BLOCK_SIZE = 256
+# Pieces shorter than this are too common to tell content apart
+MIN_PIECE = 8
+
+CREATE = (
+    """
+    CREATE TABLE IF NOT EXISTS fingerprints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        hash TEXT UNIQUE NOT NULL,
+        size_class INTEGER NOT NULL,
+        sketch BLOB NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS fingerprints_size_class
+    ON fingerprints (size_class, id)
+    """,
+)
+INSERT = """
+    INSERT OR IGNORE INTO fingerprints (hash, size_class, sketch)
+    VALUES (?, ?, ?)
+"""
+SELECT = """SELECT sketch FROM fingerprints WHERE hash = ?"""
+# Most recently stored objects of similar size first
+SELECT_CANDIDATES = """
+    SELECT hash, sketch FROM fingerprints
+    WHERE size_class BETWEEN ? AND ?
+    ORDER BY id DESC LIMIT ?
+"""
+DELETE = """DELETE FROM fingerprints WHERE hash = ?"""
+
+
+def fingerprint(content):
+    """Returns the fingerprint of content as a frozenset of piece hashes"""
+    hashes = set()
+    for piece in content.split(b'\n'):
+        if len(piece) <= MAX_PIECE:
+            if len(piece) >= MIN_PIECE:
+                hashes.add(zlib.crc32(piece))
+            continue
+        for start in range(0, len(piece), BLOCK_SIZE):
+            hashes.add(zlib.crc32(piece[start:start + BLOCK_SIZE]))
+    return frozenset(heapq.nsmallest(SKETCH_SIZE, hashes))
+
+
+def similarity(sketch, other):
+    """Returns the estimated fraction of pieces two fingerprints share"""
+    union = heapq.nsmallest(SKETCH_SIZE, sketch | other)
+    if not union:
+        return 0.0
+    shared = sketch & other
+    return sum(1 for piece in union if piece in shared) / len(union)
+
+
+def size_class(size):
+    """Returns the size class of content, sizes within a power of two"""
+    return size.bit_length()
+
+
+def pack_sketch(sketch):
+    """Returns the stored form of a fingerprint"""
+    return struct.pack('>{}I'.format(len(sketch)), *sorted(sketch))
+
+
+def unpack_sketch(data):
+    """Returns a fingerprint from its stored form"""
+    return frozenset(struct.unpack('>{}I'.format(len(data) // 4), data))
+
+
+class FingerprintIndex:
+
+    """Fingerprints of stored objects by size class, in a SQLite table
+
+    New fingerprints are kept in memory until save and are included in
+    lookups before then.
+    """
+
+    def __init__(self, db_path):
+        """Initialize instance variables"""
+        self.db_path = db_path
+
+        # Instance variables
+        self._pending = {}
+        self._pending_classes = collections.defaultdict(list)
+        self._removed = set()
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Creates the table if it does not exist and discards changes"""
+        with self._lock:
+            con = ssdb.connect(self.db_path)
+            with con:
+                for command in CREATE:
+                    con.execute(command)
+            self._clear_changes()
+
+    def save(self):
+        """Writes all new and removed fingerprints in a single transaction"""
+        with self._lock:
+            con = ssdb.connect(self.db_path)
+            with con:
+                for command in CREATE:
+                    con.execute(command)
+                con.executemany(DELETE, [
+                    (obj_hash,) for obj_hash in self._removed
+                ])
+                con.executemany(INSERT, [
+                    (obj_hash, obj_class, pack_sketch(sketch))
+                    for obj_hash, (obj_class, sketch) in self._pending.items()
+                ])
+            self._clear_changes()
+
+    def add(self, obj_hash, size, sketch):
+        """Adds the fingerprint of a stored object of the given size"""
+        obj_class = size_class(size)
+        with self._lock:
+            if obj_hash in self._pending:
+                return
+            self._pending[obj_hash] = (obj_class, sketch)
+            self._pending_classes[obj_class].append(
+                (next(self._counter), obj_hash)
+            )
+            self._removed.discard(obj_hash)
+
+    def get(self, obj_hash):
+        """Returns the fingerprint of an object or None if not known"""
+        with self._lock:
+            if obj_hash in self._pending:
+                return self._pending[obj_hash][1]
+            if obj_hash in self._removed:
+                return None
+            row = ssdb.connect(self.db_path).execute(
+                SELECT, (obj_hash,)
+            ).fetchone()
+        return None if row is None else unpack_sketch(row[0])
+
+    def remove(self, obj_hashes):
+        """Forgets the fingerprints of objects that no longer exist"""
+        with self._lock:
+            for obj_hash in obj_hashes:
+                self._pending.pop(obj_hash, None)
+                self._removed.add(obj_hash)
+
+    def candidates(self, size, window):
+        """Returns up to window (hash, fingerprint) of objects of similar size
+
+        Objects within one size class of the given size are returned, the
+        most recently added first.
+        """
+        obj_class = size_class(size)
+        with self._lock:
+            # Fingerprints not saved yet are the most recent
+            recent = heapq.nlargest(window, itertools.chain.from_iterable(
+                self._pending_classes[near_class][-window:]
+                for near_class in (obj_class - 1, obj_class, obj_class + 1)
+            ))
+            found = [
+                (obj_hash, self._pending[obj_hash][1])
+                for _, obj_hash in recent
+                if obj_hash in self._pending
+            ]
+
+            rows = ssdb.connect(self.db_path).execute(
+                SELECT_CANDIDATES,
+                (obj_class - 1, obj_class + 1, window + len(self._removed)),
+            ).fetchall()
+            for obj_hash, data in rows:
+                if len(found) >= window:
+                    break
+                if obj_hash not in self._removed:
+                    found.append((obj_hash, unpack_sketch(data)))
+        return found
+
+    def _clear_changes(self):
+        """Forgets all changes not saved yet"""
+        self._pending = {}
+        self._pending_classes = collections.defaultdict(list)
+        self._removed = set()
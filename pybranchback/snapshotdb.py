@@ -1,5 +1,6 @@
-import contextlib
+import os
 import sqlite3
+import threading
 
 
 CREATE = """
@@ -12,27 +13,161 @@ CREATE = """
         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
     );
 """
+# Files renamed by a snapshot since the previous snapshot of its branch
+CREATE_RENAMES = """
+    CREATE TABLE IF NOT EXISTS renames (
+        snapshot TEXT NOT NULL,
+        old_path TEXT NOT NULL,
+        new_path TEXT NOT NULL,
+        old_hash TEXT NOT NULL,
+        new_hash TEXT NOT NULL
+    )
+"""
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS snapshots_hash ON snapshots (hash)',
+    'CREATE INDEX IF NOT EXISTS snapshots_branch ON snapshots (branch)',
+    'CREATE INDEX IF NOT EXISTS snapshots_timestamp ON snapshots (timestamp)',
+    CREATE_RENAMES,
+    'CREATE INDEX IF NOT EXISTS renames_snapshot ON renames (snapshot)',
+)
 INSERT = """
     INSERT INTO snapshots (hash, branch, message, user)
     VALUES (:hash, :branch, :message, :user)
 """
 SELECT = """SELECT * FROM snapshots"""
+# Most recent row of a snapshot, preferring the rows of a branch
+SELECT_SNAPSHOT = """
+    SELECT * FROM snapshots WHERE hash = :hash
+    ORDER BY branch = :branch DESC, id DESC LIMIT 1
+"""
+# Most recent row of a snapshot recorded before another row
+SELECT_SNAPSHOT_BEFORE = """
+    SELECT * FROM snapshots WHERE hash = :hash AND id < :id
+    ORDER BY id DESC LIMIT 1
+"""
+# Snapshots of a branch recorded after one row up to another
+SELECT_BRANCH_RANGE = """
+    SELECT * FROM snapshots
+    WHERE branch = :branch AND id > :low AND id <= :high ORDER BY id
+"""
+# Snapshots copied from another repository keep their timestamp
+INSERT_IMPORTED = """
+    INSERT INTO snapshots (hash, branch, message, user, timestamp)
+    SELECT :hash, :branch, :message, :user, :timestamp
+    WHERE NOT EXISTS (
+        SELECT 1 FROM snapshots
+        WHERE hash = :hash AND branch = :branch AND timestamp = :timestamp
+    )
+"""
+# Distinct hashes in the range of a prefix, resolved with the hash index
+SELECT_PREFIX = """
+    SELECT DISTINCT hash FROM snapshots
+    WHERE hash >= :low AND hash < :high
+    ORDER BY hash LIMIT :limit
+"""
+SELECT_ALL_HASHES = """
+    SELECT DISTINCT hash FROM snapshots ORDER BY hash LIMIT :limit
+"""
+INSERT_RENAME = """
+    INSERT INTO renames (snapshot, old_path, new_path, old_hash, new_hash)
+    VALUES (:snapshot, :old_path, :new_path, :old_hash, :new_hash)
+"""
+SELECT_RENAMES = """
+    SELECT old_path, new_path, old_hash, new_hash FROM renames
+    WHERE snapshot = :snapshot ORDER BY new_path
+"""
 
 # Alias sqlite3.Row
 Row = sqlite3.Row
 
+# Open connections, one for each database path, shared between threads
+_connections = {}
+_lock = threading.RLock()
+
+
+def connect(db_path):
+    """Returns the shared connection to a database, opening it if needed
+
+    New connections use WAL journaling and make sure the indexes of an
+    existing snapshots table have been created.
+    """
+    key = os.path.abspath(db_path)
+    with _lock:
+        con = _connections.get(key)
+        if con is None:
+            con = sqlite3.connect(key, check_same_thread=False)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            _connections[key] = con
+            if _has_snapshots_table(con):
+                create_indexes(db_path)
+        return con
+
+
+def close(db_path=None):
+    """Closes the connection to a database, or all connections if None"""
+    with _lock:
+        if db_path is None:
+            keys = list(_connections)
+        else:
+            keys = [os.path.abspath(db_path)]
+        for key in keys:
+            con = _connections.pop(key, None)
+            if con is not None:
+                con.close()
+
+
+def create_indexes(db_path):
+    """Creates the indexes and the renames table if they do not exist"""
+    with _lock:
+        con = connect(db_path)
+        for command in INDEXES:
+            con.execute(command)
+        con.commit()
+
 
 def execute(
         db_path, command, parameters=None,
         row_factory=None, commit=False, cursor=''):
     if parameters is None:
         parameters = {}
-    with contextlib.closing(sqlite3.connect(db_path)) as con:
-        if row_factory is not None:
-            con.row_factory = row_factory
-        with contextlib.closing(con.cursor()) as cur:
+    with _lock:
+        con = connect(db_path)
+        cur = con.cursor()
+        try:
+            if row_factory is not None:
+                cur.row_factory = row_factory
             cur.execute(command, parameters)
             if commit:
                 con.commit()
             if cursor:
                 return getattr(cur, cursor)()
+        finally:
+            cur.close()
+
+
+def prefix_matches(db_path, prefix, limit):
+    """Returns up to limit distinct snapshot hashes starting with prefix
+
+    Uses an indexed range query (hash >= prefix AND hash < next prefix)
+    instead of scanning every snapshot.
+    """
+    if not prefix:
+        rows = execute(
+            db_path, SELECT_ALL_HASHES, {'limit': limit}, cursor='fetchall'
+        )
+    else:
+        parameters = {
+            'low': prefix,
+            'high': prefix[:-1] + chr(ord(prefix[-1]) + 1),
+            'limit': limit,
+        }
+        rows = execute(db_path, SELECT_PREFIX, parameters, cursor='fetchall')
+    return [row[0] for row in rows]
+
+
+def _has_snapshots_table(con):
+    """Check if the snapshots table exists in the connected database"""
+    return con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='snapshots'"
+    ).fetchone() is not None
@@ -0,0 +1,82 @@
+"""Path patterns selecting the subtrees materialized by a sparse checkout
+
+Patterns use the syntax of ignore files (see pybranchback.ignore), but
+select the paths that are written instead of the paths that are skipped.
+A directory matching a pattern is materialized with everything in it, and
+directories that may contain a matching path are created so the walk can
+reach it, unless nothing in them turns out to match. Everything else is
+kept as a reference to its stored object.
+"""
+import re
+
+import pybranchback.ignore as ignore
+
+
+# Modes of a path in a sparse checkout
+FULL = 'full'
+PARTIAL = 'partial'
+EXCLUDED = 'excluded'
+
+
+class SparsePatterns:
+
+    """Decides which paths of a snapshot a sparse checkout materializes"""
+
+    def __init__(self, patterns):
+        """Compiles the patterns"""
+        self.patterns = [
+            pattern for pattern in patterns
+            if ignore.parse_pattern(pattern) is not None
+        ]
+
+        # Instance variables
+        self._rules = ignore.IgnoreRules(self.patterns)
+        self._prefixes = []
+        for pattern in self.patterns:
+            _, negated, _ = ignore.parse_pattern(pattern)
+            if negated:
+                continue
+            pattern = pattern.strip().rstrip('/')
+            if '/' not in pattern:
+                # Names match in any directory
+                self._prefixes.append(None)
+            else:
+                self._prefixes.append(pattern.lstrip('/').split('/'))
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def mode(self, path, is_dir):
+        """Returns FULL, PARTIAL or EXCLUDED for a path of a snapshot
+
+        Only paths in PARTIAL directories have a mode of their own, paths in
+        FULL directories are always materialized.
+        """
+        if self._rules.match(path, is_dir):
+            return FULL
+        if is_dir and self._may_contain(path):
+            return PARTIAL
+        return EXCLUDED
+
+    def _may_contain(self, directory):
+        """Check if a pattern may match a path under a directory"""
+        parts = directory.split('/')
+        for segments in self._prefixes:
+            if segments is None:
+                return True
+            if _matches_prefix(segments, parts):
+                return True
+        return False
+
+
+def _matches_prefix(segments, parts):
+    """Check if the path parts match the leading segments of a pattern"""
+    for index, part in enumerate(parts):
+        if index >= len(segments) - 1:
+            return False
+        if segments[index] == '**':
+            return True
+        regex = ignore.translate(segments[index])
+        if not re.fullmatch(regex, part):
+            return False
+    return True
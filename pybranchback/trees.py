@@ -0,0 +1,159 @@
+"""Formats of the tree objects listing the entries of a directory
+
+Binary trees start with the magic 'PBBT' followed by one record for each
+entry:
+  mode:   TREE or BLOB (u8)
+  digest: raw digest of the entry object (20 bytes)
+  length: length of the encoded name (u16)
+  name:   UTF-8 encoded name of the entry
+
+Text trees of older repositories have one fixed width line for each entry,
+'<type> <40 hex digits> <name>', padded so the hash starts at column 5 and
+the name at column 46, and a single empty line if there are no entries.
+"""
+import struct
+
+
+MAGIC = b'PBBT'
+RECORD = struct.Struct('>B20sH')
+
+# Entry modes
+TREE = 1
+BLOB = 2
+MODES = {'tree': TREE, 'blob': BLOB}
+TYPES = {TREE: 'tree', BLOB: 'blob'}
+
+# Estimated bytes of memory used by a parsed entry besides its name
+ENTRY_OVERHEAD = 160
+
+
+class TreeFormatException(Exception):
+
+    """Stored tree content is not a valid tree"""
+
+    pass
+
+
+class TreeEntry:
+
+    """Entry of a parsed tree, unpacks as (type, hash, name)"""
+
+    __slots__ = ('mode', 'digest', 'name')
+
+    def __init__(self, mode, digest, name):
+        """Initialize instance variables"""
+        self.mode = mode
+        self.digest = digest
+        self.name = name
+
+    @property
+    def type(self):
+        """Returns the type of the entry object, 'tree' or 'blob'"""
+        return TYPES[self.mode]
+
+    @property
+    def hash(self):
+        """Returns the hex digest of the entry object"""
+        return self.digest.hex()
+
+    def __iter__(self):
+        return iter((self.type, self.hash, self.name))
+
+    def __eq__(self, other):
+        if not isinstance(other, (TreeEntry, tuple)):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __hash__(self):
+        # Equal entries and tuples must hash alike
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'TreeEntry{}'.format(tuple(self))
+
+
+def encode(node_entries):
+    """Returns the binary tree content of (type, hash, name) entries"""
+    parts = [MAGIC]
+    for obj_type, obj_hash, obj_name in node_entries:
+        name = obj_name.encode('utf-8', 'surrogateescape')
+        parts.append(RECORD.pack(
+            MODES[obj_type], bytes.fromhex(obj_hash), len(name)
+        ))
+        parts.append(name)
+    return b''.join(parts)
+
+
+def encode_text(node_entries):
+    """Returns the text tree content of (type, hash, name) entries"""
+    return ''.join(
+        '{} {} {}\n'.format(obj_type, obj_hash, obj_name)
+        for obj_type, obj_hash, obj_name in node_entries
+    ) or '\n'
+
+
+def decode(content):
+    """Returns the list of TreeEntry of binary or text tree content
+
+    Raises:
+      TreeFormatException: If the content is not a valid tree
+    """
+    if not is_binary(content):
+        return decode_text(content)
+
+    entries = []
+    offset = len(MAGIC)
+    try:
+        while offset < len(content):
+            mode, digest, length = RECORD.unpack_from(content, offset)
+            offset += RECORD.size
+            name = bytes(content[offset:offset + length])
+            offset += length
+            if mode not in TYPES or len(name) != length:
+                raise TreeFormatException('Invalid tree entry')
+            entries.append(TreeEntry(
+                mode, digest, name.decode('utf-8', 'surrogateescape')
+            ))
+    except struct.error:
+        raise TreeFormatException('Truncated tree entry')
+    return entries
+
+
+def decode_text(content):
+    """Returns the list of TreeEntry of text tree content
+
+    Raises:
+      TreeFormatException: If the content is not a valid tree
+    """
+    try:
+        lines = bytes(content).decode().split('\n')
+    except UnicodeDecodeError:
+        raise TreeFormatException('Tree is not text')
+
+    entries = []
+    for line in lines:
+        clean = line.rstrip()
+        if not clean:
+            continue
+        obj_type = clean[:5].rstrip()
+        obj_hash = clean[5:46].rstrip()
+        if obj_type not in MODES or len(obj_hash) != 40:
+            raise TreeFormatException('Invalid tree line')
+        try:
+            digest = bytes.fromhex(obj_hash)
+        except ValueError:
+            raise TreeFormatException('Invalid tree line')
+        entries.append(
+            TreeEntry(MODES[obj_type], digest, clean[46:].rstrip())
+        )
+    return entries
+
+
+def is_binary(content):
+    """Check if tree content is in the binary format"""
+    return content[:len(MAGIC)] == MAGIC
+
+
+def tree_size(entries):
+    """Returns the estimated bytes of memory used by parsed entries"""
+    return sum(ENTRY_OVERHEAD + len(entry.name) for entry in entries)
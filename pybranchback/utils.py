@@ -1,32 +1,129 @@
+import collections
 import contextlib
+import ctypes
+import ctypes.util
 import os
 import posixpath
+import sys
+
+
+# Entries of a directory from a single listing, as lists of os.DirEntry
+Listing = collections.namedtuple('Listing', ['directories', 'files'])
 
 
 # Helper functions for listing in a file structure with a blacklist
 def list_directories(directory, blacklist=None):
     """Returns a list of all directories not in the blacklist"""
-    return _list_with_blacklist(directory, blacklist, 1)
+    return [
+        entry.name
+        for entry in scan_directory(directory, blacklist).directories
+    ]
 
 
 def list_files(directory, blacklist=None):
     """Returns a list of all files not in the blacklist"""
-    return _list_with_blacklist(directory, blacklist, 2)
+    return [
+        entry.name for entry in scan_directory(directory, blacklist).files
+    ]
 
 
-def _list_with_blacklist(directory, blacklist, return_type):
-    """Returns a listing of a directory with blacklist for a given type
+def scan_directory(directory, blacklist=None):
+    """Returns the Listing of a directory, reading the directory once
 
-    return_type:
-      1:  returns a list of all non-blacklisted directories
-      2:  returns a list of all non-blacklisted files
+    Entries are in the order they are read, the same order as os.walk.
+    Each entry caches its type and its stat data once stat is called, so
+    callers can reuse them instead of reading them again.
+    """
+    listing = Listing([], [])
+    for entry in iter_entries(directory, blacklist):
+        if is_directory(entry):
+            listing.directories.append(entry)
+        else:
+            listing.files.append(entry)
+    return listing
+
+
+def iter_entries(directory, blacklist=None):
+    """Yields the os.DirEntry of a directory not in the blacklist
+
+    Entries are yielded as they are read, without building a list.
     """
     if blacklist is None:
         blacklist = []
-    return [
-        f for f in next(os.walk(directory))[return_type]
-        if f not in blacklist
-    ]
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name not in blacklist:
+                yield entry
+
+
+def stat_entry(entry):
+    """Returns the stat data of an entry, following links like os.stat
+
+    Listings on Windows have no inode numbers, so those entries are stat
+    again by path.
+    """
+    if os.name == 'nt':
+        return os.stat(entry.path)
+    return entry.stat()
+
+
+def is_directory(entry):
+    """Check if an entry is a directory or a link to one, as with os.walk"""
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+# syncfs of libc, False once it is known to be unavailable
+_syncfs = None
+
+
+def sync_file_system(path):
+    """Flushes the whole file system holding a path to disk
+
+    Only Linux provides syncfs, elsewhere False is returned and nothing is
+    flushed.
+    """
+    global _syncfs
+    if _syncfs is None:
+        _syncfs = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(
+                    ctypes.util.find_library('c') or 'libc.so.6',
+                    use_errno=True
+                )
+                _syncfs = libc.syncfs
+            except (OSError, AttributeError):
+                pass
+    if not _syncfs:
+        return False
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            raise OSError(ctypes.get_errno(), 'syncfs failed')
+    finally:
+        os.close(fd)
+    return True
+
+
+def fsync_path(path):
+    """Flushes a file or the entries of a directory to disk
+
+    Directories cannot be opened on Windows, where they are skipped.
+    """
+    if os.path.isdir(path):
+        if os.name == 'nt':
+            return
+        fd = os.open(path, os.O_RDONLY)
+    else:
+        fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 # Returns a list of all strings that start with the given match string
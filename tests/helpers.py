@@ -0,0 +1,48 @@
+"""Helpers creating repositories in temporary directories for tests"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import pybranchback.repository as repository
+
+
+class RepositoryTestCase(unittest.TestCase):
+
+    """Runs each test in a new repository as the working directory"""
+
+    def setUp(self):
+        """Creates the repository"""
+        self.saved_wd = os.getcwd()
+        self.root_dir = tempfile.mkdtemp(prefix='pbb')
+        os.chdir(self.root_dir)
+        self.repo = repository.Repository(self.root_dir, create=True)
+
+    def tearDown(self):
+        """Removes the repository"""
+        os.chdir(self.saved_wd)
+        shutil.rmtree(self.root_dir)
+
+    def reopen(self):
+        """Returns the repository opened again, as by a new command"""
+        self.repo = repository.Repository(self.root_dir)
+        return self.repo
+
+    def write(self, path, content):
+        """Writes a file, creating the directories above it"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as written_file:
+            written_file.write(content)
+
+    def read(self, path):
+        """Returns the content of a file"""
+        with open(path, 'r') as read_file:
+            return read_file.read()
+
+    def changed_paths(self):
+        """Returns the sorted (status, path) of the changes in status"""
+        return sorted(
+            (change.status, change.path) for change in self.repo.status()
+        )
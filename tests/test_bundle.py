@@ -0,0 +1,27 @@
+"""Bundles moving snapshots between repositories"""
+import io
+import unittest
+
+from tests.helpers import RepositoryTestCase
+
+
+class ImportBundleTest(RepositoryTestCase):
+
+    """Importing a bundle into a repository"""
+
+    def setUp(self):
+        """Exports a bundle of a snapshot"""
+        super().setUp()
+        self.write('a.txt', 'a')
+        self.snapshot_hash = self.repo.snapshot('one')
+        self.bundle = io.BytesIO()
+        self.repo.export_bundle(self.bundle)
+
+    def test_existing_snapshots_are_not_added(self):
+        result = self.repo.import_bundle(io.BytesIO(self.bundle.getvalue()))
+        self.assertEqual(result['snapshots'], [])
+        self.assertEqual(result['objects_written'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
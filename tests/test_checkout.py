@@ -0,0 +1,83 @@
+"""Checkouts keeping untracked and ignored paths"""
+import os
+import shutil
+import unittest
+import unittest.mock
+
+import pybranchback.repository as repository
+from tests.helpers import RepositoryTestCase
+
+
+class TypeChangeTest(RepositoryTestCase):
+
+    """Paths that change between a directory and a file"""
+
+    def setUp(self):
+        """Snapshots 'build' as a directory, then as a file"""
+        super().setUp()
+        self.write('.pbbignore', '*.o\n')
+        self.write('build/a.txt', 'a')
+        self.dir_hash = self.repo.snapshot('directory')
+        shutil.rmtree('build')
+        self.write('build', 'file')
+        self.file_hash = self.repo.snapshot('file')
+        self.repo.checkout(self.dir_hash)
+
+    def test_tracked_directory_becomes_file(self):
+        self.repo.checkout('master', branch=True)
+        self.assertEqual(self.read('build'), 'file')
+
+    def test_ignored_file_blocks_directory_becoming_file(self):
+        self.write('build/x.o', 'ignored')
+        with self.assertRaises(repository.DirtyDirectoryException):
+            self.repo.checkout('master', branch=True)
+
+        # Nothing was touched and HEAD did not move
+        self.assertEqual(
+            self.repo._current_snapshot_hash()[0], self.dir_hash
+        )
+        self.assertEqual(self.read('build/a.txt'), 'a')
+        self.assertEqual(self.read('build/x.o'), 'ignored')
+
+    def test_forced_checkout_removes_ignored_file(self):
+        self.write('build/x.o', 'ignored')
+        self.repo.checkout('master', branch=True, force=True)
+        self.assertEqual(self.read('build'), 'file')
+        self.assertEqual(self.changed_paths(), [])
+
+    def test_ignored_file_blocks_file_becoming_directory(self):
+        self.repo.checkout('master', branch=True)
+        self.write(os.path.join('.pbb', 'ignore'), 'build/\n')
+        os.remove('build')
+        self.write('build/x.o', 'ignored')
+        self.reopen()
+        with self.assertRaises(repository.DirtyDirectoryException):
+            self.repo.checkout(self.dir_hash)
+
+    def test_ignored_file_where_directory_goes(self):
+        self.repo.checkout('master', branch=True)
+        self.write('sub/f.txt', 'f')
+        sub_hash = self.repo.snapshot('sub')
+        self.repo.checkout(self.file_hash)
+        self.write(os.path.join('.pbb', 'ignore'), 'sub\n')
+        self.write('sub', 'ignored')
+        self.reopen()
+        with self.assertRaises(repository.DirtyDirectoryException):
+            self.repo.checkout(sub_hash)
+
+        self.repo.checkout(sub_hash, force=True)
+        self.assertEqual(self.read('sub/f.txt'), 'f')
+
+    def test_failed_checkout_keeps_head(self):
+        with unittest.mock.patch.object(
+                repository.Repository, '_write_blob',
+                side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.repo.checkout('master', branch=True)
+        self.assertEqual(
+            self.repo._current_snapshot_hash()[0], self.dir_hash
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
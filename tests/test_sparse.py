@@ -0,0 +1,127 @@
+"""Sparse checkouts materializing only some paths of a snapshot"""
+import os
+import unittest
+
+import pybranchback.repository as repository
+from tests.helpers import RepositoryTestCase
+
+
+class SparseIgnoreTest(RepositoryTestCase):
+
+    """Ignore files of a sparse checkout"""
+
+    def setUp(self):
+        """Snapshots an ignore file next to the selected directory"""
+        super().setUp()
+        self.write('.pbbignore', 'node_modules/\n')
+        self.write('src/a.py', 'a')
+        self.write('docs/b.txt', 'b')
+        self.snapshot_hash = self.repo.snapshot('one')
+
+    def test_ignore_file_is_materialized(self):
+        self.repo.sparse_checkout(['src/'])
+        self.assertTrue(os.path.isfile('.pbbignore'))
+        self.assertFalse(os.path.exists('docs/b.txt'))
+
+    def test_ignored_paths_stay_ignored(self):
+        self.repo.sparse_checkout(['src/'])
+        self.write('node_modules/y.js', 'y')
+        self.assertEqual(self.changed_paths(), [])
+
+        # Nothing changed, so there is nothing to snapshot
+        with self.assertRaises(repository.CleanDirectoryException):
+            self.repo.snapshot('two')
+        self.repo.sparse_checkout([])
+        self.assertEqual(
+            self.repo._current_snapshot_hash()[0], self.snapshot_hash
+        )
+        self.assertEqual(self.changed_paths(), [])
+
+
+class SparseDirectoriesTest(RepositoryTestCase):
+
+    """Directories a sparse checkout leaves on disk"""
+
+    def setUp(self):
+        """Snapshots directories with and without a selected path"""
+        super().setUp()
+        self.write('src/a.py', 'a')
+        self.write('docs/guide/b.txt', 'b')
+        self.write('lib/x.txt', 'x')
+        self.write('lib/src/y.py', 'y')
+        self.snapshot_hash = self.repo.snapshot('one')
+
+    def test_directories_without_selected_paths_are_removed(self):
+        self.repo.sparse_checkout(['src/'])
+        self.assertFalse(os.path.exists('docs'))
+        self.assertFalse(os.path.exists('lib/x.txt'))
+        self.assertEqual(self.read('lib/src/y.py'), 'y')
+        self.assertEqual(self.changed_paths(), [])
+
+    def test_removed_directories_are_kept_in_snapshots(self):
+        self.repo.sparse_checkout(['src/'])
+        self.write('src/a.py', 'changed')
+        self.repo.snapshot('two')
+        self.repo.sparse_checkout([])
+        self.assertEqual(self.read('docs/guide/b.txt'), 'b')
+        self.assertEqual(self.read('lib/x.txt'), 'x')
+
+    def test_checkout_materializes_new_selected_paths(self):
+        self.repo.sparse_checkout(['src/'])
+        self.repo.sparse_checkout([])
+        self.write('docs/src/c.py', 'c')
+        self.write('docs/guide/b.txt', 'changed')
+        self.repo.snapshot('two')
+        self.repo.sparse_checkout(['src/'])
+        self.assertFalse(os.path.exists('docs/guide'))
+
+        self.repo.checkout(self.snapshot_hash)
+        self.assertFalse(os.path.exists('docs'))
+        self.assertEqual(self.changed_paths(), [])
+        self.repo.checkout('master', branch=True)
+        self.assertEqual(self.read('docs/src/c.py'), 'c')
+        self.assertFalse(os.path.exists('docs/guide'))
+        self.assertEqual(self.changed_paths(), [])
+
+
+class SparseLostIndexTest(RepositoryTestCase):
+
+    """Sparse checkouts whose index is lost"""
+
+    def setUp(self):
+        """Sparse checkout of a snapshot"""
+        super().setUp()
+        self.write('src/a.py', 'a')
+        self.write('docs/big', 'big')
+        self.write('lib/x', 'x')
+        self.write('lib/src/y.py', 'y')
+        self.snapshot_hash = self.repo.snapshot('one')
+        self.repo.sparse_checkout(['src/'])
+        self.index_path = os.path.join('.pbb', 'index')
+
+    def assert_excluded_paths_kept(self):
+        """Checks excluded paths are unchanged and kept by snapshots"""
+        self.reopen()
+        self.assertEqual(self.changed_paths(), [])
+        self.write('src/a.py', 'changed')
+        self.repo.snapshot('two')
+        changes = self.repo.diff(self.snapshot_hash, 'master')
+        self.assertEqual([change.path for change in changes], ['src/a.py'])
+
+    def test_missing_index(self):
+        os.remove(self.index_path)
+        self.assert_excluded_paths_kept()
+
+    def test_corrupt_index(self):
+        with open(self.index_path, 'wb') as index_file:
+            index_file.write(b'not an index')
+        self.assert_excluded_paths_kept()
+
+    def test_torn_index_change(self):
+        with open(self.index_path, 'ab') as index_file:
+            index_file.write(b'\x80\x04torn')
+        self.assert_excluded_paths_kept()
+
+
+if __name__ == '__main__':
+    unittest.main()